@@ -1,9 +1,16 @@
+from typing import Dict
 import importlib
+
+import numpy as np
+import healpy as hp
+from scipy.ndimage import uniform_filter
 from skimage.metrics import (
                              peak_signal_noise_ratio, 
                             #  structural_similarity
                              )
 
+from cmbml.utils.physics_ps import get_transfer_function, get_correlation_coefficient
+
 
 def get_func(func_str):
     """Dynamically imports a function from a given module path string."""
@@ -26,11 +33,19 @@ def psnr(true, pred):
     return peak_signal_noise_ratio(true, pred, data_range=data_range)
 
 
-def ssim(true, pred):
-    # Not currently implemented. From my brief literature review, it seems that SSIM tracks PSNR closely and was developed for human readability. I do not think it's appropriate here.
-    data_range = get_data_range(true, pred)
-    # return structural_similarity(true, pred, data_range=data_range)
-    raise NotImplementedError("SSIM Requires arranging pixels as grids. Functions for such rearranging can come from the Healplay experiments, from Wang's method, or healpy's Cartesian projection (healpy.projector.CartesianProj).")
+def ssim(true, pred, **kwargs):
+    """
+    SSIM of full HEALPix maps (not compressed), on the faces of the HEALPix grid (see ssim_batch).
+    Maps with several fields give the mean over fields.
+    """
+    return float(np.mean(ssim_batch(true, pred, **kwargs)))
+
+
+def ms_ssim(true, pred, **kwargs):
+    """
+    Multi-scale SSIM of full HEALPix maps (see ms_ssim_batch).
+    """
+    return float(np.mean(ms_ssim_batch(true, pred, **kwargs)))
 
 
 def get_data_range(true, pred):
@@ -38,3 +53,233 @@ def get_data_range(true, pred):
     min_val = min(true.min(), pred.min())
     return max_val - min_val
 
+
+
+# Vectorized equivalents of the stat functions, for stacks of spectra or maps.
+#    Each compares true and pred along the last axis (other axes broadcast) and
+#    returns an array of results. Keys match the 'func' strings in the config.
+
+def mean_squared_error_batch(true, pred):
+    err = np.asarray(true, dtype=np.float64) - np.asarray(pred, dtype=np.float64)
+    return np.mean(err * err, axis=-1)
+
+
+def mean_absolute_error_batch(true, pred):
+    err = np.asarray(true, dtype=np.float64) - np.asarray(pred, dtype=np.float64)
+    return np.mean(np.abs(err), axis=-1)
+
+
+def normalized_root_mse_batch(true, pred, normalization="euclidean"):
+    true = np.asarray(true, dtype=np.float64)
+    normalization = normalization.lower()
+    if normalization == "euclidean":
+        denom = np.sqrt(np.mean(true * true, axis=-1))
+    elif normalization == "min-max":
+        denom = true.max(axis=-1) - true.min(axis=-1)
+    elif normalization == "mean":
+        denom = true.mean(axis=-1)
+    else:
+        raise ValueError("Unsupported norm_type")
+    return np.sqrt(mean_squared_error_batch(true, pred)) / denom
+
+
+def psnr_batch(true, pred):
+    true, pred = np.broadcast_arrays(np.asarray(true, dtype=np.float64), np.asarray(pred, dtype=np.float64))
+    data_range = np.maximum(true.max(axis=-1), pred.max(axis=-1)) - np.minimum(true.min(axis=-1), pred.min(axis=-1))
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10((data_range ** 2) / mean_squared_error_batch(true, pred))
+
+
+# SSIM on the sphere.
+#    SSIM needs pixels arranged on grids. Ring-ordered HEALPix maps are rearranged
+#    onto the 12 base faces of the HEALPix grid, each nside x nside, in which
+#    neighboring pixels are neighbors on the sky. The rearrangement is a single
+#    gather, with indices computed once per nside (get_face_index). Windows do not
+#    cross the edges of faces. At each coarser scale of MS-SSIM, 2x2 blocks of a
+#    face are averaged, which is the same as ud_grade to nside // 2.
+#    UNSEEN pixels (in either map) are excluded: only windows entirely on seen pixels count.
+#    Defaults follow skimage.metrics.structural_similarity, which these match on a single face.
+
+# Face indices by nside; (12, nside, nside) ring-ordered pixel numbers
+_FACE_INDICES: Dict[int, np.ndarray] = {}
+
+# Weights of the scales of MS-SSIM (Wang, Simoncelli & Bovik, 2003)
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+def get_face_index(nside: int) -> np.ndarray:
+    """
+    The ring-ordered pixel at each position of the 12 HEALPix base faces, (12, nside, nside).
+    """
+    nside = int(nside)
+    face_index = _FACE_INDICES.get(nside, None)
+    if face_index is None:
+        face, x, y = np.meshgrid(np.arange(12), np.arange(nside), np.arange(nside), indexing="ij")
+        face_index = hp.xyf2pix(nside, x, y, face)
+        _FACE_INDICES[nside] = face_index
+    return face_index
+
+
+def to_faces(maps: np.ndarray) -> np.ndarray:
+    """
+    Rearranges ring-ordered maps, (..., npix), onto faces, (..., 12, nside, nside).
+    """
+    npix = maps.shape[-1]
+    if not hp.isnpixok(npix):
+        raise ValueError(f"SSIM needs full HEALPix maps; got {npix} pixels. Pass the maps before removing masked pixels.")
+    return maps[..., get_face_index(hp.npix2nside(npix))]
+
+
+def _ssim_terms(x, y, valid, data_range, win_size, K1, K2):
+    """
+    Luminance and contrast-structure terms of SSIM at each pixel of stacked faces,
+    (n_maps, 12, n, n), and whether each counts toward the mean.
+    """
+    size = (1, 1, win_size, win_size)
+    ux = uniform_filter(x, size=size)
+    uy = uniform_filter(y, size=size)
+    uxx = uniform_filter(x * x, size=size)
+    uyy = uniform_filter(y * y, size=size)
+    uxy = uniform_filter(x * y, size=size)
+    # Sample covariances, as skimage
+    n_pts = win_size ** 2
+    cov_norm = n_pts / (n_pts - 1)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    data_range = data_range.reshape(-1, 1, 1, 1)
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    luminance = (2 * ux * uy + C1) / (ux * ux + uy * uy + C1)
+    contrast_structure = (2 * vxy + C2) / (vx + vy + C2)
+
+    # Only windows entirely within the face and on seen pixels
+    in_window = uniform_filter(valid.astype(np.float64), size=size) > 1 - 0.5 / n_pts
+    pad = (win_size - 1) // 2
+    in_face = np.zeros(valid.shape[-2:], dtype=bool)
+    in_face[pad:valid.shape[-2] - pad, pad:valid.shape[-1] - pad] = True
+    return luminance, contrast_structure, in_window & in_face
+
+
+def _masked_mean(values, counted):
+    n_counted = counted.sum(axis=(1, 2, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counted, values, 0).sum(axis=(1, 2, 3)) / n_counted
+
+
+def _prepare_ssim(true, pred, data_range):
+    """
+    Stacked faces of both maps, with UNSEEN pixels zeroed, the seen pixels, and the data ranges.
+    """
+    true, pred = np.broadcast_arrays(np.asarray(true, dtype=np.float64), np.asarray(pred, dtype=np.float64))
+    lead_shape = true.shape[:-1]
+    x = to_faces(true.reshape(-1, true.shape[-1]))
+    y = to_faces(pred.reshape(-1, pred.shape[-1]))
+    valid = (x != hp.UNSEEN) & (y != hp.UNSEEN)
+    if data_range is None:
+        # Per pair of maps, over pixels seen in both, as get_data_range()
+        hi = np.maximum(np.where(valid, x, -np.inf).max(axis=(1, 2, 3)), np.where(valid, y, -np.inf).max(axis=(1, 2, 3)))
+        lo = np.minimum(np.where(valid, x, np.inf).min(axis=(1, 2, 3)), np.where(valid, y, np.inf).min(axis=(1, 2, 3)))
+        data_range = hi - lo
+    else:
+        data_range = np.broadcast_to(np.asarray(data_range, dtype=np.float64), lead_shape).reshape(-1)
+    x = np.where(valid, x, 0)
+    y = np.where(valid, y, 0)
+    return x, y, valid, data_range, lead_shape
+
+
+def ssim_batch(true, pred, data_range=None, win_size=7, K1=0.01, K2=0.03):
+    """
+    SSIM of stacks of full, ring-ordered HEALPix maps, (..., npix) (other axes broadcast).
+    By default, the data range is that of each pair of maps.
+    """
+    x, y, valid, data_range, lead_shape = _prepare_ssim(true, pred, data_range)
+    luminance, contrast_structure, counted = _ssim_terms(x, y, valid, data_range, win_size, K1, K2)
+    return _masked_mean(luminance * contrast_structure, counted).reshape(lead_shape)
+
+
+def ms_ssim_batch(true, pred, data_range=None, win_size=7, K1=0.01, K2=0.03, weights=MS_SSIM_WEIGHTS):
+    """
+    Multi-scale SSIM of stacks of full, ring-ordered HEALPix maps, (..., npix).
+
+    Contrast-structure is compared at each scale and luminance at the coarsest.
+    Scales are dropped (and the weights renormalized) where faces would be smaller
+    than the window. Negative terms are clipped to 0 so that fractional powers are defined.
+    """
+    x, y, valid, data_range, lead_shape = _prepare_ssim(true, pred, data_range)
+    n_scales = len(weights)
+    while n_scales > 1 and x.shape[-1] // 2 ** (n_scales - 1) < win_size:
+        n_scales -= 1
+    weights = np.asarray(weights[:n_scales], dtype=np.float64)
+    weights = weights / weights.sum()
+
+    result = np.ones(x.shape[0])
+    for scale in range(n_scales):
+        luminance, contrast_structure, counted = _ssim_terms(x, y, valid, data_range, win_size, K1, K2)
+        if scale < n_scales - 1:
+            term = _masked_mean(contrast_structure, counted)
+            x, y, valid = _downsample(x), _downsample(y), _downsample(valid.astype(np.float64)) == 1
+        else:
+            term = _masked_mean(luminance * contrast_structure, counted)
+        result *= np.maximum(term, 0) ** weights[scale]
+    return result.reshape(lead_shape)
+
+
+def _downsample(faces):
+    n_maps, n_faces, n, _ = faces.shape
+    return faces.reshape(n_maps, n_faces, n // 2, 2, n // 2, 2).mean(axis=(3, 5))
+
+
+BATCH_FUNCS = {
+    "skimage.metrics.mean_squared_error": mean_squared_error_batch,
+    "sklearn.metrics.mean_absolute_error": mean_absolute_error_batch,
+    "skimage.metrics.normalized_root_mse": normalized_root_mse_batch,
+    "psnr": psnr_batch,
+    "ssim": ssim_batch,
+    "ms_ssim": ms_ssim_batch,
+}
+
+# Stat functions that compare full maps, rather than the seen pixels alone
+FULL_MAP_FUNCS = {"ssim", "ms_ssim"}
+
+
+def get_batch_func(func_str):
+    """
+    Returns the vectorized equivalent of a stat function. For functions without
+    one, the function is applied along the last axis, one comparison at a time.
+    """
+    if func_str in BATCH_FUNCS:
+        return BATCH_FUNCS[func_str]
+    func = get_func(func_str)
+    def batch_func(true, pred, **kwargs):
+        true, pred = np.broadcast_arrays(true, pred)
+        res = np.empty(true.shape[:-1])
+        for idx in np.ndindex(*true.shape[:-1]):
+            res[idx] = func(true[idx], pred[idx], **kwargs)
+        return res
+    return batch_func
+
+
+# Metrics of cross spectra (prediction x realization), for stacks of spectra.
+#    Each takes the realization, prediction, and cross spectra (ells on the last axis,
+#    other axes broadcast) and returns the mean of a per-ell quantity over
+#    ell_min <= ell <= ell_max. Both are 1 for a perfect prediction.
+
+def _mean_over_ells(per_ell, ell_min, ell_max):
+    ell_max = per_ell.shape[-1] - 1 if ell_max is None else ell_max
+    return np.mean(per_ell[..., ell_min:ell_max + 1], axis=-1)
+
+
+def transfer_function_mean(real, pred, cross, ell_min=2, ell_max=None):
+    """
+    Mean of the transfer function, C^{pred x real}_ell / C^{real}_ell.
+    """
+    return _mean_over_ells(get_transfer_function(cross, real), ell_min, ell_max)
+
+
+def correlation_coefficient_mean(real, pred, cross, ell_min=2, ell_max=None):
+    """
+    Mean of the correlation coefficient, C^{pred x real}_ell / sqrt(C^{pred}_ell C^{real}_ell).
+    """
+    return _mean_over_ells(get_correlation_coefficient(cross, real, pred), ell_min, ell_max)
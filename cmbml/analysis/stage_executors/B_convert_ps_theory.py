@@ -16,10 +16,11 @@ from cmbml.core import (
     BaseStageExecutor, 
     Split,
     GenericHandler,
+    Asset,
     AssetWithPathAlts
     )
 # from ..make_ps import get_power as _get_power
-from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum, NumpyPowerSpectrum
+from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum, NumpyPowerSpectrum, NumpyPowerSpectrumStack
 
 
 logger = logging.getLogger(__name__)
@@ -33,7 +34,9 @@ class FrozenAsset(NamedTuple):
 
 class TaskTarget(NamedTuple):
     asset_in: FrozenAsset
-    asset_out: FrozenAsset
+    asset_out: FrozenAsset  # None if only the stack is made
+    split_name: str
+    sim_num: int            # None for a split with a fixed fiducial spectrum
 
 
 class ConvertTheoryPowerSpectrumExecutor(BaseStageExecutor):
@@ -44,11 +47,24 @@ class ConvertTheoryPowerSpectrumExecutor(BaseStageExecutor):
         self.out_theory_ps: AssetWithPathAlts = self.assets_out["theory_ps"]
         out_theory_ps_handler: NumpyPowerSpectrum
 
+        # Optional: all spectra of each split in one array, (n_sims, n_ell), for memory-mapping
+        self.out_theory_ps_stack: Asset = self.assets_out.get("theory_ps_stack", None)
+        out_theory_ps_stack_handler: NumpyPowerSpectrumStack
+
         self.in_theory_ps: AssetWithPathAlts = self.assets_in["theory_ps"]
         in_theory_ps_handler: CambPowerSpectrum
 
         self.num_processes = cfg.model.analysis.px_operations.num_processes
 
+        # With the stack, the file per sim may be skipped
+        per_sim_files = self._config_help.get_stage_elem_silent("per_sim_files", self.stage_str)
+        self.per_sim_files = per_sim_files if per_sim_files is not None else True
+        if self.out_theory_ps_stack is None and not self.per_sim_files:
+            raise ValueError("convert_theory_ps has per_sim_files set to False, but no theory_ps_stack output.")
+
+        # Spectra collected for the stacks, by split and sim (in execute())
+        self.stack_rows: Dict[str, Dict[int, np.ndarray]] = {}
+
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
 
@@ -63,24 +79,30 @@ class ConvertTheoryPowerSpectrumExecutor(BaseStageExecutor):
 
         self.run_all_tasks(parallel_convert, tasks)
 
+        if self.out_theory_ps_stack is not None:
+            self.write_stacks()
+
     def build_tasks(self):
         tasks = []
         for split in self.splits:
             with self.name_tracker.set_context("split", split):
                 if split.ps_fidu_fixed:
-                    task = self.build_a_task(split.ps_fidu_fixed)
+                    # A single spectrum; always written as its own file
+                    task = self.build_a_task(split.name, None, split.ps_fidu_fixed, write_out=True)
                     tasks.append(task)
                     continue
+                if self.out_theory_ps_stack is not None:
+                    self.stack_rows[split.name] = {}
                 for sim in split.iter_sims():
                     with self.name_tracker.set_context("sim_num", sim):
-                        task = self.build_a_task(split.ps_fidu_fixed)
+                        task = self.build_a_task(split.name, sim, split.ps_fidu_fixed, write_out=self.per_sim_files)
                         tasks.append(task)
         return tasks
 
-    def build_a_task(self, use_path_alt):
+    def build_a_task(self, split_name, sim_num, use_path_alt, write_out):
         ps_in = self.make_frozen_asset(self.in_theory_ps, use_path_alt)
-        ps_out = self.make_frozen_asset(self.out_theory_ps, use_path_alt)
-        task = TaskTarget(asset_in=ps_in, asset_out=ps_out)
+        ps_out = self.make_frozen_asset(self.out_theory_ps, use_path_alt) if write_out else None
+        task = TaskTarget(asset_in=ps_in, asset_out=ps_out, split_name=split_name, sim_num=sim_num)
         return task
 
     @staticmethod
@@ -94,15 +116,29 @@ class ConvertTheoryPowerSpectrumExecutor(BaseStageExecutor):
         Clean one map outside multiprocessing,
         to avoid painful debugging within multiprocessing.
         """
-        _process(task)
+        _, ps = _process(task)
+        self.collect(task, ps)
 
     def run_all_tasks(self, process, tasks):
         with Pool(processes=self.num_processes) as pool:
             # Create an iterator from imap_unordered and wrap it with tqdm for progress tracking
             task_iterator = tqdm(pool.imap_unordered(process, tasks), total=len(tasks))
             # Iterate through the task_iterator to execute the tasks
-            for _ in task_iterator:
-                pass
+            for task, ps in task_iterator:
+                self.collect(task, ps)
+
+    def collect(self, task: TaskTarget, ps: np.ndarray):
+        # Keep the spectrum if it goes in a stack
+        if task.split_name in self.stack_rows and task.sim_num is not None:
+            self.stack_rows[task.split_name][task.sim_num] = ps
+
+    def write_stacks(self):
+        for split_name, rows in self.stack_rows.items():
+            sims = np.array(sorted(rows.keys()))
+            stack = np.stack([rows[sim] for sim in sims], axis=0)
+            with self.name_tracker.set_context("split", split_name):
+                logger.info(f"Writing {len(sims)} theory spectra for {split_name} to {self.out_theory_ps_stack.path}")
+                self.out_theory_ps_stack.write(data=stack, sims=sims)
 
 
 def parallel_convert(task_target: TaskTarget):
@@ -111,4 +147,7 @@ def parallel_convert(task_target: TaskTarget):
     in_ps = in_asset.handler.read(in_asset.path)
 
     out_asset = tt.asset_out
-    out_ps = out_asset.handler.write(path=out_asset.path, data=in_ps)
+    if out_asset is not None:
+        out_asset.handler.write(path=out_asset.path, data=in_ps)
+    # Returned so that the spectra can be stacked
+    return tt, in_ps
@@ -1,29 +1,34 @@
-from typing import Union
+from typing import List
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-from scipy.stats import pearsonr
-import json
 
 from omegaconf import DictConfig
 
 
 from cmbml.core import (
-    BaseStageExecutor, 
+    BaseStageExecutor,
     Split,
     Asset, AssetWithPathAlts
     )
 from tqdm import tqdm
 
-from cmbml.core.asset_handlers.asset_handlers_base import EmptyHandler, Config # Import for typing hint
-from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum, NumpyPowerSpectrumStack # Import for typing hint
+from cmbml.utils.running_stats import RunningArrayStats
 
 
 logger = logging.getLogger(__name__)
 
 
+# Rows of a consolidated spectra file added to the statistics at a time
+STACK_CHUNK_SIZE = 256
+
+# Percentiles of the theory spectra written, if wmap_percentiles is an output; overridden by the stage's wmap_percentiles
+DEFAULT_PERCENTILES = [2.5, 16, 50, 84, 97.5]
+
+
 class MakeTheoryPSStats(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following string must match the pipeline yaml
@@ -31,33 +36,73 @@ class MakeTheoryPSStats(BaseStageExecutor):
 
         self.out_wmap_ave_ps: Asset = self.assets_out["wmap_ave"]
         self.out_wmap_std_ps: Asset = self.assets_out["wmap_std"]
+        # Optional: percentile bands, (n_percentiles, n_ell), estimated while streaming
+        self.out_wmap_percentiles: Asset = self.assets_out.get("wmap_percentiles", None)
         out_ps_handler: NumpyPowerSpectrum
 
         self.in_ps_theory: AssetWithPathAlts = self.assets_in["theory_ps"]
+        # Optional: all theory spectra of the split in one file, made by convert_theory_ps
+        self.in_ps_theory_stack: Asset = self.assets_in.get("theory_ps_stack", None)
         in_ps_handler: NumpyPowerSpectrum
+        in_ps_stack_handler: NumpyPowerSpectrumStack
 
+        # Number of spectra to use; null for the whole split
         self.n_ps = self.get_stage_element("wmap_n_ps")
+        percentiles = self._config_help.get_stage_elem_silent("wmap_percentiles", self.stage_str)
+        self.percentiles = list(percentiles) if percentiles is not None else DEFAULT_PERCENTILES
+
+        # Threads for reading individual spectra
+        self.num_threads = cfg.model.analysis.px_operations.num_processes
 
     def execute(self) -> None:
-        # Remove this function
         logger.debug(f"Running {self.__class__.__name__} execute()")
-        ave_ps, std_ps = self.estimate_wmap_ps_dist(self.n_ps)
-        self.out_wmap_ave_ps.write(data=ave_ps)
-        self.out_wmap_std_ps.write(data=std_ps)
-
-    def estimate_wmap_ps_dist(self, n_ps):
+        stats = self.estimate_wmap_ps_dist(self.n_ps)
+        self.out_wmap_ave_ps.write(data=stats.mean)
+        self.out_wmap_std_ps.write(data=stats.std())
+        if self.out_wmap_percentiles is not None:
+            bands = np.stack([stats.quantiles[p / 100] for p in self.percentiles], axis=0)
+            self.out_wmap_percentiles.write(data=bands)
+
+    def estimate_wmap_ps_dist(self, n_ps) -> RunningArrayStats:
+        """
+        Mean and standard deviation (and percentiles) of the theory spectra of the
+        first n_ps sims of the Train split, computed as the spectra are read.
+        """
+        if n_ps is None:
+            n_ps = self.get_train_split().n_sims
         ps_idx = np.arange(0, n_ps)
 
-        ps_samples = None
-
-        for i, idx in enumerate(ps_idx):
+        quantiles = [p / 100 for p in self.percentiles] if self.out_wmap_percentiles is not None else []
+        stats = RunningArrayStats(quantiles=quantiles)
+
+        if self.in_ps_theory_stack is not None:
+            self.add_from_stack(stats, ps_idx)
+        else:
+            self.add_from_files(stats, ps_idx)
+        return stats
+
+    def get_train_split(self) -> Split:
+        for split in self.splits:
+            if split.name == "Train":
+                return split
+        raise ValueError("wmap_n_ps is null, so the whole Train split is used; the Train split must be in the stage's splits.")
+
+    def add_from_stack(self, stats: RunningArrayStats, ps_idx: np.ndarray) -> None:
+        with self.name_tracker.set_context("split", "Train"):
+            logger.info(f"Reading theory spectra from {self.in_ps_theory_stack.path}")
+            lookup = self.in_ps_theory_stack.handler.read_lookup(self.in_ps_theory_stack.path)
+        # Rows of the stack for the sims wanted
+        rows = lookup.rows(ps_idx)
+        for start in tqdm(range(0, len(rows), STACK_CHUNK_SIZE)):
+            stats.update_batch(lookup.spectra[rows[start:start + STACK_CHUNK_SIZE]])
+
+    def add_from_files(self, stats: RunningArrayStats, ps_idx: np.ndarray) -> None:
+        paths = []
+        for idx in ps_idx:
             with self.name_tracker.set_contexts({"split": "Train", "sim_num": idx}):
-                ps_theory = self.in_ps_theory.read(use_alt_path=False)
-            if ps_samples is None:
-                ps_samples = np.zeros((n_ps, ps_theory.shape[0]))
-            ps_samples[i] = ps_theory
-
-        mean_ps = np.mean(ps_samples, axis=0)
-        std_ps = np.std(ps_samples, axis=0)
-
-        return mean_ps, std_ps
+                paths.append(self.in_ps_theory.path)
+        handler = self.in_ps_theory.handler
+        # Spectra are read in parallel, in order, and added as they arrive
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for ps_theory in tqdm(executor.map(handler.read, paths), total=len(paths)):
+                stats.update(ps_theory)
@@ -1,10 +1,10 @@
-from typing import List, Dict
+from typing import List, Dict, NamedTuple
+from pathlib import Path
 import logging
 from itertools import product
 
 from hydra.utils import instantiate
 import numpy as np
-from tqdm import tqdm
 import healpy as hp
 
 from omegaconf import DictConfig
@@ -12,22 +12,54 @@ from omegaconf import DictConfig
 from cmbml.core import (
     BaseStageExecutor, 
     Split,
-    Asset
+    Asset,
     )
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
-from cmbml.utils.physics_mask import downgrade_mask
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum # Import for typing hint
+from cmbml.core.asset_handlers.healpy_alm_handler import HealpyAlm # Import to register handler
+from cmbml.utils.physics_mask import get_stage_mask, get_mask_cache_dir
+from cmbml.utils.physics_mode_coupling import get_mode_coupling
+from cmbml.utils.physics_ps import AutoSpectrum, get_autopower_from_alms
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
 
 
+class TaskTarget(NamedTuple):
+    cmb_map_in: FrozenAsset
+    cmb_map_out: FrozenAsset
+    # These two are None unless set in the pipeline yaml
+    cmb_alm_out: FrozenAsset
+    auto_pred_out: FrozenAsset
+
+
+class PostSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    mask: np.ndarray
+    beam: object
+    lmax: int
+    nside_out: int
+    map_fields: str
+    deconvolve: bool
+    mask_alm: np.ndarray
+    mode_coupling: object
+
+
 class CommonPostExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig, stage_str: str) -> None:
         # The following string must match the pipeline yaml
         super().__init__(cfg, stage_str)
 
         self.out_cmb_map_real: Asset = self.assets_out["cmb_map"]
+        # Optional: the prediction's power spectrum, from the same forward transform as the deconvolution
+        #    (as make_pred_ps would make it; see pipeline yaml)
+        self.out_auto_pred: Asset = self.assets_out.get("auto_pred", None)
+        # Optional: alms of the masked, mean-subtracted map (before deconvolution), for make_pred_ps
+        self.out_cmb_alm: Asset = self.assets_out.get("cmb_alm", None)
         out_ps_handler: HealpyMap
+        out_auto_pred_handler: NumpyPowerSpectrum
+        out_cmb_alm_handler: HealpyAlm
 
         self.in_cmb_map: Asset = self.assets_in["cmb_map"]
         self.in_mask: Asset = self.assets_in.get("mask", None)
@@ -39,26 +71,56 @@ class CommonPostExecutor(BaseStageExecutor):
 
         # Prepare to load mask (in execute())
         self.mask_threshold = self.cfg.model.analysis.mask_threshold
+        self.mask_cache_dir = get_mask_cache_dir(cfg)
 
         self.use_pixel_weights = False
 
         # Prepare to load beam and mask in execute()
         self.beam = None
         self.mask = None
+        self.mask_alm = None
+        self.mode_coupling_cfg = cfg.model.analysis.get("mode_coupling", None)
+        self.mode_coupling = None
+
+        # Predictions are convolved with a beam; children may change this
+        self.deconvolve = True
+
+        post_ops = cfg.model.analysis.get("post_map_operations", None)
+        self.num_processes = post_ops.num_processes if post_ops else 1
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
         self.mask = self.get_mask()
         self.beam = self.get_beam()
-        self.default_execute()
+        if self.makes_harmonic_outputs:
+            self.prepare_harmonic_outputs()
+
+        settings = PostSettings(mask=self.mask,
+                                beam=self.beam,
+                                lmax=self.lmax,
+                                nside_out=self.nside_out,
+                                map_fields=self.map_fields,
+                                deconvolve=self.deconvolve,
+                                mask_alm=self.mask_alm,
+                                mode_coupling=self.mode_coupling)
+        tasks = self.build_tasks()
+        logger.info(f"Post-processing {len(tasks)} maps.")
+        run_tasks(parallel_post_process, tasks, settings, self.num_processes)
+
+    @property
+    def makes_harmonic_outputs(self) -> bool:
+        return self.out_auto_pred is not None or self.out_cmb_alm is not None
 
     def get_mask(self):
-        mask = None
-        with self.name_tracker.set_context("src_root", self.cfg.local_system.assets_dir):
-            logger.info(f"Using mask from {self.in_mask.path}")
-            mask = self.in_mask.read(map_fields=self.in_mask.use_fields)[0]
-        mask = downgrade_mask(mask, self.nside_out, threshold=self.mask_threshold)
-        return mask
+        return get_stage_mask(self.cfg, self.in_mask, self.nside_out, self.mask_threshold)
+
+    def prepare_harmonic_outputs(self):
+        self.mask_alm = hp.map2alm(self.mask.astype(np.float64), lmax=self.lmax)
+        if self.mode_coupling_cfg and self.mode_coupling_cfg.use:
+            self.mode_coupling = get_mode_coupling(self.mask,
+                                                   lmax=self.lmax,
+                                                   delta_ell=self.mode_coupling_cfg.delta_ell,
+                                                   cache_dir=self.mask_cache_dir)
 
     def get_beam(self):
         # Partially instantiate the beam object, defined in the hydra configs (cfg.model.analysis)
@@ -66,48 +128,79 @@ class CommonPostExecutor(BaseStageExecutor):
         beam = beam(lmax=self.lmax)
         return beam
 
-    def process_split(self, 
-                      split: Split) -> None:
-        logger.info(f"Running {self.__class__.__name__} process_split() for split: {split.name}.")
-        
+    def build_tasks(self) -> List[TaskTarget]:
         epochs = self.model_epochs if self.model_epochs else [""]
 
-        for epoch in epochs:
-            for sim in tqdm(split.iter_sims()):
-                context_params = dict(epoch=epoch, sim_num=sim)
-                with self.name_tracker.set_contexts(context_params):
-                    self.process_sim()
+        tasks = []
+        for split in self.splits:
+            for epoch in epochs:
+                for sim in split.iter_sims():
+                    context_params = dict(split=split.name, epoch=epoch, sim_num=sim)
+                    with self.name_tracker.set_contexts(context_params):
+                        tasks.append(TaskTarget(cmb_map_in=freeze(self.in_cmb_map),
+                                                cmb_map_out=freeze(self.out_cmb_map_real),
+                                                cmb_alm_out=freeze(self.out_cmb_alm),
+                                                auto_pred_out=freeze(self.out_auto_pred)))
+        return tasks
+
+
+def parallel_post_process(task_target: TaskTarget):
+    tt = task_target
+    st: PostSettings = get_settings()
 
-    def process_sim(self) -> None:
-        # Get power spectrum for realization
-        cmb_map: np.ndarray = self.in_cmb_map.read()
-        if cmb_map.shape[0] == 3 and self.map_fields == "I":
-            cmb_map = cmb_map[0]
+    cmb_map: np.ndarray = tt.cmb_map_in.handler.read(tt.cmb_map_in.path)
+    if cmb_map.shape[0] == 3 and st.map_fields == "I":
+        cmb_map = cmb_map[0]
 
-        # Apply the mask
-        post_map = hp.ma(cmb_map)
-        post_map.mask = np.logical_not(self.mask)
+    # Apply the mask
+    post_map = hp.ma(cmb_map)
+    post_map.mask = np.logical_not(st.mask)
 
-        # Deconvolve the beam
-        post_map = self.deconv(post_map)
-        post_map = hp.ma(post_map)
-        post_map.mask = np.logical_not(self.mask)
+    # Deconvolve the beam
+    if st.deconvolve:
+        post_map = deconv(post_map, tt, st)
+    post_map = hp.ma(post_map)
+    post_map.mask = np.logical_not(st.mask)
 
-        # Remove the dipole and monopole
-        post_map = hp.remove_dipole(post_map)
-        self.out_cmb_map_real.write(data=post_map)
+    # Remove the dipole and monopole
+    post_map = hp.remove_dipole(post_map)
+    tt.cmb_map_out.handler.write(tt.cmb_map_out.path, data=post_map)
 
-    def deconv(self, data) -> np.ndarray:
-        # Convert to spherical harmonic space (a_lm)
-        alm_in = hp.map2alm(data, lmax=self.lmax)
-        
-        # Deconvolve the beam
-        alm_deconv = hp.almxfl(alm_in, 1 / self.beam.beam[:self.lmax])
 
-        # Convert back to map space
-        map_deconv = hp.alm2map(alm_deconv, nside=self.nside_out)
+def deconv(data, tt: TaskTarget, st: PostSettings) -> np.ndarray:
+    # Convert to spherical harmonic space (a_lm)
+    alm_in = hp.map2alm(data, lmax=st.lmax)
 
-        return map_deconv
+    # The power spectrum (or alms for it) reuses the forward transform
+    if tt.cmb_alm_out is not None or tt.auto_pred_out is not None:
+        write_harmonic_outputs(data, alm_in, tt, st)
+
+    # Deconvolve the beam
+    alm_deconv = hp.almxfl(alm_in, 1 / st.beam.beam[:st.lmax])
+
+    # Convert back to map space
+    map_deconv = hp.alm2map(alm_deconv, nside=st.nside_out)
+
+    return map_deconv
+
+
+def write_harmonic_outputs(masked_map, masked_alm, tt: TaskTarget, st: PostSettings) -> None:
+    """
+    Writes the alms of mask * (map - mean) and/or the power spectrum 
+    MakePredPowerSpectrumExecutor.make_pred_ps would make from them.
+    """
+    # Mean subtraction by linearity: alm(mask * (map - mean)) = alm(mask * map) - mean * alm(mask)
+    map_mean = np.mean(masked_map.compressed())
+    ps_alm = masked_alm - map_mean * st.mask_alm
+
+    if tt.cmb_alm_out is not None:
+        alm_dtype = np.complex64 if masked_map.dtype == np.float32 else np.complex128
+        tt.cmb_alm_out.handler.write(tt.cmb_alm_out.path, data=ps_alm.astype(alm_dtype))
+
+    if tt.auto_pred_out is not None:
+        cl = get_autopower_from_alms(ps_alm, mask=st.mask, mode_coupling=st.mode_coupling)
+        auto_pred_ps = AutoSpectrum(None, cl, np.arange(st.lmax + 1), st.beam, is_convolved=True)
+        tt.auto_pred_out.handler.write(tt.auto_pred_out.path, data=auto_pred_ps.deconv_dl)
 
 
 class CommonRealPostExecutor(CommonPostExecutor):
@@ -116,12 +209,8 @@ class CommonRealPostExecutor(CommonPostExecutor):
         self.out_cmb_map: Asset = self.assets_out["cmb_map"]
         self.in_cmb_map: Asset = self.assets_in["cmb_map"]
         self.beam_cfg = cfg.model.analysis.beam_real
-
-    def deconv(self, data):
-        """
-        No-op because the realization map was never convolved
-        """
-        return data
+        # The realization map was never convolved
+        self.deconvolve = False
 
 
 class CommonCMBNNCSPredPostExecutor(CommonPostExecutor):
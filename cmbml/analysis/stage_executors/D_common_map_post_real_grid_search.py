@@ -1,10 +1,10 @@
-from typing import List, Dict
+from typing import List, Dict, NamedTuple
+from pathlib import Path
 import logging
 from itertools import product
 
 from hydra.utils import instantiate
 import numpy as np
-from tqdm import tqdm
 import healpy as hp
 
 from omegaconf import DictConfig
@@ -12,15 +12,37 @@ from omegaconf import DictConfig
 from cmbml.core import (
     BaseStageExecutor, 
     Split,
-    Asset
+    Asset,
     )
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
-from cmbml.utils.physics_mask import downgrade_mask
+from cmbml.utils.physics_mask import get_stage_mask
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
 
 
+# The grid: each map is written with every combination of these
+MASKINGS = ["hpma", "yxma", "noma"]
+DECONVS = [True, False]
+REMOVE_DIPOLES = [True, False]
+
+
+class TaskTarget(NamedTuple):
+    cmb_map_in: FrozenAsset
+    cmb_maps_out: Dict[tuple, FrozenAsset]  # By (masking, deconv, remove_dipole)
+
+
+class GridSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    mask: np.ndarray
+    beam: object
+    lmax: int
+    nside_out: int
+    map_fields: str
+    deconvolve: bool
+
+
 class CommonPostExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig, stage_str: str) -> None:
         # The following string must match the pipeline yaml
@@ -46,19 +68,32 @@ class CommonPostExecutor(BaseStageExecutor):
         self.beam = None
         self.mask = None
 
+        # Predictions are convolved with a beam; children may change this
+        self.deconvolve = True
+
+        post_ops = cfg.model.analysis.get("post_map_operations", None)
+        self.num_processes = post_ops.num_processes if post_ops else 1
+
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
         self.mask = self.get_masks()
         self.beam = self.get_beam()
-        self.default_execute()
+
+        settings = GridSettings(mask=self.mask,
+                                beam=self.beam,
+                                lmax=self.lmax,
+                                nside_out=self.nside_out,
+                                map_fields=self.map_fields,
+                                deconvolve=self.deconvolve)
+        tasks = []
+        for split in self.splits:
+            with self.name_tracker.set_context("split", split.name):
+                tasks.extend(self.build_tasks(split))
+        logger.info(f"Post-processing {len(tasks)} maps over the grid.")
+        run_tasks(parallel_grid_search, tasks, settings, self.num_processes)
 
     def get_masks(self):
-        mask = None
-        with self.name_tracker.set_context("src_root", self.cfg.local_system.assets_dir):
-            logger.info(f"Using mask from {self.in_mask.path}")
-            mask = self.in_mask.read(map_fields=self.in_mask.use_fields)[0]
-        mask = downgrade_mask(mask, self.nside_out, threshold=self.mask_threshold)
-        return mask
+        return get_stage_mask(self.cfg, self.in_mask, self.nside_out, self.mask_threshold)
 
     def get_beam(self):
         # Partially instantiate the beam object, defined in the hydra configs (cfg.model.analysis)
@@ -66,62 +101,85 @@ class CommonPostExecutor(BaseStageExecutor):
         beam = beam(lmax=self.lmax)
         return beam
 
-    def process_split(self, 
-                      split: Split) -> None:
-        logger.info(f"Running {self.__class__.__name__} process_split() for split: {split.name}.")
-        
+    def build_tasks(self, 
+                    split: Split) -> List[TaskTarget]:
         epochs = self.model_epochs if self.model_epochs else [""]
 
+        tasks = []
         for epoch in epochs:
-            for sim in tqdm(split.iter_sims()):
+            for sim in split.iter_sims():
                 context_params = dict(epoch=epoch, sim_num=sim)
                 with self.name_tracker.set_contexts(context_params):
-                    self.process_sim()
-
-    def process_sim(self) -> None:
-        # Get power spectrum for realization
-        cmb_map: np.ndarray = self.in_cmb_map.read()
-        if cmb_map.shape[0] == 3 and self.map_fields == "I":
-            cmb_map = cmb_map[0]
-
-        masking = ["hpma", "yxma", "noma"]
-        deconv = [True, False]
-        remove_dipole = [True, False]
-
-        combos = list(product(masking, deconv, remove_dipole))
-        for combo in combos:
-            self.process_combo(cmb_map, *combo)
-
+                    tasks.append(TaskTarget(cmb_map_in=freeze(self.in_cmb_map),
+                                            cmb_maps_out=self.freeze_grid_outputs()))
+        return tasks
+
+    def freeze_grid_outputs(self) -> Dict[tuple, FrozenAsset]:
+        cmb_maps_out = {}
+        for masking, deconv, remove_dipole in product(MASKINGS, DECONVS, REMOVE_DIPOLES):
+            context_params = dict(
+                mask=masking,
+                deconv="ydec" if deconv else "ndec",
+                remove_dipole="yrd" if remove_dipole else "nrd"
+            )
+            with self.name_tracker.set_contexts(context_params):
+                cmb_maps_out[(masking, deconv, remove_dipole)] = freeze(self.out_cmb_map_real)
+        return cmb_maps_out
+
+
+
+def parallel_grid_search(task_target: TaskTarget):
+    """
+    Writes the map for every point of the grid.
+
+    The transforms are shared across the grid: the mask is binary, so the alms of the
+    hp.ma-masked map (hpma) and of map * mask (yxma) are the same, and each deconvolved
+    map is made once whether or not the dipole is then removed. The masked and unmasked
+    maps are transformed together.
+    """
+    tt = task_target
+    st: GridSettings = get_settings()
+
+    cmb_map: np.ndarray = tt.cmb_map_in.handler.read(tt.cmb_map_in.path)
+    if cmb_map.shape[0] == 3 and st.map_fields == "I":
+        cmb_map = cmb_map[0]
+
+    masked_maps = get_masked_maps(cmb_map, st)
+    deconv_maps = get_deconv_maps(masked_maps, st)
+
+    dipole_removed = {}
+    for (masking, deconv, remove_dipole), out_asset in tt.cmb_maps_out.items():
+        post_map = deconv_maps[masking] if deconv else masked_maps[masking]
+        if remove_dipole:
+            # Deconvolved maps may be shared between maskings; so are their dipole-removed versions
+            key = id(post_map)
+            if key not in dipole_removed:
+                dipole_removed[key] = hp.remove_dipole(post_map)
+            post_map = dipole_removed[key]
+        out_asset.handler.write(out_asset.path, data=post_map)
 
-    def process_combo(self, cmb_map, masking, deconv, remove_dipole):
-        if masking == "hpma":
-            post_map = hp.ma(cmb_map)
-            # healpy wants True for pixels to be masked; convention is False
-            post_map.mask = np.logical_not(self.mask)
-        elif masking == "yxma":
-            post_map = cmb_map * self.mask
-        else:
-            post_map = cmb_map
 
-        if deconv:
-            post_map = self.deconv(post_map)
+def get_masked_maps(cmb_map, st: GridSettings) -> Dict[str, np.ndarray]:
+    hpma_map = hp.ma(cmb_map)
+    # healpy wants True for pixels to be masked; convention is False
+    hpma_map.mask = np.logical_not(st.mask)
+    return {"hpma": hpma_map, "yxma": cmb_map * st.mask, "noma": cmb_map}
 
-        if remove_dipole:
-            post_map = hp.remove_dipole(post_map)
 
-        context_params = dict(
-            mask=masking,
-            deconv="ydec" if deconv else "ndec",
-            remove_dipole="yrd" if remove_dipole else "nrd"
-        )
-        with self.name_tracker.set_contexts(context_params):
-            self.out_cmb_map_real.write(data=post_map)
+def get_deconv_maps(masked_maps, st: GridSettings) -> Dict[str, np.ndarray]:
+    if not st.deconvolve:
+        # The realization map was never convolved
+        return masked_maps
 
-    def deconv(self, data) -> np.ndarray:
-        alm_in = hp.map2alm(data, lmax=self.lmax)
-        alm_deconv = hp.almxfl(alm_in, 1 / self.beam.beam[:self.lmax])
-        map_deconv = hp.alm2map(alm_deconv, nside=self.nside_out)
-        return map_deconv
+    # Masked (for both hpma and yxma) and unmasked maps, transformed together
+    #   A single field may be read as (1, npix); healpy treats it as one map
+    stacked = np.stack([np.asarray(masked_maps["yxma"], dtype=np.float64).reshape(-1),
+                        np.asarray(masked_maps["noma"], dtype=np.float64).reshape(-1)])
+    alms = hp.map2alm(stacked, lmax=st.lmax, pol=False)
+    fl = 1 / st.beam.beam[:st.lmax]
+    alms_deconv = np.stack([hp.almxfl(alm, fl) for alm in alms])
+    masked_deconv, unmasked_deconv = hp.alm2map(alms_deconv, nside=st.nside_out, pol=False)
+    return {"hpma": masked_deconv, "yxma": masked_deconv, "noma": unmasked_deconv}
 
 
 class CommonRealPostExecutor(CommonPostExecutor):
@@ -130,12 +188,8 @@ class CommonRealPostExecutor(CommonPostExecutor):
         self.out_cmb_map: Asset = self.assets_out["cmb_map"]
         self.in_cmb_map: Asset = self.assets_in["cmb_map"]
         self.beam_cfg = cfg.model.analysis.beam_real
-
-    def deconv(self, data):
-        """
-        No-op because the realization map was never convolved
-        """
-        return data
+        # The realization map was never convolved
+        self.deconvolve = False
 
 
 class CommonCMBNNCSPredPostExecutor(CommonPostExecutor):
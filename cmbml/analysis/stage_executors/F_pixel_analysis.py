@@ -3,7 +3,7 @@ import logging
 from pathlib import Path
 
 from functools import partial
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 
 from tqdm import tqdm
 
@@ -17,9 +17,11 @@ from cmbml.core import (
     Asset,
     GenericHandler
     )
-from cmbml.analysis.px_statistics import get_func
-from cmbml.core.asset_handlers.asset_handlers_base import Config # Import for typing hint
+from cmbml.analysis.px_statistics import get_func, FULL_MAP_FUNCS
+from cmbml.core.asset_handlers.pd_table_handler import PandasTableHandler, make_table # Import to register handler
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
+from cmbml.core.asset_handlers.pd_csv_handler import PandasCsvHandler # Import for typing hint
+from cmbml.utils.running_stats import GroupedStats
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +32,12 @@ class FrozenAsset(NamedTuple):
 
 
 class TaskTarget(NamedTuple):
+    # One simulation: the true map and the prediction at each epoch
     true_asset: FrozenAsset
-    pred_asset: FrozenAsset
+    pred_assets: List[FrozenAsset]
     split_name: str
     sim_num: str
-    epoch: int
+    epochs: List[int]
 
 
 
@@ -44,7 +47,11 @@ class PixelAnalysisExecutor(BaseStageExecutor):
         super().__init__(cfg, stage_str="pixel_analysis")
 
         self.out_report: Asset = self.assets_out["report"]
-        out_report_handler: Config
+        out_report_handler: PandasTableHandler
+        # Optional: summary tables, as pixel_summary_tables makes them, kept up to date during the run
+        self.out_overall_stats: Asset = self.assets_out.get("overall_stats", None)
+        self.out_stats_per_split: Asset = self.assets_out.get("stats_per_split", None)
+        out_stats_handler: PandasCsvHandler
 
         self.in_cmb_map_true: Asset = self.assets_in["cmb_map_sim"]
         self.in_cmb_map_pred: Asset = self.assets_in["cmb_map_post"]
@@ -52,8 +59,22 @@ class PixelAnalysisExecutor(BaseStageExecutor):
 
         self.stat_func_dict = self.cfg.model.analysis.px_functions
         self.stat_funcs = self.get_stat_funcs()
+        # Stats (e.g. SSIM) that are given full maps, with UNSEEN pixels, instead of the seen pixels alone
+        self.full_map_stats = [name for name, details in self.stat_func_dict.items()
+                               if details["func"] in FULL_MAP_FUNCS]
+        # Columns of the report, fixed up front so that every batch of rows has all of them
+        self.report_columns = {'split': None, 'sim': None, 'epoch': None,
+                               **{name: 'float64' for name in self.stat_funcs}, 
+                               'error': 'string'}
 
         self.num_processes = cfg.model.analysis.px_operations.num_processes
+        # Summary tables are rewritten after this many sims (and at the end); 0 for only at the end
+        self.summary_interval = cfg.model.analysis.px_operations.get("summary_interval", 0)
+
+        # Summary statistics, updated as results arrive; by epoch and by (epoch, split)
+        quantiles = cfg.model.analysis.get("summary_quantiles", None) or []
+        self.stats = GroupedStats(self.stat_funcs.keys(), quantiles=quantiles)
+        self.split_names = []
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
@@ -61,7 +82,7 @@ class PixelAnalysisExecutor(BaseStageExecutor):
         # Create a method; 
         #   process_target needs a list of statistics functions, from the config file
         #   partial() makes a `process` that takes a single argument
-        process = partial(process_target, stat_funcs=self.stat_funcs)
+        process = partial(process_target, stat_funcs=self.stat_funcs, full_map_stats=self.full_map_stats)
         # Tasks are items on a to-do list
         #   For each simulation, we compare the prediction and target
         #   A task contains labels, file names, and handlers for each sim
@@ -74,21 +95,53 @@ class PixelAnalysisExecutor(BaseStageExecutor):
 
     def run_all_tasks(self, process, tasks):
         # Use multiprocessing to search through sims in parallel
-        # A manager allows collection of information across separate threads
-        with Manager() as manager:
-            results = manager.list()
-            # The Pool sets up the individual processes. 
-            # Set processes according to the capacity of your computer
-            with Pool(processes=self.num_processes) as pool:
-                # Each result is the output of "process" running on each of the tasks
-                for result in tqdm(pool.imap_unordered(process, tasks), total=len(tasks)):
-                    results.append(result)
-            # Convert the results to a regular list after multiprocessing is complete
-            #     and before the scope of the manager ends
-            results_list = list(results)
-        self.review_report(results_list)
-        # Use the out_report asset to write all results to disk
-        self.out_report.write(data=results_list)
+        # Results are written and summarized as they arrive, so they are not all kept in memory
+        errors = []
+        n_written = 0
+        # The Pool sets up the individual processes. 
+        # Set processes according to the capacity of your computer
+        with Pool(processes=self.num_processes) as pool:
+            # Each result is the output of "process" running on each of the tasks
+            #   A task covers all epochs of a sim, so it returns a list of results
+            task_iterator = tqdm(pool.imap_unordered(process, tasks), total=len(tasks))
+            for i, task_results in enumerate(task_iterator):
+                # Use the out_report asset to write the results to disk
+                self.out_report.write(data=make_table(task_results, self.report_columns), append=n_written > 0)
+                n_written += len(task_results)
+                for res in task_results:
+                    if 'error' in res.keys():
+                        errors.append(res)
+                    else:
+                        self.update_stats(res)
+                if self.summary_interval and (i + 1) % self.summary_interval == 0:
+                    self.write_summaries()
+        # The report's handler may keep the file open between appends (PandasTable does)
+        close = getattr(self.out_report.handler, "close", None)
+        if close is not None:
+            close(self.out_report.path)
+        self.write_summaries()
+        self.review_report(errors)
+
+    def update_stats(self, res):
+        self.stats.update(res['epoch'], res)
+        self.stats.update((res['epoch'], res['split']), res)
+        if res['split'] not in self.split_names:
+            self.split_names.append(res['split'])
+
+    def write_summaries(self):
+        if self.out_overall_stats is None and self.out_stats_per_split is None:
+            return
+        split_names = sort_split_names(self.split_names)
+        for epoch in self.model_epochs:
+            with self.name_tracker.set_context('epoch', epoch):
+                if self.out_overall_stats is not None:
+                    overall_stats = self.stats.summary(epoch)
+                    self.out_overall_stats.write(data=overall_stats, index=True)
+                if self.out_stats_per_split is not None:
+                    stats_per_split = self.stats.summary_by([(epoch, split) for split in split_names],
+                                                            labels=split_names,
+                                                            name='split')
+                    self.out_stats_per_split.write(data=stats_per_split, index=True)
 
     def review_report(self, report_list):
         found_error = False
@@ -100,33 +153,36 @@ class PixelAnalysisExecutor(BaseStageExecutor):
             raise OSError("Errors were found in the report. Please review the log for details.")
 
     def build_tasks(self):
+        # One task per sim, so that the true map is read once for all epochs
         tasks = []
         for split in self.splits:
             for sim in split.iter_sims():
-                for epoch in self.model_epochs:
-                    context = dict(split=split.name, sim_num=sim, epoch=epoch)
-                    with self.name_tracker.set_contexts(contexts_dict=context):
-                        true = self.in_cmb_map_true
-                        true = FrozenAsset(path=true.path, handler=true.handler)
-                        
-                        pred = self.in_cmb_map_pred
-                        pred = FrozenAsset(path=pred.path, handler=pred.handler)
-                        
-                        tasks.append(TaskTarget(true_asset=true,
-                                                pred_asset=pred,
-                                                split_name=split.name, 
-                                                sim_num=sim,
-                                                epoch=epoch))
+                context = dict(split=split.name, sim_num=sim)
+                with self.name_tracker.set_contexts(contexts_dict=context):
+                    true = self.in_cmb_map_true
+                    true = FrozenAsset(path=true.path, handler=true.handler)
+
+                    preds = []
+                    for epoch in self.model_epochs:
+                        with self.name_tracker.set_context("epoch", epoch):
+                            pred = self.in_cmb_map_pred
+                            preds.append(FrozenAsset(path=pred.path, handler=pred.handler))
+
+                    tasks.append(TaskTarget(true_asset=true,
+                                            pred_assets=preds,
+                                            split_name=split.name, 
+                                            sim_num=sim,
+                                            epochs=list(self.model_epochs)))
         return tasks
 
     def try_a_task(self, process, task: TaskTarget):
         """
-        Get statistics for one sim (task) outside multiprocessing first, 
+        Get statistics for one sim (task), at all epochs, outside multiprocessing first, 
         to avoid painful debugging within multiprocessing.
         """
-        res = process(task)
-        if 'error' in res.keys():
-            raise Exception(res['error'])
+        for res in process(task):
+            if 'error' in res.keys():
+                raise Exception(res['error'])
 
     def get_stat_funcs(self):
         stat_funcs = {}
@@ -138,49 +194,84 @@ class PixelAnalysisExecutor(BaseStageExecutor):
         return stat_funcs
 
 
-def process_target(task_target: TaskTarget, stat_funcs):
+def sort_split_names(split_names: List[str]) -> List[str]:
+    try:
+        # The default order of splits is lexicographic; putting Test10 between Test1 and Test2
+        return sorted(split_names, key=lambda x: int(x.replace('Test', '')))
+    except ValueError:
+        return sorted(split_names)
+
+
+def process_target(task_target: TaskTarget, stat_funcs, full_map_stats=()) -> List[Dict]:
     """
     Each stat_func should accept true, pred, and **kwargs to catch other things
+
+    The true map is read and masked once, then compared to the prediction at each epoch.
+    Returns one result per epoch.
     """
-    res = {'split': task_target.split_name, 'sim': task_target.sim_num, 'epoch':task_target.epoch}
+    res_base = {'split': task_target.split_name, 'sim': task_target.sim_num}
     true = task_target.true_asset
-    pred = task_target.pred_asset
     try:
         true_data = true.handler.read(true.path)
     except OSError as e:
-        return {'error': f"Could not read true data from {true.path}. Error: {str(e)}", **res}
+        error = f"Could not read true data from {true.path}. Error: {str(e)}"
+        return [{'error': error, **res_base, 'epoch': epoch} for epoch in task_target.epochs]
+
+    # Masked true data, for each number of fields compared (usually just one)
+    masked_truths = {}
+
+    results = []
+    for epoch, pred in zip(task_target.epochs, task_target.pred_assets):
+        res = {**res_base, 'epoch': epoch}
+        results.append(process_epoch(res, true_data, pred, masked_truths, stat_funcs, full_map_stats))
+    return results
+
+
+def process_epoch(res: Dict, 
+                  true_data: np.ndarray, 
+                  pred: FrozenAsset, 
+                  masked_truths: Dict, 
+                  stat_funcs, 
+                  full_map_stats=()) -> Dict:
     try:
         pred_data = pred.handler.read(pred.path)
     except OSError as e:
         return {'error': f"Could not read pred data from {pred.path}. Error: {str(e)}", **res}
 
     # Ensure that the shapes match
+    n_fields = None
     if pred_data.shape != true_data.shape:
         # The CMB maps may contain QU fields.
         # Check if the data shapes at axis[1] match and [0] has a smaller pred than true
         if pred_data.shape[1] == true_data.shape[1] and pred_data.shape[0] < true_data.shape[0]:
             # If so, use just the portion of true data needed.
-            true_data = true_data[:pred_data.shape[0]]
+            n_fields = pred_data.shape[0]
         else:
             res['error'] = f"The true data has shape {true_data.shape} and the predicted data has shape {pred_data.shape}. This mismatch will cause errors."
+            return res
 
-    true_data = true_data.flatten()
-    pred_data = pred_data.flatten()
-
-    mask = true_data == hp.UNSEEN
+    if n_fields not in masked_truths:
+        masked_truths[n_fields] = mask_true_data(true_data[:n_fields])
+    mask, true_compressed = masked_truths[n_fields]
 
-    true_data = hp.ma(true_data)
-    true_data.mask = mask
-    true_data = true_data.compressed()
-
-    pred_data = hp.ma(pred_data)
-    pred_data.mask = mask
-    pred_data = pred_data.compressed()
+    pred_compressed = pred_data.flatten()[~mask]
 
     try:
         for stat_name, func in stat_funcs.items():
-            res[stat_name] = func(true_data, pred_data)
+            if stat_name in full_map_stats:
+                res[stat_name] = func(true_data[:n_fields], pred_data)
+            else:
+                res[stat_name] = func(true_compressed, pred_compressed)
     except Exception as e:
         res['error'] = f"Running '{stat_name}' caused '{str(e)}'. This stat function is defined in stat_funcs.yaml."
 
     return res
+
+
+def mask_true_data(true_data: np.ndarray):
+    """
+    Returns the mask of UNSEEN pixels and the true data without them, both flattened.
+    """
+    true_data = true_data.flatten()
+    mask = true_data == hp.UNSEEN
+    return mask, true_data[~mask]
@@ -1,9 +1,9 @@
-from typing import List, Dict
+from typing import List, Dict, NamedTuple
+from pathlib import Path
 import logging
 
 from hydra.utils import instantiate
 import numpy as np
-from tqdm import tqdm
 import healpy as hp
 
 from omegaconf import DictConfig
@@ -11,19 +11,55 @@ from omegaconf import DictConfig
 from cmbml.core import (
     BaseStageExecutor, 
     Split,
-    Asset
+    Asset,
     )
 # from src.analysis.make_ps import get_power as _get_power
 from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
-from cmbml.utils.physics_ps import get_auto_ps_result, get_x_ps_result, PowerSpectrum
+from cmbml.core.asset_handlers.healpy_alm_handler import HealpyAlm # Import to register handler
+from cmbml.utils.physics_ps import (
+    get_auto_ps_result, 
+    get_autopower_from_alms, 
+    get_x_ps_result, 
+    get_masked_alms_batch,
+    get_auto_ps_results_from_alms_batch,
+    get_x_ps_results_from_alms_batch,
+    AutoSpectrum, 
+    PowerSpectrum
+    )
 from cmbml.utils.physics_beam import NoBeam, GaussianBeam
-from cmbml.utils.physics_mask import downgrade_mask
+from cmbml.utils.physics_mask import get_stage_mask, get_mask_cache_dir
+from cmbml.utils.physics_mode_coupling import get_mode_coupling
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
 
 
+class TaskTarget(NamedTuple):
+    # One simulation: the realization and the prediction at each epoch
+    real_map_in: FrozenAsset
+    real_alm_in: FrozenAsset         # None unless set in the pipeline yaml
+    auto_real_out: FrozenAsset
+    pred_maps_in: List[FrozenAsset]
+    pred_alms_in: List[FrozenAsset]  # None unless set in the pipeline yaml
+    auto_preds_out: List[FrozenAsset]
+    x_preds_out: List[FrozenAsset]   # None unless x_real_pred is set in the pipeline yaml
+    auto_real_masked_out: FrozenAsset  # None unless x_real_pred is set in the pipeline yaml
+
+
+class PSSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    mask: np.ndarray
+    beam_real: object
+    beam_pred: object
+    lmax: int
+    map_fields: str
+    sht_backend: str
+    sht_threads: int
+    mode_coupling: object
+
+
 class MakePredPowerSpectrumExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig, beam_type:str) -> None:
         # The following string must match the pipeline yaml
@@ -31,13 +67,26 @@ class MakePredPowerSpectrumExecutor(BaseStageExecutor):
 
         self.out_auto_real: Asset = self.assets_out.get("auto_real", None)
         self.out_auto_pred: Asset = self.assets_out.get("auto_pred", None)
-        # self.out_x_real_pred: Asset = self.assets_out.get("x_real_pred", None)
+        # Optional: cross spectra of the prediction and realization, from the same alms as the auto spectra
+        self.out_x_real_pred: Asset = self.assets_out.get("x_real_pred", None)
+        # With the cross spectra: the realization's spectrum over the same (masked) sky, to compare them to
+        self.out_auto_real_masked: Asset = self.assets_out.get("auto_real_masked", None)
         out_ps_handler: NumpyPowerSpectrum
+        if self.out_x_real_pred is not None and self.out_auto_real_masked is None:
+            raise ValueError("make_pred_ps has x_real_pred, but no auto_real_masked output.")
+        if self.out_x_real_pred is not None and self.out_auto_pred is None:
+            raise ValueError("make_pred_ps has x_real_pred, but no auto_pred output. Cross spectra are made "
+                             "with the prediction spectra; remove x_real_pred and auto_real_masked "
+                             "here and from the inputs of ps_analysis.")
 
         self.in_cmb_map_real: Asset = self.assets_in["cmb_map_real"]
         self.in_cmb_map_pred: Asset = self.assets_in["cmb_map_post"]
         self.in_mask: Asset = self.assets_in.get("mask", None)
+        # Optional: alms stored by make_sims and common_post_map_pred; if given, maps are not transformed here
+        self.in_cmb_alm_real: Asset = self.assets_in.get("cmb_alm_real", None)
+        self.in_cmb_alm_pred: Asset = self.assets_in.get("cmb_alm_post", None)
         in_cmb_map_handler: HealpyMap
+        in_cmb_alm_handler: HealpyAlm
 
         # Basic parameters
         self.nside_out = self.cfg.scenario.nside
@@ -45,8 +94,10 @@ class MakePredPowerSpectrumExecutor(BaseStageExecutor):
 
         # Prepare to load mask (in execute())
         self.mask_threshold = self.cfg.model.analysis.mask_threshold
-        self.mask_2048 = None
+        self.mask_cache_dir = get_mask_cache_dir(cfg)
         self.mask_512 = None
+        self.mode_coupling_cfg = cfg.model.analysis.get("mode_coupling", None)
+        self.mode_coupling = None
 
         # Prepare to load beam (in execute())
         # beam_type is either "beam_pyilc" or "beam_other"
@@ -55,21 +106,40 @@ class MakePredPowerSpectrumExecutor(BaseStageExecutor):
 
         self.use_pixel_weights = False
 
+        ps_sht = cfg.model.analysis.get("ps_sht", None)
+        self.sht_backend = ps_sht.backend if ps_sht else "healpy"
+        self.sht_threads = ps_sht.n_threads if ps_sht else 1
+
+        ps_ops = cfg.model.analysis.get("pred_ps_operations", None)
+        self.num_processes = ps_ops.num_processes if ps_ops else 1
+
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
         self.mask = self.get_masks()
         # self.beam_real = GaussianBeam(beam_fwhm=5, lmax=self.lmax)
         self.beam_real = NoBeam(self.lmax)
         self.beam_pred = self.get_pred_beam()
-        self.default_execute()
+
+        settings = PSSettings(mask=self.mask_512,
+                              beam_real=self.beam_real,
+                              beam_pred=self.beam_pred,
+                              lmax=self.lmax,
+                              map_fields=self.map_fields,
+                              sht_backend=self.sht_backend,
+                              sht_threads=self.sht_threads,
+                              mode_coupling=self.mode_coupling)
+        tasks = self.build_tasks()
+        logger.info(f"Making power spectra for {len(tasks)} sims.")
+        run_tasks(parallel_make_ps, tasks, settings, self.num_processes)
 
     def get_masks(self):
-        mask = None
-        with self.name_tracker.set_context("src_root", self.cfg.local_system.assets_dir):
-            logger.info(f"Using mask from {self.in_mask.path}")
-            mask = self.in_mask.read(map_fields=self.in_mask.use_fields)[0]
-        self.mask_2048 = mask
-        self.mask_512 = downgrade_mask(mask, self.nside_out, threshold=self.mask_threshold)
+        mask = get_stage_mask(self.cfg, self.in_mask, self.nside_out, self.mask_threshold)
+        self.mask_512 = mask
+        if self.mode_coupling_cfg and self.mode_coupling_cfg.use:
+            self.mode_coupling = get_mode_coupling(mask,
+                                                   lmax=self.lmax,
+                                                   delta_ell=self.mode_coupling_cfg.delta_ell,
+                                                   cache_dir=self.mask_cache_dir)
         return
 
     def get_pred_beam(self):
@@ -79,49 +149,150 @@ class MakePredPowerSpectrumExecutor(BaseStageExecutor):
         beam = beam(lmax=self.lmax)
         return beam
 
-    def process_split(self, 
-                      split: Split) -> None:
-        logger.info(f"Running {self.__class__.__name__} process_split() for split: {split.name}.")
-        for sim in tqdm(split.iter_sims()):
-            with self.name_tracker.set_context("sim_num", sim):
-                self.process_sim()
-
-    def process_sim(self) -> None:
-        # Get power spectrum for realization
-        real_map: np.ndarray = self.in_cmb_map_real.read()
-        if real_map.shape[0] == 3 and self.map_fields == "I":
-            real_map = real_map[0]
-        self.make_real_ps(real_map)
-
-        # Get power spectra for predictions
-        for epoch in self.model_epochs:
-            with self.name_tracker.set_context("epoch", epoch):
-                # We may want to generate cross power spectra as well
-                # TODO: Make flag for this in config file instead of hardcoding
-                self.make_pred_ps(real_map)
-
-    def make_real_ps(self, real_map):
-        auto_real_ps = get_auto_ps_result(real_map,
-                                          mask=None,
-                                          lmax=self.lmax,
-                                          beam=self.beam_real,
-                                          is_convolved=False)
-        ps1 = auto_real_ps._ps
-        ps = auto_real_ps.deconv_dl
-        # print(max(ps-ps1))
-        self.out_auto_real.write(data=ps)
-
-    def make_pred_ps(self, real_map) -> None:
-        pred_map = self.in_cmb_map_pred.read()
-        auto_pred_ps = get_auto_ps_result(pred_map,
-                                          mask=self.mask_512,
-                                          lmax=self.lmax,
-                                          beam=self.beam_pred,
-                                          is_convolved=True)
-        ps1 = auto_pred_ps._ps
+    def build_tasks(self) -> List[TaskTarget]:
+        # Prediction spectra are skipped if auto_pred is made by common_post_map_pred (see pipeline yaml)
+        make_pred = self.out_auto_pred is not None
+        # Stored alms are used instead of maps if given (see pipeline yaml)
+        use_pred_alms = self.in_cmb_alm_pred is not None
+        make_cross = self.out_x_real_pred is not None
+
+        tasks = []
+        for split in self.splits:
+            for sim in split.iter_sims():
+                with self.name_tracker.set_contexts(dict(split=split.name, sim_num=sim)):
+                    pred_maps_in, pred_alms_in, auto_preds_out, x_preds_out = [], [], [], []
+                    for epoch in self.model_epochs if make_pred else []:
+                        with self.name_tracker.set_context("epoch", epoch):
+                            pred_maps_in.append(freeze(self.in_cmb_map_pred))
+                            pred_alms_in.append(freeze(self.in_cmb_alm_pred))
+                            auto_preds_out.append(freeze(self.out_auto_pred))
+                            x_preds_out.append(freeze(self.out_x_real_pred))
+                    tasks.append(TaskTarget(real_map_in=freeze(self.in_cmb_map_real),
+                                            real_alm_in=freeze(self.in_cmb_alm_real),
+                                            auto_real_out=freeze(self.out_auto_real),
+                                            pred_maps_in=pred_maps_in,
+                                            pred_alms_in=pred_alms_in if use_pred_alms else None,
+                                            auto_preds_out=auto_preds_out,
+                                            x_preds_out=x_preds_out if make_cross else None,
+                                            auto_real_masked_out=freeze(self.out_auto_real_masked) if make_cross else None))
+        return tasks
+
+
+def parallel_make_ps(task_target: TaskTarget):
+    tt = task_target
+    st: PSSettings = get_settings()
+
+    # Get power spectrum for realization
+    real_map = None
+    if tt.real_alm_in is not None:
+        make_real_ps_from_alms(tt, st)
+    else:
+        real_map = read_real_map(tt, st)
+        make_real_ps(real_map, tt, st)
+
+    # Get power spectra for predictions; all epochs at once
+    if len(tt.auto_preds_out) == 0:
+        return
+    # Cross spectra reuse the alms of the predictions; the realization is 
+    #   transformed (masked, as the predictions) once for all epochs
+    real_x_alms = None
+    if tt.x_preds_out is not None:
+        if real_map is None:
+            real_map = read_real_map(tt, st)
+        real_x_alms = get_masked_alms_batch(np.atleast_2d(real_map)[0],
+                                            mask=st.mask,
+                                            lmax=st.lmax,
+                                            n_threads=st.sht_threads,
+                                            backend=st.sht_backend)
+        make_real_masked_ps(real_x_alms, tt, st)
+    if tt.pred_alms_in is not None:
+        make_pred_ps_from_alms(tt, st, real_x_alms)
+    else:
+        make_pred_ps(tt, st, real_x_alms)
+
+
+def read_real_map(tt: TaskTarget, st: PSSettings) -> np.ndarray:
+    real_map: np.ndarray = tt.real_map_in.handler.read(tt.real_map_in.path)
+    if real_map.shape[0] == 3 and st.map_fields == "I":
+        real_map = real_map[0]
+    return real_map
+
+
+def make_real_ps(real_map, tt: TaskTarget, st: PSSettings):
+    auto_real_ps = get_auto_ps_result(real_map,
+                                      mask=None,
+                                      lmax=st.lmax,
+                                      beam=st.beam_real,
+                                      is_convolved=False)
+    ps = auto_real_ps.deconv_dl
+    tt.auto_real_out.handler.write(tt.auto_real_out.path, data=ps)
+
+
+def make_real_ps_from_alms(tt: TaskTarget, st: PSSettings):
+    cl = get_autopower_from_alms(tt.real_alm_in.handler.read(tt.real_alm_in.path, lmax=st.lmax))
+    auto_real_ps = AutoSpectrum(None, cl, np.arange(st.lmax + 1), st.beam_real, is_convolved=False)
+    tt.auto_real_out.handler.write(tt.auto_real_out.path, data=auto_real_ps.deconv_dl)
+
+
+def make_real_masked_ps(real_x_alms: np.ndarray, tt: TaskTarget, st: PSSettings):
+    # The realization over the sky of the cross spectra; the baseline for their metrics
+    auto_real_ps = get_auto_ps_results_from_alms_batch(real_x_alms,
+                                                       mask=st.mask,
+                                                       lmax=st.lmax,
+                                                       beam=st.beam_real,
+                                                       is_convolved=False,
+                                                       mode_coupling=st.mode_coupling)[0]
+    out = tt.auto_real_masked_out
+    out.handler.write(out.path, data=auto_real_ps.deconv_dl)
+
+
+def make_pred_ps_from_alms(tt: TaskTarget, st: PSSettings, real_x_alms: np.ndarray=None):
+    pred_alms = []
+    for alm_in, ps_out in zip(tt.pred_alms_in, tt.auto_preds_out):
+        # Alms of mask * (map - mean), as get_xpower would compute them
+        alms = alm_in.handler.read(alm_in.path, lmax=st.lmax)
+        cl = get_autopower_from_alms(alms, mask=st.mask, mode_coupling=st.mode_coupling)
+        auto_pred_ps = AutoSpectrum(None, cl, np.arange(st.lmax + 1), st.beam_pred, is_convolved=True)
+        ps_out.handler.write(ps_out.path, data=auto_pred_ps.deconv_dl)
+        pred_alms.append(np.atleast_2d(alms)[0])
+    if real_x_alms is not None:
+        make_x_ps(np.stack(pred_alms, axis=0), real_x_alms, tt, st)
+
+
+def make_pred_ps(tt: TaskTarget, st: PSSettings, real_x_alms: np.ndarray=None) -> None:
+    # Temperature only; maps are read as (n_fields, n_pix)
+    pred_maps = [np.atleast_2d(map_in.handler.read(map_in.path))[0] for map_in in tt.pred_maps_in]
+    # One transform per map, for both auto and cross spectra
+    pred_alms = get_masked_alms_batch(np.stack(pred_maps, axis=0),
+                                      mask=st.mask,
+                                      lmax=st.lmax,
+                                      n_threads=st.sht_threads,
+                                      backend=st.sht_backend)
+    auto_pred_ps_list = get_auto_ps_results_from_alms_batch(pred_alms,
+                                                            mask=st.mask,
+                                                            lmax=st.lmax,
+                                                            beam=st.beam_pred,
+                                                            is_convolved=True,
+                                                            mode_coupling=st.mode_coupling)
+    for ps_out, auto_pred_ps in zip(tt.auto_preds_out, auto_pred_ps_list):
         ps = auto_pred_ps.deconv_dl
-        # print(max(ps-ps1))
-        self.out_auto_pred.write(data=ps)
+        ps_out.handler.write(ps_out.path, data=ps)
+    if real_x_alms is not None:
+        make_x_ps(pred_alms, real_x_alms, tt, st)
+
+
+def make_x_ps(pred_alms: np.ndarray, real_x_alms: np.ndarray, tt: TaskTarget, st: PSSettings) -> None:
+    # The prediction carries beam_pred; the realization has no beam (beam_real is NoBeam)
+    x_ps_list = get_x_ps_results_from_alms_batch(pred_alms,
+                                                 real_x_alms,
+                                                 mask=st.mask,
+                                                 lmax=st.lmax,
+                                                 beam1=st.beam_pred,
+                                                 beam2=st.beam_real,
+                                                 is_convolved=True,
+                                                 mode_coupling=st.mode_coupling)
+    for x_out, x_ps in zip(tt.x_preds_out, x_ps_list):
+        x_out.handler.write(x_out.path, data=x_ps.deconv_dl)
 
 
 class PyILCMakePSExecutor(MakePredPowerSpectrumExecutor):
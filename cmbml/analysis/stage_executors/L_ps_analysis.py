@@ -1,89 +1,253 @@
-from typing import Dict, List, NamedTuple, Callable
+from typing import Dict, List, Tuple
 import logging
-from pathlib import Path
 
 from functools import partial
-from multiprocessing import Pool, Manager
 
 from tqdm import tqdm
+import numpy as np
+import pandas as pd
 
 from omegaconf import DictConfig
 
-from cmbml.core import BaseStageExecutor, Asset, AssetWithPathAlts, GenericHandler
-from cmbml.analysis.px_statistics import get_func
+from cmbml.core import BaseStageExecutor, Split, Asset, AssetWithPathAlts
+from cmbml.analysis.px_statistics import get_batch_func, get_func
 from cmbml.core.asset_handlers.pd_csv_handler import PandasCsvHandler # Import for typing hint
-from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
-from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
+from cmbml.core.asset_handlers.pd_table_handler import PandasTableHandler, make_table # Import to register handler
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum, NumpyPowerSpectrumStack
+from cmbml.utils.running_stats import GroupedStats
 
 logger = logging.getLogger(__name__)
 
 
-class FrozenAsset(NamedTuple):
-    path: Path
-    handler: GenericHandler
-
-
-class TaskTarget(NamedTuple):
-    pred_asset: FrozenAsset
-    base_asset: FrozenAsset
-    baseline_label: str
-    split_name: str
-    sim_num: str
-    epoch: int
+class PSAnalysisExecutor(BaseStageExecutor):
+    """
+    Compares predicted power spectra to the theory and realization spectra.
 
+    The spectra of a split are stacked into arrays, (n_sims, n_epochs, n_ell)
+    for predictions, and each metric is evaluated across the whole stack at once.
 
-class PSAnalysisExecutor(BaseStageExecutor):
+    If cross spectra (prediction x realization) are given, the metrics of
+    ps_cross_functions (e.g. transfer function, correlation coefficient) are 
+    added to the rows compared with the realization. They compare the cross
+    spectra to the realization's spectrum over the same masked sky (auto_real_masked).
+    """
     def __init__(self, cfg: DictConfig) -> None:
         # The following string must match the pipeline yaml
         super().__init__(cfg, stage_str="ps_analysis")
 
         self.out_report: Asset = self.assets_out["report"]
-        out_report_handler: PandasCsvHandler
+        out_report_handler: PandasTableHandler
+        # Optional: the summary table, as ps_summary_tables makes it
+        self.out_epoch_stats: Asset = self.assets_out.get("epoch_stats", None)
+        out_epoch_stats_handler: PandasCsvHandler
 
         self.in_ps_theory: AssetWithPathAlts = self.assets_in["theory_ps"]
+        # Optional: the theory spectra of each split in one file (see convert_theory_ps)
+        self.in_ps_theory_stack: Asset = self.assets_in.get("theory_ps_stack", None)
+        in_ps_theory_stack_handler: NumpyPowerSpectrumStack
         self.in_ps_real: Asset = self.assets_in["auto_real"]
         self.in_ps_pred: Asset = self.assets_in["auto_pred"]
+        # Optional: cross spectra, made by make_pred_ps
+        self.in_ps_x: Asset = self.assets_in.get("x_real_pred", None)
+        self.in_ps_real_masked: Asset = self.assets_in.get("auto_real_masked", None)
         in_ps_handler: NumpyPowerSpectrum
+        if self.in_ps_x is not None and self.in_ps_real_masked is None:
+            raise ValueError("ps_analysis has x_real_pred, but no auto_real_masked input.")
 
         self.stat_func_dict = self.cfg.model.analysis.ps_functions
         self.stat_funcs = self.get_stat_funcs()
-
-        self.num_processes = cfg.model.analysis.ps_operations.num_processes
+        self.cross_funcs = self.get_cross_funcs()
+
+        # Summary statistics, updated as results arrive; by (epoch, baseline)
+        quantiles = cfg.model.analysis.get("summary_quantiles", None) or []
+        self.stats = GroupedStats([*self.stat_funcs.keys(), *self.cross_funcs.keys()], quantiles=quantiles)
+        self.baselines = []
+        # Columns of the report, fixed up front so that every batch of rows has all of them
+        self.report_columns = {'split': None, 'sim': None, 'epoch': None, 'baseline': None,
+                               **{name: 'float64' for name in [*self.stat_funcs, *self.cross_funcs]},
+                               'error': 'string'}
+        self.n_rows_written = 0
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
-        
-        # Create a method; 
-        #   process_target needs a list of statistics functions, from the config file
-        #   partial() makes a `process` that takes a single argument
-        process = partial(process_target, stat_funcs=self.stat_funcs)
-        # Tasks are items on a to-do list
-        #   For each simulation, we compare the prediction and target
-        #   A task contains labels, file names, and handlers for each sim
-        tasks = self.build_tasks()
-
-        # Run a single task outside multiprocessing to catch issues quickly.
-        self.try_a_task(process, tasks[0])
-
-        self.run_all_tasks(process, tasks)
-
-    def run_all_tasks(self, process, tasks):
-        # Use multiprocessing to search through sims in parallel
-        # A manager allows collection of information across separate threads
-        with Manager() as manager:
-            results = manager.list()
-            # The Pool sets up the individual processes. 
-            # Set processes according to the capacity of your computer
-            with Pool(processes=self.num_processes) as pool:
-                # Each result is the output of "process" running on each of the tasks
-                for result in tqdm(pool.imap_unordered(process, tasks), total=len(tasks)):
-                    results.append(result)
-            # Convert the results to a regular list after multiprocessing is complete
-            #     and before the scope of the manager ends
-            results_list = list(results)
-        self.review_report(results_list)
-        # Use the out_report asset to write all results to disk
-        self.out_report.write(data=results_list)
+        errors = []
+        for split in self.splits:
+            results = self.process_split(split)
+            self.write_report_rows(results)
+            for result in results:
+                if 'error' in result.keys():
+                    errors.append(result)
+                else:
+                    self.update_stats(result)
+
+        # The report's handler may keep the file open between appends (PandasTable does)
+        close = getattr(self.out_report.handler, "close", None)
+        if close is not None:
+            close(self.out_report.path)
+        self.write_summary()
+        self.review_report(errors)
+
+    def process_split(self, split: Split) -> List[Dict]:
+        sims, spectra, errors = self.load_split(split)
+        results = []
+        if len(sims) > 0:
+            theory, real, pred, real_masked, cross = spectra
+            # Baselines are (n_sims, 1, n_ell), to compare with every epoch
+            for baseline_label, base in [("thry", theory), ("real", real)]:
+                try:
+                    metrics = self.get_metrics(base[:, None, :], pred)
+                    if self.cross_funcs:
+                        if baseline_label == "real":
+                            metrics.update(self.get_cross_metrics(real_masked[:, None, :], pred, cross))
+                        else:
+                            # Cross spectra are compared with the realization only
+                            metrics.update({name: np.full(pred.shape[:-1], np.nan) for name in self.cross_funcs})
+                except Exception as e:
+                    # The comparisons of the split fail together; they are reported, as are unreadable spectra
+                    results.extend(self.to_error_rows(split.name, sims, baseline_label, str(e)))
+                    continue
+                results.extend(self.to_rows(split.name, sims, baseline_label, metrics))
+        return results + errors
+
+    def load_split(self, split: Split) -> Tuple[List, Tuple[np.ndarray], List[Dict]]:
+        """
+        Reads all spectra for a split, once each.
+
+        Returns the sims read, the stacked theory (n_sims, n_ell), realization (n_sims, n_ell),
+        prediction (n_sims, n_epochs, n_ell), masked realization (as realization, or None), 
+        and cross (as prediction, or None) spectra, and error results for sims that could not be read.
+        """
+        sims, theory, real, pred, real_masked, cross = [], [], [], [], [], []
+        errors = []
+        # The split's theory spectra by sim, if read from one file (see convert_theory_ps)
+        theory_lookup = None
+        if self.in_ps_theory_stack is not None and not split.ps_fidu_fixed:
+            with self.name_tracker.set_context("split", split.name):
+                theory_lookup = self.in_ps_theory_stack.handler.read_lookup(self.in_ps_theory_stack.path)
+        for sim in tqdm(split.iter_sims(), total=split.n_sims, desc=f"Reading {split.name}"):
+            with self.name_tracker.set_contexts(dict(split=split.name, sim_num=sim)):
+                try:
+                    if theory_lookup is None:
+                        sim_theory = self.read_ps(self.in_ps_theory)
+                    else:
+                        sim_theory = theory_lookup(sim)
+                    sim_real = self.read_ps(self.in_ps_real)
+                    if self.cross_funcs:
+                        sim_real_masked = self.read_ps(self.in_ps_real_masked)
+                    sim_pred, sim_cross = [], []
+                    for epoch in self.model_epochs:
+                        with self.name_tracker.set_context("epoch", epoch):
+                            sim_pred.append(self.read_ps(self.in_ps_pred))
+                            if self.cross_funcs:
+                                sim_cross.append(self.read_ps(self.in_ps_x))
+                except OSError as e:
+                    for epoch in self.model_epochs:
+                        for baseline_label in ["thry", "real"]:
+                            errors.append(dict(split=split.name, sim=sim, epoch=epoch, baseline=baseline_label,
+                                               error=str(e)))
+                    continue
+            sims.append(sim)
+            theory.append(sim_theory)
+            real.append(sim_real)
+            pred.append(np.stack(sim_pred, axis=0))
+            if self.cross_funcs:
+                real_masked.append(sim_real_masked)
+                cross.append(np.stack(sim_cross, axis=0))
+        if len(sims) == 0:
+            return sims, None, errors
+        try:
+            real_masked = np.stack(real_masked) if self.cross_funcs else None
+            cross = np.stack(cross) if self.cross_funcs else None
+            spectra = (np.stack(theory), np.stack(real), np.stack(pred), real_masked, cross)
+        except ValueError as e:
+            error = f"Spectra in split {split.name} differ in length, so they cannot be compared. Error: {str(e)}"
+            for baseline_label in ["thry", "real"]:
+                errors.extend(self.to_error_rows(split.name, sims, baseline_label, error))
+            return [], None, errors
+        return sims, spectra, errors
+
+    @staticmethod
+    def read_ps(asset: Asset) -> np.ndarray:
+        path = asset.path
+        try:
+            return asset.handler.read(path)
+        except OSError as e:
+            raise OSError(f"Could not read data from {path}. Error: {str(e)}")
+
+    def get_metrics(self, true: np.ndarray, pred: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Each metric for each (sim, epoch), from spectra with ells on the last axis.
+        """
+        # Use just the portion of true data needed.
+        n_ell = pred.shape[-1]
+        if true.shape[-1] < n_ell:
+            raise ValueError(f"Baseline spectra have {true.shape[-1]} ells; predictions have {n_ell}.")
+        true = true[..., :n_ell]
+        metrics = {}
+        for stat_name, func in self.stat_funcs.items():
+            try:
+                metrics[stat_name] = np.broadcast_to(func(true, pred), pred.shape[:-1])
+            except Exception as e:
+                raise ValueError(f"Running '{stat_name}' caused '{str(e)}'. This stat function is defined in stat_funcs.yaml.") from e
+        return metrics
+
+    def get_cross_metrics(self, real: np.ndarray, pred: np.ndarray, cross: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Each cross-spectrum metric for each (sim, epoch), as get_metrics.
+        The realization must be masked as the cross spectra are (auto_real_masked).
+        """
+        n_ell = pred.shape[-1]
+        if cross.shape[-1] != n_ell:
+            raise ValueError(f"Cross spectra have {cross.shape[-1]} ells; predictions have {n_ell}.")
+        if real.shape[-1] < n_ell:
+            raise ValueError(f"Masked realization spectra have {real.shape[-1]} ells; predictions have {n_ell}.")
+        real = real[..., :n_ell]
+        return {stat_name: np.broadcast_to(func(real, pred, cross), pred.shape[:-1])
+                for stat_name, func in self.cross_funcs.items()}
+
+    def to_rows(self, split_name, sims, baseline_label, metrics) -> List[Dict]:
+        rows = []
+        for i, sim in enumerate(sims):
+            for j, epoch in enumerate(self.model_epochs):
+                res = dict(split=split_name, sim=sim, epoch=epoch, baseline=baseline_label)
+                for stat_name, values in metrics.items():
+                    res[stat_name] = float(values[i, j])
+                rows.append(res)
+        return rows
+
+    def to_error_rows(self, split_name, sims, baseline_label, error) -> List[Dict]:
+        return [dict(split=split_name, sim=sim, epoch=epoch, baseline=baseline_label, error=error)
+                for sim in sims for epoch in self.model_epochs]
+
+    def write_report_rows(self, results: List[Dict]) -> None:
+        if len(results) == 0:
+            return
+        # Use the out_report asset to write the results to disk
+        rows = make_table(results, self.report_columns)
+        self.out_report.write(data=rows, append=self.n_rows_written > 0)
+        self.n_rows_written += len(rows)
+
+    def update_stats(self, result):
+        self.stats.update((result['epoch'], result['baseline']), result)
+        if result['baseline'] not in self.baselines:
+            self.baselines.append(result['baseline'])
+
+    def write_summary(self):
+        if self.out_epoch_stats is None:
+            return
+        all_summaries = []
+        for baseline in self.baselines:
+            for epoch in self.model_epochs:
+                summary_df = self.stats.summary((epoch, baseline))
+                summary_df = summary_df.unstack().reset_index()
+                summary_df.columns = ['metric', 'type', 'value']
+                summary_df['epoch'] = epoch  # Add epoch as a column
+                summary_df['baseline'] = baseline  # Add baseline as a column
+                all_summaries.append(summary_df)
+        if len(all_summaries) == 0:
+            return
+        final_summary = pd.concat(all_summaries, ignore_index=True)
+        self.out_epoch_stats.write(data=final_summary, index=False)
 
     def review_report(self, report_list):
         found_error = False
@@ -94,88 +258,25 @@ class PSAnalysisExecutor(BaseStageExecutor):
         if found_error:
             raise OSError("Errors were found in the report. Please review the log for details.")
 
-    def build_tasks(self):
-        tasks = []
-        for split in self.splits:
-            for sim in split.iter_sims():
-                for epoch in self.model_epochs:
-                    context = dict(split=split.name, sim_num=sim, epoch=epoch)
-                    with self.name_tracker.set_contexts(contexts_dict=context):
-                        pred = self.in_ps_pred
-                        pred = FrozenAsset(path=pred.path, handler=pred.handler)
-
-                        real = self.in_ps_real
-                        real = FrozenAsset(path=real.path, handler=real.handler)
-
-                        thry = self.in_ps_theory
-                        thry = FrozenAsset(path=thry.path, handler=thry.handler)
-
-                        tasks.append(TaskTarget(pred_asset=pred,
-                                                base_asset=thry,
-                                                baseline_label="thry",
-                                                split_name=split.name, 
-                                                sim_num=sim,
-                                                epoch=epoch))
-
-                        tasks.append(TaskTarget(pred_asset=pred,
-                                                base_asset=real,
-                                                baseline_label="real",
-                                                split_name=split.name, 
-                                                sim_num=sim,
-                                                epoch=epoch))
-
-        return tasks
-
-    def try_a_task(self, process, task: TaskTarget):
-        """
-        Get statistics for one sim (task) outside multiprocessing first, 
-        to avoid painful debugging within multiprocessing.
-        """
-        res = process(task)
-        if 'error' in res.keys():
-            raise Exception(res['error'])
-
     def get_stat_funcs(self):
+        # Vectorized equivalents of the functions in the config file (see px_statistics)
         stat_funcs = {}
         for name, details in self.stat_func_dict.items():
-            func = get_func(details["func"])
+            func = get_batch_func(details["func"])
             if 'kwargs' in details:
                 func = partial(func, **details['kwargs'])
             stat_funcs[name] = func
         return stat_funcs
 
-
-def process_target(task_target: TaskTarget, stat_funcs):
-    """
-    Each stat_func should accept true, pred, and **kwargs to catch other things
-    """
-    res = {'split': task_target.split_name, 'sim': task_target.sim_num, 'epoch':task_target.epoch}
-    res = dict(
-        split=task_target.split_name,
-        sim=task_target.sim_num,
-        epoch=task_target.epoch,
-        baseline=task_target.baseline_label
-    )
-    pred = task_target.pred_asset
-    base = task_target.base_asset
-    try:
-        true_data = base.handler.read(base.path)
-    except OSError as e:
-        return {'error': f"Could not read true data from {base.path}. Error: {str(e)}", **res}
-    try:
-        pred_data = pred.handler.read(pred.path)
-    except OSError as e:
-        return {'error': f"Could not read pred data from {pred.path}. Error: {str(e)}", **res}
-
-    # Ensure that the shapes match
-    if pred_data.shape[0] < true_data.shape[0]:
-        # If so, use just the portion of true data needed.
-        true_data = true_data[:pred_data.shape[0]]
-
-    try:
-        for stat_name, func in stat_funcs.items():
-            res[stat_name] = func(true_data, pred_data)
-    except Exception as e:
-        res['error'] = f"Running '{stat_name}' caused '{str(e)}'. This stat function is defined in stat_funcs.yaml."
-
-    return res
+    def get_cross_funcs(self):
+        # Metrics of the cross spectra, if given (see px_statistics)
+        cross_funcs = {}
+        if self.in_ps_x is None:
+            return cross_funcs
+        cross_func_dict = self.cfg.model.analysis.get("ps_cross_functions", None) or {}
+        for name, details in cross_func_dict.items():
+            func = get_func(details["func"])
+            if 'kwargs' in details:
+                func = partial(func, **details['kwargs'])
+            cross_funcs[name] = func
+        return cross_funcs
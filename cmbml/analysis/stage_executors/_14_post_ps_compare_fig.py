@@ -1,4 +1,5 @@
-from typing import Union
+from typing import Union, List, NamedTuple, Tuple
+from pathlib import Path
 import logging
 
 import numpy as np
@@ -19,7 +20,9 @@ from cmbml.core import (
     )
 
 from cmbml.core.asset_handlers.asset_handlers_base import EmptyHandler # Import for typing hint
-from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum, NumpyPowerSpectrumStack
+from cmbml.utils.fig_render import init_render_worker
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
@@ -32,6 +35,20 @@ GREEN = "#00A651"
 YELLOW = "#FDB913"
 
 
+class TaskTarget(NamedTuple):
+    ps_theory_in: FrozenAsset                   # None if the split's theory spectrum is fixed (in FigSettings)
+    ps_theory: np.ndarray                       # None unless read from the split's theory_ps_stack
+    ps_preds_in: List[Tuple[str, FrozenAsset]]  # (model name, spectrum) for each model compared
+    fig_path: Path
+
+
+class FigSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    ps_theory: np.ndarray                       # None unless the split's theory spectrum is fixed
+    wmap_band: List
+    lmax: int
+
+
 class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following string must match the pipeline yaml
@@ -42,6 +59,9 @@ class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
         out_ps_figure_handler: EmptyHandler
 
         self.in_ps_theory: AssetWithPathAlts = self.assets_in["theory_ps"]
+        # Optional: the theory spectra of each split in one file (see convert_theory_ps)
+        self.in_ps_theory_stack: Asset = self.assets_in.get("theory_ps_stack", None)
+        in_ps_theory_stack_handler: NumpyPowerSpectrumStack
         self.in_ps_real: Asset = self.assets_in["auto_real"]
         self.in_ps_pred: Asset = self.assets_in["auto_pred"]
         self.in_wmap_ave: Asset = self.assets_in["wmap_ave"]
@@ -56,6 +76,9 @@ class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
         self.fig_model_name = cfg.fig_model_name
         self.models_to_compare = cfg.models_comp
 
+        fig_ops = cfg.model.analysis.get("fig_operations", None)
+        self.num_processes = fig_ops.num_processes if fig_ops else 1
+
     def execute(self) -> None:
         # Remove this function
         logger.debug(f"Running {self.__class__.__name__} execute()")
@@ -77,14 +100,29 @@ class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
             ps_theory = self.in_ps_theory.read(use_alt_path=True)
         else:
             ps_theory = None
-        
+        # The split's theory spectra by sim, if read from one file (see convert_theory_ps)
+        theory_lookup = None
+        if ps_theory is None and self.in_ps_theory_stack is not None:
+            theory_lookup = self.in_ps_theory_stack.handler.read_lookup(self.in_ps_theory_stack.path)
+
+        # The WMAP band is the same for every figure; it is read once and given to each worker
+        wmap_ave = self.in_wmap_ave.read()
+        wmap_std = self.in_wmap_std.read()
+        wmap_band = [(wmap_ave - wmap_std, wmap_ave + wmap_std), (wmap_ave - 2*wmap_std, wmap_ave + 2*wmap_std)]
+        settings = FigSettings(ps_theory=ps_theory, wmap_band=wmap_band, lmax=self.lmax)
+
+        tasks = []
         for sim in sim_iter:
-            print(f"Processing split {split.name}, sim {sim}")
             with self.name_tracker.set_context("sim_num", sim):
-                self.process_sim(ps_theory)
+                tasks.append(self.build_a_task(fixed_theory=ps_theory is not None,
+                                               theory_lookup=theory_lookup))
+
+        logger.info(f"Making {len(tasks)} figures.")
+        run_tasks(render_figure, tasks, settings, self.num_processes,
+                  initializer=init_render_worker)
 
-    def process_sim(self, ps_theory) -> None:
-        spectra = []
+    def build_a_task(self, fixed_theory, theory_lookup=None) -> TaskTarget:
+        ps_preds_in = []
         for model_comp in self.models_to_compare:
             epochs = model_comp.get("epochs", None)
             if epochs is None:
@@ -93,137 +131,24 @@ class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
                 # Hard code to just do the last epoch. TODO: Fix this!
                 epoch = epochs[-1]
             with self.name_tracker.set_context('epoch', epoch):
-                ps = self.get_ps_for(model_comp)
-            res = dict(
-                model=model_comp,
-                epochs=epochs,
-                ps=ps
-            )
-            spectra.append(res)
-        self.make_figure(ps_theory, spectra)
-
-    def get_ps_for(self, model_comp):
+                ps_preds_in.append((model_comp["model_name"], self.get_ps_asset_for(model_comp)))
+        self.out_ps_figure_theory.write()  # Make directory
+        if theory_lookup is not None:
+            ps_theory_in, ps_theory = None, theory_lookup(self.name_tracker.context['sim_num'])
+        else:
+            ps_theory_in = None if fixed_theory else freeze(self.in_ps_theory)
+            ps_theory = None
+        return TaskTarget(ps_theory_in=ps_theory_in,
+                          ps_theory=ps_theory,
+                          ps_preds_in=ps_preds_in,
+                          fig_path=self.out_ps_figure_theory.path)
+
+    def get_ps_asset_for(self, model_comp) -> FrozenAsset:
         model_dict = OmegaConf.to_container(model_comp, resolve=True)
         working_directory = model_dict["working_directory"]
 
         with self.name_tracker.set_context("working", working_directory):
-            ps = self.in_ps_pred.read()
-        return ps
-
-    def make_figure(self, ps_theory, spectra) -> None:
-        if ps_theory is None:
-            ps_theory = self.in_ps_theory.read(use_alt_path=False)
-
-        wmap_ave = self.in_wmap_ave.read()
-        wmap_std = self.in_wmap_std.read()
-
-        wmap_band = [(wmap_ave - wmap_std, wmap_ave + wmap_std), (wmap_ave - 2*wmap_std, wmap_ave + 2*wmap_std)]
-
-        fig, axs = plt.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 6))
-        ax1, ax2 = axs
-
-        colors = [PURBLUE, RED, YELLOW, GREEN ]
-        label_xlate = {'CMBNNCS': 'CMBNNCS Prediction', 'CNILC': 'CNILC Prediction'}
-
-        # fig, ax = plt.subplots()
-        # fig.suptitle('Marker fillstyle', fontsize=14)
-        # fig.subplots_adjust(left=0.4)
-
-        # filled_marker_style = dict(marker='o', linestyle=':', markersize=15,
-        #                         color='darkgrey',
-        #                         markerfacecolor='tab:blue',
-        #                         markerfacecoloralt='lightsteelblue',
-        #                         markeredgecolor='brown')
-
-        # for y, fill_style in enumerate(Line2D.fillStyles):
-        #     ax.text(-0.5, y, repr(fill_style), **text_style)
-        #     ax.plot([y] * 3, fillstyle=fill_style, **filled_marker_style)
-        # format_axes(ax)
-
-        n_ells = self.lmax
-        ells = np.arange(1, n_ells+1)
-        ells = ells[2:n_ells]
-        thry_params = dict(color=BLACK, label='Theory')
-        wmap1_params = dict(color=GREEN, alpha=0.25, label='1$\\sigma$ WMAP')
-        wmap2_params = dict(color=GREEN, alpha=0.50, label='2$\\sigma$ WMAP')
-        horz_params = dict(linestyle='--', linewidth=0.5, label='Theory', color=BLACK)
-        # horz_params = {'label': 'Theory', 'color': BLACK, **horz_params}
-        wmap1_lower = wmap_band[0][0][2:n_ells]
-        wmap1_upper = wmap_band[0][1][2:n_ells]
-        wmap2_lower = wmap_band[1][0][2:n_ells]
-        wmap2_upper = wmap_band[1][1][2:n_ells]
-        ps_theory = ps_theory[2:n_ells]
-
-        ax1.fill_between(ells, wmap1_lower, wmap1_upper, **wmap1_params)
-        ax1.fill_between(ells, wmap2_lower, wmap2_upper, **wmap2_params)
-        ax1.plot(ells, ps_theory, **thry_params)
-
-        ax2.axhline(0, **horz_params)
-
-        # TODO: temporary. Better to specify colors per model in the configs and use those; 
-        # can have fixed presentation style
-        fillstyles = ['left', 'right']
-        for spec, color, fillstyle in zip(spectra, colors, fillstyles):
-            model_name = spec['model']['model_name']
-            pred_params = dict(color=color, label=label_xlate[model_name])
-            ps_pred = spec['ps'][2:n_ells]
-            self.add_ps_to_figures(axs, ells, ps_pred, ps_theory, pred_params, fillstyle)
-
-        ax1.set_ylabel('$D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
-        ax1.set_ylim(-300, 6500)
-        ax1.legend(markerscale=3)
-
-        ax2.set_xlabel('$\\ell$')
-
-        ax2.set_ylabel('$\\% \\Delta D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
-        ax2.set_ylim(-50, 50)
-
-        # title = self.make_title(epoch, split, sim_num)
-        # plt.suptitle(title)
-        self.out_ps_figure_theory.write()
-        fn = self.out_ps_figure_theory.path
-        print(f'writing to {fn}')
-        plt.savefig(fn)
-        plt.close()
-
-    def add_ps_to_figures(self, axs, ells, ps_pred, ps_theory, pred_params, fillstyle):
-        ax1, ax2 = axs
-
-        # Upper Panel
-        self.abs_panel(ax1, ells, ps_pred, pred_params)
-
-        # Lower Panel
-        deltas = (ps_pred - ps_theory) / ps_theory * 100
-        self.rel_panel(ax2, ells, deltas, pred_params, fillstyle)
-
-    def abs_panel(self, ax, ells, pred_conved, pred_params):
-        # Upper panel
-        marker_size = 1
-        ax.scatter(ells, pred_conved, s=marker_size, **pred_params)
-
-    def rel_panel(self, ax, ells, deltas, deltas_params, fillstyle):
-        # Lower panel
-        marker_size = 5
-        bin_width = 30
-
-        bin_centers2, binned_means2, binned_stds2 = self.bin_data(ells, deltas, bin_width)
-        ax.errorbar(bin_centers2, binned_means2, yerr=binned_stds2, fmt='o', markersize=marker_size, fillstyle=fillstyle, markeredgecolor='none', **deltas_params)
-
-    def bin_data(self, ells, deltas, bin_width):
-        # Calculate the bin edges
-        bin_edges = np.arange(min(ells), max(ells) + bin_width, bin_width)
-        # Digitize the ells data to find out which bin each value belongs to
-        bin_indices = np.digitize(ells, bin_edges)
-        # Calculate the mean and standard deviation of deltas values within each bin
-        binned_means = []
-        binned_stds = []
-        for i in range(1, len(bin_edges)):
-            bin_values = deltas[bin_indices == i]
-            binned_means.append(np.mean(bin_values))
-            binned_stds.append(np.std(bin_values))
-        # Calculate the center of each bin for plotting purposes
-        bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-        return bin_centers, binned_means, binned_stds
+            return freeze(self.in_ps_pred)
 
     def make_title(self, epoch, split, sim_num):
         if epoch != "":
@@ -231,3 +156,129 @@ class PostAnalysisPsCompareFigExecutor(BaseStageExecutor):
         else:
             e_phrase = ""
         return f"{self.fig_model_name} Predictions{e_phrase}, {split}:{sim_num}"
+
+
+def render_figure(task_target: TaskTarget):
+    tt = task_target
+    st: FigSettings = get_settings()
+
+    if tt.ps_theory is not None:
+        ps_theory = tt.ps_theory
+    elif tt.ps_theory_in is None:
+        ps_theory = st.ps_theory
+    else:
+        ps_theory = tt.ps_theory_in.handler.read(tt.ps_theory_in.path)
+    spectra = []
+    for model_name, ps_in in tt.ps_preds_in:
+        spectra.append(dict(model_name=model_name, ps=ps_in.handler.read(ps_in.path)))
+    make_figure(ps_theory, spectra, st.wmap_band, st.lmax)
+    logger.debug(f'writing to {tt.fig_path}')
+    plt.savefig(tt.fig_path)
+    plt.close()
+
+
+def make_figure(ps_theory, spectra, wmap_band, lmax) -> None:
+    fig, axs = plt.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 6))
+    ax1, ax2 = axs
+
+    colors = [PURBLUE, RED, YELLOW, GREEN ]
+    label_xlate = {'CMBNNCS': 'CMBNNCS Prediction', 'CNILC': 'CNILC Prediction'}
+
+    # fig, ax = plt.subplots()
+    # fig.suptitle('Marker fillstyle', fontsize=14)
+    # fig.subplots_adjust(left=0.4)
+
+    # filled_marker_style = dict(marker='o', linestyle=':', markersize=15,
+    #                         color='darkgrey',
+    #                         markerfacecolor='tab:blue',
+    #                         markerfacecoloralt='lightsteelblue',
+    #                         markeredgecolor='brown')
+
+    # for y, fill_style in enumerate(Line2D.fillStyles):
+    #     ax.text(-0.5, y, repr(fill_style), **text_style)
+    #     ax.plot([y] * 3, fillstyle=fill_style, **filled_marker_style)
+    # format_axes(ax)
+
+    n_ells = lmax
+    ells = np.arange(1, n_ells+1)
+    ells = ells[2:n_ells]
+    thry_params = dict(color=BLACK, label='Theory')
+    wmap1_params = dict(color=GREEN, alpha=0.25, label='1$\\sigma$ WMAP')
+    wmap2_params = dict(color=GREEN, alpha=0.50, label='2$\\sigma$ WMAP')
+    horz_params = dict(linestyle='--', linewidth=0.5, label='Theory', color=BLACK)
+    # horz_params = {'label': 'Theory', 'color': BLACK, **horz_params}
+    wmap1_lower = wmap_band[0][0][2:n_ells]
+    wmap1_upper = wmap_band[0][1][2:n_ells]
+    wmap2_lower = wmap_band[1][0][2:n_ells]
+    wmap2_upper = wmap_band[1][1][2:n_ells]
+    ps_theory = ps_theory[2:n_ells]
+
+    ax1.fill_between(ells, wmap1_lower, wmap1_upper, **wmap1_params)
+    ax1.fill_between(ells, wmap2_lower, wmap2_upper, **wmap2_params)
+    ax1.plot(ells, ps_theory, **thry_params)
+
+    ax2.axhline(0, **horz_params)
+
+    # TODO: temporary. Better to specify colors per model in the configs and use those; 
+    # can have fixed presentation style
+    fillstyles = ['left', 'right']
+    for spec, color, fillstyle in zip(spectra, colors, fillstyles):
+        model_name = spec['model_name']
+        pred_params = dict(color=color, label=label_xlate[model_name])
+        ps_pred = spec['ps'][2:n_ells]
+        add_ps_to_figures(axs, ells, ps_pred, ps_theory, pred_params, fillstyle)
+
+    ax1.set_ylabel('$D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
+    ax1.set_ylim(-300, 6500)
+    ax1.legend(markerscale=3)
+
+    ax2.set_xlabel('$\\ell$')
+
+    ax2.set_ylabel('$\\% \\Delta D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
+    ax2.set_ylim(-50, 50)
+
+    # title = self.make_title(epoch, split, sim_num)
+    # plt.suptitle(title)
+
+
+def add_ps_to_figures(axs, ells, ps_pred, ps_theory, pred_params, fillstyle):
+    ax1, ax2 = axs
+
+    # Upper Panel
+    abs_panel(ax1, ells, ps_pred, pred_params)
+
+    # Lower Panel
+    deltas = (ps_pred - ps_theory) / ps_theory * 100
+    rel_panel(ax2, ells, deltas, pred_params, fillstyle)
+
+
+def abs_panel(ax, ells, pred_conved, pred_params):
+    # Upper panel
+    marker_size = 1
+    ax.scatter(ells, pred_conved, s=marker_size, **pred_params)
+
+
+def rel_panel(ax, ells, deltas, deltas_params, fillstyle):
+    # Lower panel
+    marker_size = 5
+    bin_width = 30
+
+    bin_centers2, binned_means2, binned_stds2 = bin_data(ells, deltas, bin_width)
+    ax.errorbar(bin_centers2, binned_means2, yerr=binned_stds2, fmt='o', markersize=marker_size, fillstyle=fillstyle, markeredgecolor='none', **deltas_params)
+
+
+def bin_data(ells, deltas, bin_width):
+    # Calculate the bin edges
+    bin_edges = np.arange(min(ells), max(ells) + bin_width, bin_width)
+    # Digitize the ells data to find out which bin each value belongs to
+    bin_indices = np.digitize(ells, bin_edges)
+    # Calculate the mean and standard deviation of deltas values within each bin
+    binned_means = []
+    binned_stds = []
+    for i in range(1, len(bin_edges)):
+        bin_values = deltas[bin_indices == i]
+        binned_means.append(np.mean(bin_values))
+        binned_stds.append(np.std(bin_values))
+    # Calculate the center of each bin for plotting purposes
+    bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
+    return bin_centers, binned_means, binned_stds
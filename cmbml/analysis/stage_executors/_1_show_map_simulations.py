@@ -1,5 +1,5 @@
-from typing import List, Dict, Union
-from typing import List, Dict, Union
+from typing import List, Dict, Union, NamedTuple, Tuple
+from pathlib import Path
 import logging
 
 import numpy as np
@@ -13,16 +13,35 @@ from cmbml.core import (
     Split,
     Asset
     )
-# from tqdm import tqdm
+from cmbml.core.asset_handlers import make_directories
 from cmbml.core.asset_handlers.asset_handlers_base import Mover
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap
 from cmbml.utils.planck_instrument import make_instrument, Instrument
 from cmbml.utils import planck_cmap
+from cmbml.utils import fig_render
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
 
 
+class TaskTarget(NamedTuple):
+    map_in: FrozenAsset
+    fig_paths: Dict[str, Path]  # By field
+    title: str                  # Start of each figure's title
+
+
+class RenderSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    min_max: Tuple
+    rot: Tuple
+    xsize: int
+
+
+# Width of the views, in pixels (as hp.mollview's default)
+MOLL_XSIZE = 800
+
+
 class ShowSimsExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following stage_str must match the pipeline yaml
@@ -48,6 +67,9 @@ class ShowSimsExecutor(BaseStageExecutor):
         self.plot_rot = cfg.pipeline[self.stage_str].plot_rot
         self.gnom_plot_res = cfg.pipeline[self.stage_str].plot_gnom_res
 
+        fig_ops = cfg.model.analysis.get("fig_operations", None)
+        self.num_processes = fig_ops.num_processes if fig_ops else 1
+
     def get_override_sim_ns(self, sim_nums: Union[None, list, int]):
         # Returns either a list of sims, or None
         try:
@@ -68,11 +90,23 @@ class ShowSimsExecutor(BaseStageExecutor):
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
-        self.default_execute()
+        tasks = []
+        for split in self.splits:
+            with self.name_tracker.set_context("split", split.name):
+                tasks.extend(self.build_tasks(split))
+        if len(tasks) == 0:
+            return
 
-    def process_split(self, 
-                      split: Split) -> None:
-        logger.info(f"Running {self.__class__.__name__} process_split() for split: {split.name}.")
+        # The projection is computed once, here, and given to each worker
+        settings = RenderSettings(min_max=self.min_max, rot=self.plot_rot, xsize=MOLL_XSIZE)
+        grids = [fig_render.get_mollweide_grid(self.cfg.scenario.nside, xsize=MOLL_XSIZE, rot=self.plot_rot)]
+
+        logger.info(f"Rendering figures for {len(tasks)} maps.")
+        run_tasks(render_maps_per_field, tasks, settings, self.num_processes,
+                  initializer=fig_render.init_render_worker, initargs=(grids,))
+
+    def build_tasks(self, split: Split) -> List[TaskTarget]:
+        logger.info(f"Running {self.__class__.__name__} build_tasks() for split: {split.name}.")
 
         # We may want to process a subset of all sims
         if self.sim_ns is None:
@@ -80,19 +114,16 @@ class ShowSimsExecutor(BaseStageExecutor):
         else:
             sim_iter = self.sim_ns
 
+        tasks = []
         for sim in sim_iter:
             with self.name_tracker.set_context("sim_num", sim):
-                self.process_sim()
+                tasks.append(self.build_a_task(self.in_cmb_map, det="cmb", out_asset=self.out_cmb_figure))
+                for freq in self.instrument.dets:
+                    with self.name_tracker.set_context("freq", freq):
+                        tasks.append(self.build_a_task(self.in_obs_map, det=freq, out_asset=self.out_obs_figure))
+        return tasks
 
-    def process_sim(self) -> None:
-        cmb_map = self.in_cmb_map.read()
-        self.make_maps_per_field(cmb_map, det="cmb", out_asset=self.out_cmb_figure)
-        for freq in self.instrument.dets:
-            with self.name_tracker.set_context("freq", freq):
-                obs_map = self.in_obs_map.read()
-                self.make_maps_per_field(obs_map, det=freq, out_asset=self.out_obs_figure)
-
-    def make_maps_per_field(self, some_map, det, out_asset):
+    def build_a_task(self, in_asset, det, out_asset) -> TaskTarget:
         split = self.name_tracker.context['split']
         sim_n = f"{self.name_tracker.context['sim_num']:0{self.cfg.file_system.sim_str_num_digits}d}"
         if det == "cmb":
@@ -101,35 +132,13 @@ class ShowSimsExecutor(BaseStageExecutor):
         else:
             title_start = f"Observation, {det} GHz (Feature)"
             fields = self.instrument.dets[det].fields
+        fig_paths = {}
         for field_str in fields:
-            with self.name_tracker.set_context("field", field_str):
-                field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
-                # self.make_gnomview(some_map[field_idx])
-                # with self.name_tracker.set_context("view", "gnom"):
-                #     self.save_figure(title_start, split, sim_n, field_str, out_asset)
-                self.make_mollview(some_map[field_idx])
-                with self.name_tracker.set_context("view", "moll"):
-                    self.save_figure(title_start, split, sim_n, field_str, out_asset)
-
-    def save_figure(self, title, split_name, sim_num, field_str, out_asset):
-        plt.suptitle(f"{title}, {split_name}:{sim_num} {field_str} Stokes")
-
-        fn = out_asset.path.name
-        plt.savefig(fn)
-        plt.close()
-        out_asset.write(source_location=fn)
-
-    def make_mollview(self, some_map):
-        fig = plt.figure(figsize=(8, 6))
-        plot_params = dict(
-            min=self.min_max[0], 
-            max=self.min_max[1],
-            rot=self.plot_rot,
-            cmap=planck_cmap.colombi1_cmap,
-            hold=True,
-            norm='log'
-        )
-        hp.mollview(some_map, **plot_params)
+            with self.name_tracker.set_contexts(dict(field=field_str, view="moll")):
+                fig_paths[field_str] = out_asset.path
+        return TaskTarget(map_in=freeze(in_asset),
+                          fig_paths=fig_paths,
+                          title=f"{title_start}, {split}:{sim_n}")
 
     def make_gnomview(self, some_map):
         fig = plt.figure(figsize=(8, 6))
@@ -143,3 +152,31 @@ class ShowSimsExecutor(BaseStageExecutor):
             norm='log'
         )
         hp.gnomview(some_map, **plot_params)
+
+
+def render_maps_per_field(task_target: TaskTarget):
+    tt = task_target
+    st: RenderSettings = get_settings()
+
+    some_map = tt.map_in.handler.read(tt.map_in.path)
+    for field_str, fig_path in tt.fig_paths.items():
+        field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
+        make_mollview(some_map[field_idx], st)
+        plt.suptitle(f"{tt.title} {field_str} Stokes")
+        # Saved in place; the file is not moved from the working directory, as names may be repeated across workers
+        make_directories(fig_path)
+        plt.savefig(fig_path)
+        plt.close()
+
+
+def make_mollview(some_map, st: RenderSettings):
+    fig = plt.figure(figsize=(8, 6))
+    plot_params = dict(
+        min=st.min_max[0], 
+        max=st.min_max[1],
+        rot=st.rot,
+        xsize=st.xsize,
+        cmap=planck_cmap.colombi1_cmap,
+        norm='log'
+    )
+    fig_render.mollview(some_map, **plot_params)
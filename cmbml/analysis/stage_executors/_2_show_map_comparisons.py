@@ -1,4 +1,5 @@
-from typing import List, Dict, Union
+from typing import List, Dict, Union, NamedTuple, Tuple
+from pathlib import Path
 import logging
 
 import numpy as np
@@ -19,11 +20,30 @@ from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap
 from cmbml.cmbnncs_local.handler_npymap import NumpyMap
 from cmbml.utils.planck_instrument import make_instrument, Instrument
 from cmbml.utils import planck_cmap
+from cmbml.utils import fig_render
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
 
 
+class TaskTarget(NamedTuple):
+    map_sim_in: FrozenAsset
+    map_other_in: FrozenAsset   # Preprocessed, predicted, or post-processed map
+    fig_paths: Dict[str, Path]  # By field
+    title: str                  # Start of each figure's title
+
+
+class RenderSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    min_max: Tuple
+    right_subplot_title: str
+
+
+# Width of the views, in pixels
+MOLL_XSIZE = 2400
+
+
 class ShowSimsExecutor(BaseStageExecutor):
     """
     Abstract.
@@ -48,6 +68,12 @@ class ShowSimsExecutor(BaseStageExecutor):
         self.min_max = self.get_plot_min_max()
         self.fig_model_name = cfg.fig_model_name
 
+        fig_ops = cfg.model.analysis.get("fig_operations", None)
+        self.num_processes = fig_ops.num_processes if fig_ops else 1
+
+        # Makes the figures for a task; children may change this
+        self.render_func = render_pair_per_field
+
     def get_plot_min_max(self):
         """
         Handles reading the minimum intensity and maximum intensity from cfg files
@@ -66,11 +92,24 @@ class ShowSimsExecutor(BaseStageExecutor):
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
-        self.default_execute()
+        tasks = []
+        for split in self.splits:
+            with self.name_tracker.set_context("split", split.name):
+                tasks.extend(self.build_tasks(split))
+        if len(tasks) == 0:
+            return
+
+        # The projection is computed once, here, and given to each worker
+        settings = RenderSettings(min_max=self.min_max, right_subplot_title=self.right_subplot_title)
+        grids = [fig_render.get_mollweide_grid(self.cfg.scenario.nside, xsize=MOLL_XSIZE)]
 
-    def process_split(self, 
-                      split: Split) -> None:
-        logger.info(f"Running {self.__class__.__name__} process_split() for split: {split.name}.")
+        logger.info(f"Rendering {len(tasks)} figure sets.")
+        run_tasks(self.render_func, tasks, settings, self.num_processes,
+                  initializer=fig_render.init_render_worker, initargs=(grids,))
+
+    def build_tasks(self, 
+                    split: Split) -> List[TaskTarget]:
+        logger.info(f"Running {self.__class__.__name__} build_tasks() for split: {split.name}.")
 
         # We may want to process a subset of all sims
         if self.override_sim_nums is None:
@@ -78,77 +117,36 @@ class ShowSimsExecutor(BaseStageExecutor):
         else:
             sim_iter = self.override_sim_nums
 
+        tasks = []
         for sim in sim_iter:
-        # for sim in tqdm(sim_iter):
             with self.name_tracker.set_context("sim_num", sim):
-                self.process_sim()
+                tasks.extend(self.build_sim_tasks())
+        return tasks
 
-    def process_sim(self):
-        raise NotImplementedError("This is intended to be an abstract class. process_sim() should be overwritten.")
+    def build_sim_tasks(self) -> List[TaskTarget]:
+        raise NotImplementedError("This is intended to be an abstract class. build_sim_tasks() should be overwritten.")
 
-    def make_maps_per_field(self, map_sim, map_prep, det, out_asset):
+    def build_a_task(self, map_sim_in, map_other_in, out_asset, title_start, fields) -> TaskTarget:
         split = self.name_tracker.context['split']
         sim_n = f"{self.name_tracker.context['sim_num']:0{self.cfg.file_system.sim_str_num_digits}d}"
+        fig_paths = {}
+        for field_str in fields:
+            with self.name_tracker.set_context("field", field_str):
+                out_asset.write()  # Make directory
+                fig_paths[field_str] = out_asset.path
+        return TaskTarget(map_sim_in=freeze(map_sim_in),
+                          map_other_in=freeze(map_other_in),
+                          fig_paths=fig_paths,
+                          title=f"{title_start}, {split}:{sim_n}")
+
+    def get_title_and_fields(self, det):
         if det == "cmb":
             title_start = "CMB Realization (Target)"
             fields = self.cfg.scenario.map_fields
         else:
             title_start = f"Observation, {det} GHz"
             fields = self.instrument.dets[det].fields
-        for field_str in fields:
-            with self.name_tracker.set_context("field", field_str):
-                field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
-                fig = plt.figure(figsize=(12, 6))
-                gs = gridspec.GridSpec(1, 3, width_ratios=[6, 3, 0.1], wspace=0.1)
-
-                (ax1, ax2, cbar_ax) = [plt.subplot(gs[i]) for i in [0,1,2]]
-
-                self.make_mollview(map_sim[field_idx], ax1)
-                self.make_imshow(map_prep[field_idx], ax2)
-
-                norm = plt.Normalize(vmin=self.min_max[0], vmax=self.min_max[1])
-                sm = plt.cm.ScalarMappable(cmap=planck_cmap.colombi1_cmap, norm=norm)
-                sm.set_array([])
-                fig.colorbar(sm, cax=cbar_ax)
-
-                self.save_figure(title_start, split, sim_n, field_str, out_asset)
-
-    def save_figure(self, title, split_name, sim_num, field_str, out_asset):
-        plt.suptitle(f"{title}, {split_name}:{sim_num} {field_str} Stokes")
-
-        fn = out_asset.path
-        out_asset.write()
-        plt.savefig(fn)
-        plt.close()
-
-    def make_imshow(self, some_map, ax):
-        plt.axes(ax)
-        plot_params = dict(
-            vmin=self.min_max[0],
-            vmax=self.min_max[1],
-            cmap=planck_cmap.colombi1_cmap,
-        )
-        plt.imshow(some_map, **plot_params)
-        plt.title(self.right_subplot_title)
-        ax.set_axis_off()
-        plt.colorbar
-
-    def make_mollview(self, some_map, ax, unit='\\mu \\text{K}_\\text{CMB}', min_or=None, max_or=None, show_cbar=False, title="Raw Simulation"):
-        plt.axes(ax)
-        vmin = self.min_max[0] if min_or is None else min_or
-        vmax = self.min_max[1] if max_or is None else max_or
-        plot_params = dict(
-            xsize=2400,
-            min=vmin, 
-            max=vmax,
-            unit=unit,
-            cmap=planck_cmap.colombi1_cmap,
-            hold=True,
-            cbar=show_cbar
-        )
-        hp.mollview(some_map, **plot_params)
-
-        plt.title(title)
+        return title_start, fields
 
 
 class ShowSimsPrepExecutor(ShowSimsExecutor):
@@ -170,15 +168,17 @@ class ShowSimsPrepExecutor(ShowSimsExecutor):
         in_cmb_map_handler: NumpyMap
         in_obs_map_handler: NumpyMap
 
-    def process_sim(self) -> None:
-        cmb_map_sim = self.in_cmb_map_sim.read()
-        cmb_map_prep = self.in_cmb_map_prep.read()
-        self.make_maps_per_field(cmb_map_sim, cmb_map_prep, det="cmb", out_asset=self.out_cmb_figure)
+    def build_sim_tasks(self) -> List[TaskTarget]:
+        tasks = []
+        title_start, fields = self.get_title_and_fields("cmb")
+        tasks.append(self.build_a_task(self.in_cmb_map_sim, self.in_cmb_map_prep, self.out_cmb_figure,
+                                       title_start, fields))
         for freq in self.instrument.dets:
             with self.name_tracker.set_context("freq", freq):
-                obs_map_sim = self.in_obs_map_sim.read()
-                obs_map_prep = self.in_obs_map_prep.read()
-                self.make_maps_per_field(obs_map_sim, obs_map_prep, det=freq, out_asset=self.out_obs_figure)
+                title_start, fields = self.get_title_and_fields(freq)
+                tasks.append(self.build_a_task(self.in_obs_map_sim, self.in_obs_map_prep, self.out_obs_figure,
+                                               title_start, fields))
+        return tasks
 
 
 class CMBNNCSShowSimsPredExecutor(ShowSimsExecutor):
@@ -196,16 +196,14 @@ class CMBNNCSShowSimsPredExecutor(ShowSimsExecutor):
         in_cmb_map_sim_handler: HealpyMap
         in_cmb_map_pred_handler: NumpyMap
 
-    def process_sim(self) -> None:
+    def build_sim_tasks(self) -> List[TaskTarget]:
+        tasks = []
+        title_start, fields = self.get_title_and_fields("cmb")
         for epoch in self.model_epochs:
-            logger.info(f"Creating map figures predictions, model epoch {epoch}")
             with self.name_tracker.set_context('epoch', epoch):
-                cmb_map_sim = self.in_cmb_map_sim.read()
-                cmb_map_prep = self.in_cmb_map_pred.read()
-                self.make_maps_per_field(cmb_map_sim, 
-                                         cmb_map_prep, 
-                                         det="cmb",
-                                         out_asset=self.out_cmb_figure)
+                tasks.append(self.build_a_task(self.in_cmb_map_sim, self.in_cmb_map_pred, self.out_cmb_figure,
+                                               title_start, fields))
+        return tasks
 
 
 class ShowSimsPostExecutor(ShowSimsExecutor):
@@ -222,59 +220,121 @@ class ShowSimsPostExecutor(ShowSimsExecutor):
         self.in_cmb_map_sim: Asset = self.assets_in["cmb_map_sim"]
         in_cmb_map_handler: HealpyMap
 
-    def process_sim(self) -> None:
+        self.render_func = render_post_per_field
+
+    def build_sim_tasks(self) -> List[TaskTarget]:
+        tasks = []
+        fields = self.cfg.scenario.map_fields
         for epoch in self.model_epochs:
             with self.name_tracker.set_context('epoch', epoch):
-                cmb_map_sim = self.in_cmb_map_sim.read()
-                cmb_map_post = self.in_cmb_map_post.read()
-                self.make_maps_per_field(cmb_map_sim, 
-                                         cmb_map_post, 
-                                         out_asset=self.out_cmb_figure)
+                tasks.append(self.build_a_task(self.in_cmb_map_sim, self.in_cmb_map_post, self.out_cmb_figure,
+                                               "CMB Predictions", fields))
+        return tasks
 
-    def make_maps_per_field(self, map_sim, map_post, out_asset):
-        """
-        Makes a figure for each field in the maps (e.g., IQU will result in 3 figures)
-        """
-        split = self.name_tracker.context['split']
-        sim_n = f"{self.name_tracker.context['sim_num']:0{self.cfg.file_system.sim_str_num_digits}d}"
-        fields = self.cfg.scenario.map_fields
 
-        for field_str in fields:
-            with self.name_tracker.set_context("field", field_str):
-                field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
-                fig = plt.figure(figsize=(30, 7), dpi=150)
-                gs = gridspec.GridSpec(1, 4, width_ratios=[6, 6, 6, 6], wspace=0.1)
+def render_pair_per_field(task_target: TaskTarget):
+    """
+    Makes a figure for each field: the simulation's map beside the other map (e.g. preprocessed).
+    """
+    tt = task_target
+    st: RenderSettings = get_settings()
+
+    map_sim = tt.map_sim_in.handler.read(tt.map_sim_in.path)
+    map_prep = tt.map_other_in.handler.read(tt.map_other_in.path)
+    for field_str, fig_path in tt.fig_paths.items():
+        field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
+        fig = plt.figure(figsize=(12, 6))
+        gs = gridspec.GridSpec(1, 3, width_ratios=[6, 3, 0.1], wspace=0.1)
+
+        (ax1, ax2, cbar_ax) = [plt.subplot(gs[i]) for i in [0,1,2]]
+
+        make_mollview(map_sim[field_idx], ax1, st)
+        make_imshow(map_prep[field_idx], ax2, st)
+
+        norm = plt.Normalize(vmin=st.min_max[0], vmax=st.min_max[1])
+        sm = plt.cm.ScalarMappable(cmap=planck_cmap.colombi1_cmap, norm=norm)
+        sm.set_array([])
+        fig.colorbar(sm, cax=cbar_ax)
+
+        save_figure(tt.title, field_str, fig_path)
+
 
-                axs = [plt.subplot(gs[i]) for i in range(4)]
+def render_post_per_field(task_target: TaskTarget):
+    """
+    Makes a figure for each field in the maps (e.g., IQU will result in 3 figures)
+    """
+    tt = task_target
+    st: RenderSettings = get_settings()
+
+    map_sim = tt.map_sim_in.handler.read(tt.map_sim_in.path)
+    map_post = tt.map_other_in.handler.read(tt.map_other_in.path)
+    for field_str, fig_path in tt.fig_paths.items():
+        field_idx = {'I': 0, 'Q': 1, 'U': 2}[field_str]
+        fig = plt.figure(figsize=(30, 7), dpi=150)
+        gs = gridspec.GridSpec(1, 4, width_ratios=[6, 6, 6, 6], wspace=0.1)
+
+        axs = [plt.subplot(gs[i]) for i in range(4)]
+
+        mask = map_sim[field_idx] == hp.UNSEEN
 
-                mask = map_sim[field_idx] == hp.UNSEEN
+        diff = map_post[field_idx] - map_sim[field_idx]
 
-                diff = map_post[field_idx] - map_sim[field_idx]
+        diff = hp.ma(diff)
+        diff.mask = mask
 
-                diff = hp.ma(diff)
-                diff.mask = mask
+        plot_params = dict(show_cbar=True, unit='$\\mu \\text{K}_\\text{CMB}$')
 
-                plot_params = dict(show_cbar=True, unit='$\\mu \\text{K}_\\text{CMB}$')
+        make_mollview(map_sim[field_idx], axs[0], st, title="Realization", **plot_params)
+        make_mollview(map_post[field_idx], axs[1], st, title="Prediction", **plot_params)
+        make_mollview(diff, axs[2], st, title="Difference", min_or=-120, max_or=120, **plot_params)
 
-                self.make_mollview(map_sim[field_idx], axs[0], title="Realization", **plot_params)
-                self.make_mollview(map_post[field_idx], axs[1], title="Prediction", **plot_params)
-                self.make_mollview(diff, axs[2], title="Difference", min_or=-120, max_or=120, **plot_params)
+        for ax in axs[:3]:
+            fig_render.graticule(ax, dpar=45, dmer=45)
 
-                # healpy applies the graticule to every subplot, so we only need to do it once; 
-                # if this were in self.make_mollview, earlier subplots will have multiple graticules applied.
-                hp.graticule(dpar=45, dmer=45)
+        n_bins = 50
 
-                n_bins = 50
+        plt.axes(axs[3])
+        plt.hist(diff.compressed(), bins=n_bins, range=(-120, 120), color="#524FA1", histtype='stepfilled')
+        axs[3].set_yticks([])
+        axs[3].set_xlabel("Deviation from Zero Difference ($\\mu \\text{K}_\\text{CMB}$)")
+        axs[3].set_ylabel("Pixel Count")
+        axs[3].set_title("Histogram of Difference")
+        for x in [-100, -50, 0, 50, 100]:
+            axs[3].axvline(x=x, color='black', linestyle='--', linewidth=0.5)
+        save_figure(tt.title, field_str, fig_path)
 
-                plt.axes(axs[3])
-                plt.hist(diff.compressed(), bins=n_bins, range=(-120, 120), color="#524FA1", histtype='stepfilled')
-                axs[3].set_yticks([])
-                axs[3].set_xlabel("Deviation from Zero Difference ($\\mu \\text{K}_\\text{CMB}$)")
-                axs[3].set_ylabel("Pixel Count")
-                axs[3].set_title("Histogram of Difference")
-                for x in [-100, -50, 0, 50, 100]:
-                    axs[3].axvline(x=x, color='black', linestyle='--', linewidth=0.5)
-                self.save_figure("CMB Predictions", split, sim_n, field_str, out_asset)
+
+def save_figure(title, field_str, fig_path):
+    plt.suptitle(f"{title} {field_str} Stokes")
+    plt.savefig(fig_path)
+    plt.close()
+
+
+def make_imshow(some_map, ax, st: RenderSettings):
+    plt.axes(ax)
+    plot_params = dict(
+        vmin=st.min_max[0],
+        vmax=st.min_max[1],
+        cmap=planck_cmap.colombi1_cmap,
+    )
+    plt.imshow(some_map, **plot_params)
+    plt.title(st.right_subplot_title)
+    ax.set_axis_off()
+
+
+def make_mollview(some_map, ax, st: RenderSettings, unit='\\mu \\text{K}_\\text{CMB}', min_or=None, max_or=None, show_cbar=False, title="Raw Simulation"):
+    vmin = st.min_max[0] if min_or is None else min_or
+    vmax = st.min_max[1] if max_or is None else max_or
+    plot_params = dict(
+        xsize=MOLL_XSIZE,
+        min=vmin, 
+        max=vmax,
+        unit=unit,
+        cmap=planck_cmap.colombi1_cmap,
+        cbar=show_cbar,
+        title=title
+    )
+    fig_render.mollview(some_map, ax, **plot_params)
 
 
 class CMBNNCSShowSimsPostExecutor(ShowSimsPostExecutor):
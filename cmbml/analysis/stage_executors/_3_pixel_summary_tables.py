@@ -8,7 +8,7 @@ import matplotlib.pyplot as plt
 from omegaconf import DictConfig
 
 from cmbml.core import BaseStageExecutor, Asset
-from cmbml.core.asset_handlers.asset_handlers_base import Config      # Import for typing hint
+from cmbml.core.asset_handlers.pd_table_handler import PandasTableHandler # Import for typing hint
 from cmbml.core.asset_handlers.pd_csv_handler import PandasCsvHandler # Import for typing hint
 
 logger = logging.getLogger(__name__)
@@ -25,9 +25,11 @@ class PixelSummaryExecutor(BaseStageExecutor):
         out_stats_per_split_handler: PandasCsvHandler
 
         self.in_report: Asset = self.assets_in["report"]
-        in_report_handler: Config
+        in_report_handler: PandasTableHandler
 
         self.labels_lookup = self.get_labels_lookup()
+        # Only these columns are read from the report
+        self.report_columns = ['split', 'sim', 'epoch', *self.labels_lookup.keys()]
 
     def get_labels_lookup(self):
         lookup = dict(self.cfg.model.analysis.px_functions)
@@ -35,7 +37,7 @@ class PixelSummaryExecutor(BaseStageExecutor):
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
-        report_contents = self.in_report.read()
+        report_contents = self.in_report.read(columns=self.report_columns)
         df = pd.DataFrame(report_contents)
 
         df = self.sort_order(df)
@@ -14,6 +14,7 @@ from cmbml.core import (BaseStageExecutor,
 from cmbml.core.asset_handlers.asset_handlers_base import EmptyHandler
 from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
 from cmbml.core.asset_handlers.pd_csv_handler import PandasCsvHandler
+from cmbml.core.asset_handlers.pd_table_handler import PandasTableHandler
 
 logger = logging.getLogger(__name__)
 
@@ -25,11 +26,18 @@ class PowerSpectrumSummaryExecutor(BaseStageExecutor):
         out_ps_stats_handlers: PandasCsvHandler
 
         self.in_ps_report: Asset = self.assets_in["report"]
-        in_ps_report_handler: PandasCsvHandler
+        in_ps_report_handler: PandasTableHandler
+        # Only these columns are read from the report
+        self.report_columns = ['sim', 'epoch', 'baseline', *cfg.model.analysis.ps_functions.keys()]
+        # ps_analysis adds the cross-spectrum metrics if it reads cross spectra (see the pipeline yaml)
+        cross_func_dict = cfg.model.analysis.get("ps_cross_functions", None) or {}
+        ps_analysis_in = cfg.pipeline.get("ps_analysis", {}).get("assets_in", {})
+        if "x_real_pred" in ps_analysis_in:
+            self.report_columns.extend(cross_func_dict.keys())
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute()")
-        df = self.in_ps_report.read()
+        df = self.in_ps_report.read(columns=self.report_columns)
         # print(df.info())
         df['epoch'] = df['epoch'].astype(str)
         df['epoch'] = df['epoch'].replace("nan", "")
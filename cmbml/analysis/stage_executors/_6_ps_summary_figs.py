@@ -13,7 +13,7 @@ from cmbml.core import (
     GenericHandler,
     )
 from cmbml.core.asset_handlers.asset_handlers_base import EmptyHandler # Import for typing hint
-from cmbml.core.asset_handlers.asset_handlers_base import Config # Import for typing hint
+from cmbml.core.asset_handlers.pd_table_handler import PandasTableHandler # Import for typing hint
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +24,7 @@ class PowerSpectrumSummaryFigsExecutor(BaseStageExecutor):
         super().__init__(cfg, stage_str="ps_summary_figs")
 
         self.in_report: Asset = self.assets_in["report"]
-        in_report_handler: Config
+        in_report_handler: PandasTableHandler
 
         self.out_boxplots: Asset = self.assets_out["boxplots"]
         self.out_histogram: Asset = self.assets_out["histogram"]
@@ -32,6 +32,8 @@ class PowerSpectrumSummaryFigsExecutor(BaseStageExecutor):
         out_histogram_handler: EmptyHandler
 
         self.labels_lookup = self.get_labels_lookup()
+        # Only these columns are read from the report
+        self.report_columns = ['split', 'sim', 'epoch', 'baseline', *self.labels_lookup.keys()]
         self.fig_model_name = cfg.fig_model_name
 
     def get_labels_lookup(self):
@@ -40,7 +42,7 @@ class PowerSpectrumSummaryFigsExecutor(BaseStageExecutor):
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute().")
-        report_contents = self.in_report.read()
+        report_contents = self.in_report.read(columns=self.report_columns)
         df = pd.DataFrame(report_contents)
 
         df = self.sort_order(df)
@@ -1,4 +1,5 @@
-from typing import Union
+from typing import Union, List, NamedTuple
+from pathlib import Path
 import logging
 
 import numpy as np
@@ -18,7 +19,9 @@ from cmbml.core import (
     )
 
 from cmbml.core.asset_handlers.asset_handlers_base import EmptyHandler # Import for typing hint
-from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrum, NumpyPowerSpectrumStack
+from cmbml.utils.fig_render import init_render_worker
+from cmbml.utils.worker_pool import FrozenAsset, freeze, get_settings, run_tasks
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +34,21 @@ GREEN = "#00A651"
 YELLOW = "#FDB913"
 
 
+class TaskTarget(NamedTuple):
+    ps_real_in: FrozenAsset
+    ps_pred_in: FrozenAsset
+    ps_theory_in: FrozenAsset   # None if the split's theory spectrum is fixed (in FigSettings)
+    ps_theory: np.ndarray       # None unless read from the split's theory_ps_stack
+    fig_path: Path
+    title: str
+
+
+class FigSettings(NamedTuple):
+    # Shared by all tasks (see worker_pool)
+    ps_theory: np.ndarray       # None unless the split's theory spectrum is fixed
+    wmap_band: List
+
+
 class PostAnalysisPsFigExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following string must match the pipeline yaml
@@ -41,6 +59,9 @@ class PostAnalysisPsFigExecutor(BaseStageExecutor):
         out_ps_figure_handler: EmptyHandler
 
         self.in_ps_theory: AssetWithPathAlts = self.assets_in["theory_ps"]
+        # Optional: the theory spectra of each split in one file (see convert_theory_ps)
+        self.in_ps_theory_stack: Asset = self.assets_in.get("theory_ps_stack", None)
+        in_ps_theory_stack_handler: NumpyPowerSpectrumStack
         self.in_ps_real: Asset = self.assets_in["auto_real"]
         self.in_ps_pred: Asset = self.assets_in["auto_pred"]
         self.in_wmap_ave: Asset = self.assets_in["wmap_ave"]
@@ -51,6 +72,9 @@ class PostAnalysisPsFigExecutor(BaseStageExecutor):
 
         self.fig_model_name = cfg.fig_model_name
 
+        fig_ops = cfg.model.analysis.get("fig_operations", None)
+        self.num_processes = fig_ops.num_processes if fig_ops else 1
+
     def execute(self) -> None:
         # Remove this function
         logger.debug(f"Running {self.__class__.__name__} execute()")
@@ -73,150 +97,46 @@ class PostAnalysisPsFigExecutor(BaseStageExecutor):
             ps_theory = self.in_ps_theory.read(use_alt_path=True)
         else:
             ps_theory = None
-        
+        # The split's theory spectra by sim, if read from one file (see convert_theory_ps)
+        theory_lookup = None
+        if ps_theory is None and self.in_ps_theory_stack is not None:
+            theory_lookup = self.in_ps_theory_stack.handler.read_lookup(self.in_ps_theory_stack.path)
+
+        # The WMAP band is the same for every figure; it is read once and given to each worker
+        wmap_ave = self.in_wmap_ave.read()
+        wmap_std = self.in_wmap_std.read()
+        wmap_band = [(wmap_ave - wmap_std, wmap_ave + wmap_std), (wmap_ave - 2*wmap_std, wmap_ave + 2*wmap_std)]
+        settings = FigSettings(ps_theory=ps_theory, wmap_band=wmap_band)
+
+        tasks = []
         for sim in sim_iter:
-            print(f"Processing split {split.name}, sim {sim}")
             with self.name_tracker.set_context("sim_num", sim):
-                self.process_sim(ps_theory)
+                tasks.extend(self.build_sim_tasks(fixed_theory=ps_theory is not None,
+                                                  theory_lookup=theory_lookup))
 
-    def process_sim(self, ps_theory) -> None:
-        for epoch in self.model_epochs:
-            with self.name_tracker.set_context("epoch", epoch):
-                self.process_epoch(ps_theory)
+        logger.info(f"Making {len(tasks)} figures.")
+        run_tasks(render_ps_figure, tasks, settings, self.num_processes,
+                  initializer=init_render_worker)
 
-    def process_epoch(self, ps_theory) -> None:
-        epoch = self.name_tracker.context['epoch']
+    def build_sim_tasks(self, fixed_theory, theory_lookup=None) -> List[TaskTarget]:
+        tasks = []
         split = self.name_tracker.context['split']
         sim_num = self.name_tracker.context['sim_num']
-        ps_real = self.in_ps_real.read()
-        ps_pred = self.in_ps_pred.read()
-
-        if ps_theory is None:
-            ps_theory = self.in_ps_theory.read(use_alt_path=False)
-
-        wmap_ave = self.in_wmap_ave.read()
-        wmap_std = self.in_wmap_std.read()
-
-        wmap_band = [(wmap_ave - wmap_std, wmap_ave + wmap_std), (wmap_ave - 2*wmap_std, wmap_ave + 2*wmap_std)]
-
-        self.make_ps_figure(ps_real, ps_pred, ps_theory, wmap_band, baseline="theory")
-        title = self.make_title(epoch, split, sim_num)
-        plt.suptitle(title)
-        self.out_ps_figure_theory.write()
-        fn = self.out_ps_figure_theory.path
-        print(f'writing to {fn}')
-        plt.savefig(fn)
-        plt.close()
-
-    def make_ps_figure(self, ps_real, ps_pred, ps_theory, wmap_band, baseline="theory"):
-        n_ells = ps_real.shape[0] - 2
-        ells = np.arange(1, n_ells+1)
-
-        pred_conved = ps_pred
-        real_conved = ps_real
-
-        fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 6))
-
-        thry_params = dict(color=BLACK, label='Theory')
-        real_params = dict(color=RED, label='Realization')
-        pred_params = dict(color=PURBLUE, label='Prediction')
-        wmap1_params = dict(color=GREEN, alpha=0.25, label='1$\\sigma$ WMAP')
-        wmap2_params = dict(color=GREEN, alpha=0.50, label='2$\\sigma$ WMAP')
-
-        ells = ells[2:n_ells]
-        wmap1_lower = wmap_band[0][0][2:n_ells]
-        wmap1_upper = wmap_band[0][1][2:n_ells]
-        wmap2_lower = wmap_band[1][0][2:n_ells]
-        wmap2_upper = wmap_band[1][1][2:n_ells]
-        ps_theory = ps_theory[2:n_ells]
-        real_conved = real_conved[2:n_ells]
-        pred_conved = pred_conved[2:n_ells]
-        self.abs_panel(ax1, ells, real_conved, pred_conved, ps_theory, 
-                       wmap1_lower, wmap1_upper, wmap2_lower, wmap2_upper, 
-                       thry_params, real_params, pred_params, wmap1_params, wmap2_params)
-        horz_params = dict(linestyle='--', linewidth=0.5)
-        if baseline == "theory":
-            horz_params = {'label': 'Theory', 'color': BLACK, **horz_params}
-            deltas1 = (real_conved - ps_theory) / ps_theory * 100
-            deltas1_params = real_params
-            deltas2 = (pred_conved - ps_theory) / ps_theory * 100
-            deltas2_params = pred_params
-        elif baseline == "real":
-            horz_params = {'label': 'Realization', 'color': RED, **horz_params}
-            deltas1 = ps_theory - real_conved
-            deltas1_params = thry_params
-            deltas2 = pred_conved - real_conved
-            deltas2_params = pred_params
+        if theory_lookup is not None:
+            ps_theory_in, ps_theory = None, theory_lookup(sim_num)
         else:
-            raise ValueError("Baseline must be 'real' or 'theory'")
-        ylabel = '$\\%\\Delta D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$'
-        self.rel_panel(ax2, ells, ylabel, deltas1, deltas2, 
-                       deltas1_params, deltas2_params, horz_params)
-
-    def abs_panel(self, ax, ells, real_conved, pred_conved, ps_theory, 
-                  wmap1_lower, wmap1_upper, wmap2_lower, wmap2_upper, 
-                  thry_params, real_params, pred_params, wmap1_params, wmap2_params):
-        # TODO: refactor
-        # Upper panel
-        marker_size = 5
-        ax.fill_between(ells, wmap1_lower, wmap1_upper, **wmap1_params)
-        ax.fill_between(ells, wmap2_lower, wmap2_upper, **wmap2_params)
-        ax.plot(ells, ps_theory, **thry_params)
-        # ax.scatter(ells,real_conved, s=marker_size, **real_params)
-        ax.scatter(ells, pred_conved, s=marker_size, **pred_params)
-        ax.set_ylabel('$D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
-        # ax1.set_ylabel(r'$\ell(\ell+1)C_\ell/(2\pi)$ $\;$ [$\mu K^2$]')
-        ax.set_ylim(-300, 6500)
-        ax.legend()
-
-    def rel_panel(self, ax, ells, ylabel, deltas1, deltas2, 
-                  deltas1_params, deltas2_params, horz_params):
-        # TODO: refactor
-        # Lower panel
-        marker_size = 5
-        bin_width = 30
-
-        bin_centers1, binned_means1, binned_stds1 = self.bin_data(ells, deltas1, bin_width)
-        bin_centers2, binned_means2, binned_stds2 = self.bin_data(ells, deltas2, bin_width)
-
-        # Lower panel
-        ax.axhline(0, **horz_params)
-        # ax.errorbar(bin_centers1, binned_means1, yerr=binned_stds1, fmt='o', markersize=marker_size, **deltas1_params)
-        ax.errorbar(bin_centers2, binned_means2, yerr=binned_stds2, fmt='o', markersize=marker_size, **deltas2_params)
-        ax.set_xlabel('$\\ell$')
-        ax.set_ylabel(ylabel)
-        ax.set_ylim(-50, 50)
-        # ax.legend(loc='upper right')
-
-    def bin_data(self, ells, deltas, bin_width):
-        # Calculate the bin edges
-        bin_edges = np.arange(min(ells), max(ells) + bin_width, bin_width)
-        # Digitize the ells data to find out which bin each value belongs to
-        bin_indices = np.digitize(ells, bin_edges)
-        # Calculate the mean and standard deviation of deltas values within each bin
-        binned_means = []
-        binned_stds = []
-        for i in range(1, len(bin_edges)):
-            bin_values = deltas[bin_indices == i]
-            binned_means.append(np.mean(bin_values))
-            binned_stds.append(np.std(bin_values))
-        # Calculate the center of each bin for plotting purposes
-        bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-        return bin_centers, binned_means, binned_stds
-
-    # def rel_panel(self, ax, ells, ylabel, scatter1, scatter2, 
-    #               scatter1_params, scatter2_params, horz_params):
-    #     # TODO: refactor
-    #     # Lower panel
-    #     marker_size = 5
-
-    #     ax.axhline(0, **horz_params)
-    #     ax.scatter(ells, scatter1, s=marker_size, **scatter1_params)
-    #     ax.scatter(ells, scatter2, s=marker_size, **scatter2_params)
-    #     ax.set_xlabel('$\\ell$')
-    #     ax.set_ylabel(ylabel)
-    #     ax.set_ylim(-1250,1250)
-    #     ax.legend(loc='upper right')
+            ps_theory_in = None if fixed_theory else freeze(self.in_ps_theory)
+            ps_theory = None
+        for epoch in self.model_epochs:
+            with self.name_tracker.set_context("epoch", epoch):
+                self.out_ps_figure_theory.write()  # Make directory
+                tasks.append(TaskTarget(ps_real_in=freeze(self.in_ps_real),
+                                        ps_pred_in=freeze(self.in_ps_pred),
+                                        ps_theory_in=ps_theory_in,
+                                        ps_theory=ps_theory,
+                                        fig_path=self.out_ps_figure_theory.path,
+                                        title=self.make_title(epoch, split, sim_num)))
+        return tasks
 
     def make_title(self, epoch, split, sim_num):
         if epoch != "":
@@ -224,3 +144,138 @@ class PostAnalysisPsFigExecutor(BaseStageExecutor):
         else:
             e_phrase = ""
         return f"{self.fig_model_name} Predictions{e_phrase}, {split}:{sim_num}"
+
+
+def render_ps_figure(task_target: TaskTarget):
+    tt = task_target
+    st: FigSettings = get_settings()
+
+    ps_real = tt.ps_real_in.handler.read(tt.ps_real_in.path)
+    ps_pred = tt.ps_pred_in.handler.read(tt.ps_pred_in.path)
+    if tt.ps_theory is not None:
+        ps_theory = tt.ps_theory
+    elif tt.ps_theory_in is None:
+        ps_theory = st.ps_theory
+    else:
+        ps_theory = tt.ps_theory_in.handler.read(tt.ps_theory_in.path)
+
+    make_ps_figure(ps_real, ps_pred, ps_theory, st.wmap_band, baseline="theory")
+    plt.suptitle(tt.title)
+    logger.debug(f'writing to {tt.fig_path}')
+    plt.savefig(tt.fig_path)
+    plt.close()
+
+
+def make_ps_figure(ps_real, ps_pred, ps_theory, wmap_band, baseline="theory"):
+    n_ells = ps_real.shape[0] - 2
+    ells = np.arange(1, n_ells+1)
+
+    pred_conved = ps_pred
+    real_conved = ps_real
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]}, figsize=(10, 6))
+
+    thry_params = dict(color=BLACK, label='Theory')
+    real_params = dict(color=RED, label='Realization')
+    pred_params = dict(color=PURBLUE, label='Prediction')
+    wmap1_params = dict(color=GREEN, alpha=0.25, label='1$\\sigma$ WMAP')
+    wmap2_params = dict(color=GREEN, alpha=0.50, label='2$\\sigma$ WMAP')
+
+    ells = ells[2:n_ells]
+    wmap1_lower = wmap_band[0][0][2:n_ells]
+    wmap1_upper = wmap_band[0][1][2:n_ells]
+    wmap2_lower = wmap_band[1][0][2:n_ells]
+    wmap2_upper = wmap_band[1][1][2:n_ells]
+    ps_theory = ps_theory[2:n_ells]
+    real_conved = real_conved[2:n_ells]
+    pred_conved = pred_conved[2:n_ells]
+    abs_panel(ax1, ells, real_conved, pred_conved, ps_theory, 
+              wmap1_lower, wmap1_upper, wmap2_lower, wmap2_upper, 
+              thry_params, real_params, pred_params, wmap1_params, wmap2_params)
+    horz_params = dict(linestyle='--', linewidth=0.5)
+    if baseline == "theory":
+        horz_params = {'label': 'Theory', 'color': BLACK, **horz_params}
+        deltas1 = (real_conved - ps_theory) / ps_theory * 100
+        deltas1_params = real_params
+        deltas2 = (pred_conved - ps_theory) / ps_theory * 100
+        deltas2_params = pred_params
+    elif baseline == "real":
+        horz_params = {'label': 'Realization', 'color': RED, **horz_params}
+        deltas1 = ps_theory - real_conved
+        deltas1_params = thry_params
+        deltas2 = pred_conved - real_conved
+        deltas2_params = pred_params
+    else:
+        raise ValueError("Baseline must be 'real' or 'theory'")
+    ylabel = '$\\%\\Delta D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$'
+    rel_panel(ax2, ells, ylabel, deltas1, deltas2, 
+              deltas1_params, deltas2_params, horz_params)
+
+
+def abs_panel(ax, ells, real_conved, pred_conved, ps_theory, 
+              wmap1_lower, wmap1_upper, wmap2_lower, wmap2_upper, 
+              thry_params, real_params, pred_params, wmap1_params, wmap2_params):
+    # TODO: refactor
+    # Upper panel
+    marker_size = 5
+    ax.fill_between(ells, wmap1_lower, wmap1_upper, **wmap1_params)
+    ax.fill_between(ells, wmap2_lower, wmap2_upper, **wmap2_params)
+    ax.plot(ells, ps_theory, **thry_params)
+    # ax.scatter(ells,real_conved, s=marker_size, **real_params)
+    ax.scatter(ells, pred_conved, s=marker_size, **pred_params)
+    ax.set_ylabel('$D_{\ell}^\\text{TT} [\\mu \\text{K}^2]$')
+    # ax1.set_ylabel(r'$\ell(\ell+1)C_\ell/(2\pi)$ $\;$ [$\mu K^2$]')
+    ax.set_ylim(-300, 6500)
+    ax.legend()
+
+
+def rel_panel(ax, ells, ylabel, deltas1, deltas2, 
+              deltas1_params, deltas2_params, horz_params):
+    # TODO: refactor
+    # Lower panel
+    marker_size = 5
+    bin_width = 30
+
+    bin_centers1, binned_means1, binned_stds1 = bin_data(ells, deltas1, bin_width)
+    bin_centers2, binned_means2, binned_stds2 = bin_data(ells, deltas2, bin_width)
+
+    # Lower panel
+    ax.axhline(0, **horz_params)
+    # ax.errorbar(bin_centers1, binned_means1, yerr=binned_stds1, fmt='o', markersize=marker_size, **deltas1_params)
+    ax.errorbar(bin_centers2, binned_means2, yerr=binned_stds2, fmt='o', markersize=marker_size, **deltas2_params)
+    ax.set_xlabel('$\\ell$')
+    ax.set_ylabel(ylabel)
+    ax.set_ylim(-50, 50)
+    # ax.legend(loc='upper right')
+
+
+def bin_data(ells, deltas, bin_width):
+    # Calculate the bin edges
+    bin_edges = np.arange(min(ells), max(ells) + bin_width, bin_width)
+    # Digitize the ells data to find out which bin each value belongs to
+    bin_indices = np.digitize(ells, bin_edges)
+    # Calculate the mean and standard deviation of deltas values within each bin
+    binned_means = []
+    binned_stds = []
+    for i in range(1, len(bin_edges)):
+        bin_values = deltas[bin_indices == i]
+        binned_means.append(np.mean(bin_values))
+        binned_stds.append(np.std(bin_values))
+    # Calculate the center of each bin for plotting purposes
+    bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
+    return bin_centers, binned_means, binned_stds
+
+
+# def rel_panel(ax, ells, ylabel, scatter1, scatter2, 
+#               scatter1_params, scatter2_params, horz_params):
+#     # TODO: refactor
+#     # Lower panel
+#     marker_size = 5
+
+#     ax.axhline(0, **horz_params)
+#     ax.scatter(ells, scatter1, s=marker_size, **scatter1_params)
+#     ax.scatter(ells, scatter2, s=marker_size, **scatter2_params)
+#     ax.set_xlabel('$\\ell$')
+#     ax.set_ylabel(ylabel)
+#     ax.set_ylim(-1250,1250)
+#     ax.legend(loc='upper right')
@@ -36,7 +36,10 @@ class Config(GenericHandler):
             data = yaml.safe_load(infile)
         return data
 
-    def write(self, path, data, verbose=True) -> None:
+    def write(self, path, data, verbose=True, append=False) -> None:
+        """
+        With append=True, data (a list) is added to the list already in the file.
+        """
         if verbose:
             logger.debug(f"Writing config to '{path}'")
         make_directories(path)
@@ -47,7 +50,7 @@ class Config(GenericHandler):
         yaml_string = yaml.dump(unnumpy_data, default_flow_style=False)
         if "\[" in yaml_string and "\]" in yaml_string:
             yaml_string = yaml_string.replace("\[", "[").replace("\]", "]")
-        with open(path, 'w') as outfile:
+        with open(path, 'a' if append else 'w') as outfile:
             outfile.write(yaml_string)
 
 
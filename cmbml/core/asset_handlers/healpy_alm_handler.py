@@ -0,0 +1,66 @@
+from typing import List, Union
+from pathlib import Path
+import logging
+
+import numpy as np
+import healpy as hp
+from astropy.io import fits
+
+from cmbml.core.asset_handlers import GenericHandler, make_directories
+from .asset_handler_registration import register_handler
+
+
+logger = logging.getLogger(__name__)
+
+
+class HealpyAlm(GenericHandler):
+    """
+    Spherical harmonic coefficients (a_lm), in healpy ordering, one field per HDU.
+
+    Precision follows the data: complex64 is stored as float32. The lmax is
+    recorded in the file by healpy's index column.
+    """
+    def read(self,
+             path: Union[Path, str],
+             lmax: int=None,
+             precision: str=None) -> np.ndarray:
+        """
+        Returns alms with shape (n_fields, n_alm).
+
+        If lmax is given, alms stored to a higher lmax are truncated.
+        """
+        path = Path(path)
+        try:
+            with fits.open(path) as hdul:
+                n_fields = len(hdul) - 1
+        except FileNotFoundError as e:
+            raise FileNotFoundError(f"This alm file cannot be found: {path}")
+        alms = [hp.read_alm(path, hdu=hdu) for hdu in range(1, n_fields + 1)]
+        alms = np.stack(alms, axis=0)
+
+        file_lmax = hp.Alm.getlmax(alms.shape[-1])
+        if lmax is not None and lmax != file_lmax:
+            if lmax > file_lmax:
+                raise ValueError(f"Alms in {path} are stored to lmax {file_lmax}; lmax {lmax} was requested.")
+            alms = np.stack([hp.resize_alm(alm, file_lmax, file_lmax, lmax, lmax) for alm in alms], axis=0)
+        if precision == "float":
+            alms = alms.astype(np.complex64)
+        return alms
+
+    def write(self,
+              path: Union[Path, str],
+              data: Union[List[np.ndarray], np.ndarray],
+              overwrite: bool = True
+              ) -> None:
+        data = np.atleast_2d(data)
+        out_dtype = np.float32 if data.dtype == np.complex64 else np.float64
+
+        path = Path(path)
+        make_directories(path)
+        hp.write_alm(filename=str(path),
+                     alms=[alm.astype(np.complex128) for alm in data],
+                     out_dtype=out_dtype,
+                     overwrite=overwrite)
+
+
+register_handler("HealpyAlm", HealpyAlm)
@@ -0,0 +1,38 @@
+from typing import Dict, List, Union
+from pathlib import Path
+import logging
+
+import numpy as np
+
+from cmbml.core.asset_handlers import GenericHandler, make_directories
+from .asset_handler_registration import register_handler
+
+
+logger = logging.getLogger(__name__)
+
+
+class NumpyColumnsHandler(GenericHandler):
+    """
+    A table of named columns, stored as a single .npz file.
+    """
+    def read(self, 
+             path: Union[Path, str], 
+             columns: List[str]=None
+             ) -> Dict[str, np.ndarray]:
+        logger.debug(f"Reading columns from '{path}'")
+        with np.load(path) as npz:
+            if columns is None:
+                columns = npz.files
+            res = {col: npz[col] for col in columns}
+        return res
+
+    def write(self, 
+              path: Union[Path, str], 
+              data: Dict[str, Union[List, np.ndarray]]
+              ) -> None:
+        logger.debug(f"Writing columns to '{path}'")
+        make_directories(path)
+        np.savez(path, **{col: np.asarray(values) for col, values in data.items()})
+
+
+register_handler("NumpyColumns", NumpyColumnsHandler)
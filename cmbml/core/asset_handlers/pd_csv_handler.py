@@ -20,13 +20,19 @@ class PandasCsvHandler(GenericHandler):
     def write(self, 
               path: Union[Path, str], 
               data: Union[dict, pd.DataFrame],
-              index: bool=False
+              index: bool=False,
+              append: bool=False
               ):
+        """
+        With append=True, rows are added to the file, without a header.
+        Their columns must be in the file's order.
+        """
         make_directories(path)
+        mode = 'a' if append else 'w'
         try:
-            data.to_csv(path, index=index)
+            data.to_csv(path, index=index, mode=mode, header=not append)
         except:
-            pd.DataFrame(data).to_csv(path, index=index)
+            pd.DataFrame(data).to_csv(path, index=index, mode=mode, header=not append)
 
 
 register_handler("PandasCsvHandler", PandasCsvHandler)
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional, Union
+from pathlib import Path
+import logging
+
+import pandas as pd
+
+from cmbml.core.asset_handlers import GenericHandler, make_directories
+from .asset_handler_registration import register_handler
+
+
+logger = logging.getLogger(__name__)
+
+
+# Rows appended to a parquet file are buffered, then written as a row group of this size
+ROW_GROUP_SIZE = 1024
+
+
+def _have_pyarrow():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+class PandasTableHandler(GenericHandler):
+    """
+    A table of results (e.g. an analysis report), stored as parquet.
+
+    Reading can be limited to some columns, which parquet reads without
+    parsing the rest of the file. Rows can be appended; they are written in
+    row groups, and the file is complete once close() is called.
+
+    Without pyarrow (the "parquet" extra), the table is stored as csv instead, next to
+    the parquet path (e.g. report.csv for report.parquet), with a warning. Reading uses whichever exists.
+
+    Columns are fixed by the first rows written; rows appended later may omit 
+    columns, but may not add any. Use make_table() to give every batch the same columns.
+    """
+    def __init__(self) -> None:
+        # Open parquet writers, their schemas, and buffered rows, per path
+        self._writers: Dict[Path, object] = {}
+        self._buffers: Dict[Path, List[pd.DataFrame]] = {}
+
+    def read(self,
+             path: Union[Path, str],
+             columns: List[str]=None
+             ) -> pd.DataFrame:
+        path = Path(path)
+        csv_path = path.with_suffix(".csv")
+        if path.exists() and path.suffix != ".csv":
+            return pd.read_parquet(path, columns=columns)
+        if csv_path.exists():
+            return pd.read_csv(csv_path, usecols=columns)
+        raise FileNotFoundError(f"This table cannot be found: {path} (or {csv_path.name})")
+
+    def write(self,
+              path: Union[Path, str],
+              data: Union[Dict, List[Dict], pd.DataFrame],
+              append: bool=False
+              ) -> None:
+        """
+        Writes a table. With append=True, rows are added to the table already
+        being written (columns of later rows follow the first rows).
+        """
+        path = Path(path)
+        make_directories(path)
+        df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+        if not (_have_pyarrow() and path.suffix != ".csv"):
+            if not append and path.suffix != ".csv":
+                logger.warning(f"pyarrow is not installed, so {path.name} is written as csv instead "
+                               f"(install cmbml[parquet] for parquet).")
+            self._write_csv(path.with_suffix(".csv"), df, append)
+            return
+
+        if not append:
+            self.close(path)
+            df.to_parquet(path, index=False)
+            return
+
+        buffer = self._buffers.setdefault(path, [])
+        buffer.append(df)
+        if sum(len(d) for d in buffer) >= ROW_GROUP_SIZE:
+            self._flush(path)
+
+    def close(self, path: Union[Path, str]) -> None:
+        """
+        Writes any buffered rows and completes the file. Not needed for csv.
+        """
+        path = Path(path)
+        if path in self._buffers:
+            self._flush(path)
+        writer = self._writers.pop(path, None)
+        if writer is not None:
+            writer[0].close()
+
+    def _flush(self, path: Path) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        buffer = self._buffers.pop(path, [])
+        if len(buffer) == 0:
+            return
+        if path not in self._writers and path.exists():
+            # Appending to a complete file; its rows become the first row group
+            existing = pd.read_parquet(path)
+            for df in buffer:
+                check_columns(df, existing.columns, path)
+            buffer.insert(0, existing)
+        df = pd.concat(buffer, ignore_index=True)
+        if path not in self._writers:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            self._writers[path] = (pq.ParquetWriter(path, schema), schema)
+        writer, schema = self._writers[path]
+        check_columns(df, schema.names, path)
+        df = df.reindex(columns=schema.names)
+        writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+    @staticmethod
+    def _write_csv(path: Path, df: pd.DataFrame, append: bool) -> None:
+        if append and path.exists():
+            # Follow the columns already in the file
+            columns = pd.read_csv(path, nrows=0).columns
+            check_columns(df, columns, path)
+            df.reindex(columns=columns).to_csv(path, index=False, mode='a', header=False)
+        else:
+            df.to_csv(path, index=False)
+
+    def __getstate__(self):
+        # Open writers stay with the process that opened them
+        return {'_writers': {}, '_buffers': {}}
+
+
+def check_columns(df: pd.DataFrame, columns: List[str], path: Path) -> None:
+    extra = [column for column in df.columns if column not in set(columns)]
+    if extra:
+        raise ValueError(f"Columns {extra} are not in {path}, which has columns {list(columns)}.")
+
+
+def make_table(rows: Union[List[Dict], pd.DataFrame], columns: Dict[str, Optional[str]]) -> pd.DataFrame:
+    """
+    Rows as a table with exactly the given columns, in order. Columns absent 
+    from the rows are empty. Each column has the dtype given (e.g. 'float64', 'string'), 
+    or, for None, the dtype of its values, so that batches of rows written to one
+    table have the same columns and types even if a batch is, e.g., only errors.
+    """
+    df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+    extra = [column for column in df.columns if column not in columns]
+    if extra:
+        raise ValueError(f"Rows have columns {extra}, which are not among the table's columns {list(columns)}.")
+    df = df.reindex(columns=list(columns))
+    return df.astype({column: dtype for column, dtype in columns.items() if dtype is not None})
+
+
+register_handler("PandasTable", PandasTableHandler)
@@ -1,9 +1,10 @@
+from typing import Iterable, Tuple, Union
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 
 import camb
+from camb.results import save_cmb_power_array
 
 from cmbml.core.asset_handlers import GenericHandler, make_directories
 from .asset_handler_registration import register_handler
@@ -13,6 +14,33 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Columns written by CAMBdata.save_cmb_power_spectra(), after the L column
+CAMB_PS_COLUMNS = ["TT", "EE", "BB", "TE", "PP", "PT", "PE"]
+
+
+def read_camb_ps_text(path: Path) -> Tuple[list, np.ndarray]:
+    """
+    Parses CAMB's power spectrum text format: a commented header line of column
+    names, then whitespace-separated numbers.
+
+    Numbers are parsed by numpy in a single pass, which is much faster than
+    pandas for these files.
+
+    Returns:
+    list: The column names (e.g. 'L', 'TT', ...).
+    np.ndarray: The table, (n_rows, n_columns).
+    """
+    with open(path, 'r') as file:
+        columns = file.readline().strip().lstrip('#').split()
+        text = file.read()
+    if '#' in text:
+        text = "\n".join(line for line in text.splitlines() if not line.lstrip().startswith('#'))
+    values = np.fromstring(text, dtype=np.float64, sep=' ')
+    if values.size % len(columns) != 0:
+        raise ValueError(f"Could not parse {path}: {values.size} values do not fill {len(columns)} columns.")
+    return columns, values.reshape(-1, len(columns))
+
+
 class CambPowerSpectrum(GenericHandler):
     def read(self, path: Path, TT_only=True) -> None:
         """
@@ -21,28 +49,27 @@ class CambPowerSpectrum(GenericHandler):
         Reading CAMB's power spectra for simulation is performed by
            a PySM3 method. We simply provide it with the filepath.
         """
-        with open(path, 'r') as file:
-            header_line = file.readline().strip().lstrip('#').split()
-
-        # Read the data into a DataFrame, setting the header manually.
-        df = pd.read_csv(path, comment='#', sep='\s+', header=None, skiprows=1, names=header_line)
-        # L = df['L'].to_numpy()
-        TT = df['TT'].to_numpy()
-        # EE = df['EE'].to_numpy()
-        # BB = df['BB'].to_numpy()
-        # TE = df['TE'].to_numpy()
-        # PP = df['PP'].to_numpy()
-        # PT = df['PT'].to_numpy()
-        # PE = df['PE'].to_numpy()
+        columns, table = read_camb_ps_text(path)
+        TT = table[:, columns.index('TT')]
         if TT_only:
             return TT
-        else:
-            raise NotImplementedError("Untested, no use case currently.")
-            return df
+        # All columns as a single array, with rows indexed by ell
+        #    (rows for ells below the first L in the file are zero)
+        ells = table[:, columns.index('L')].astype(int)
+        data = np.zeros((ells.max() + 1, len(CAMB_PS_COLUMNS)))
+        data[ells] = table[:, [columns.index(col) for col in CAMB_PS_COLUMNS]]
+        return data
 
-    def write(self, path: Path, data: camb.CAMBdata) -> None:
+    def write(self, path: Path, data: Union[camb.CAMBdata, np.ndarray]) -> None:
+        """
+        Writes either CAMB results or an array of spectra (n_ell x CAMB_PS_COLUMNS,
+        starting at ell=0, e.g. from an emulator) in CAMB's text format.
+        """
         make_directories(path)
-        data.save_cmb_power_spectra(filename=path)
+        if isinstance(data, np.ndarray):
+            save_cmb_power_array(path, data, CAMB_PS_COLUMNS)
+        else:
+            data.save_cmb_power_spectra(filename=path)
 
 
 class NumpyPowerSpectrum(GenericHandler):
@@ -54,5 +81,65 @@ class NumpyPowerSpectrum(GenericHandler):
         np.save(path, arr=data)
 
 
+class NumpyPowerSpectrumStack(GenericHandler):
+    """
+    The power spectra of many sims, as one array (n_sims, n_ell), with the sim
+    number of each row in a second file alongside (e.g. theory_ps_sims.npy for theory_ps.npy).
+
+    Reading memory-maps the array, so rows are loaded only as they are used.
+    """
+    def read(self, path: Path, mmap: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the spectra, (n_sims, n_ell), and the sim number of each row.
+        """
+        spectra = np.load(path, mmap_mode='r' if mmap else None)
+        sims = np.load(self.sims_path(path))
+        return spectra, sims
+
+    def read_lookup(self, path: Path) -> "PowerSpectrumLookup":
+        """
+        The spectra of the stack, by sim number (see PowerSpectrumLookup).
+        """
+        spectra, sims = self.read(path)
+        return PowerSpectrumLookup(spectra, sims, path)
+
+    def write(self, path: Path, data: np.ndarray, sims: np.ndarray) -> None:
+        make_directories(path)
+        np.save(path, arr=data)
+        np.save(self.sims_path(path), arr=np.asarray(sims))
+
+    @staticmethod
+    def sims_path(path: Union[Path, str]) -> Path:
+        path = Path(path)
+        return path.with_name(f"{path.stem}_sims.npy")
+
+
+class PowerSpectrumLookup:
+    """
+    The rows of a stack of spectra (NumpyPowerSpectrumStack), by sim number.
+
+    Calling it with a sim gives that sim's spectrum, loaded from the
+    memory-mapped stack. Sims that are not in the stack raise an OSError,
+    as a missing spectrum file would.
+    """
+    def __init__(self, spectra: np.ndarray, sims: np.ndarray, path: Path) -> None:
+        self.spectra = spectra
+        self.path = path
+        self.row_by_sim = {sim: row for row, sim in enumerate(sims)}
+
+    def rows(self, sims: Iterable[int]) -> np.ndarray:
+        """
+        The rows of the stack for the sims, in order.
+        """
+        missing = [sim for sim in sims if sim not in self.row_by_sim]
+        if missing:
+            raise OSError(f"Could not read data from {self.path}. Error: sims {missing[:10]} are not in the file.")
+        return np.array([self.row_by_sim[sim] for sim in sims], dtype=int)
+
+    def __call__(self, sim: int) -> np.ndarray:
+        return np.array(self.spectra[self.rows([sim])[0]])
+
+
 register_handler("CambPowerSpectrum", CambPowerSpectrum)
 register_handler("NumpyPowerSpectrum", NumpyPowerSpectrum)
+register_handler("NumpyPowerSpectrumStack", NumpyPowerSpectrumStack)
@@ -1,6 +1,7 @@
 from .stage_executors.A_check_sims_hydra_configs import HydraConfigSimsCheckerExecutor
 from .stage_executors.B_make_noise_cache import NoiseCacheExecutor
 from .stage_executors.C_make_sim_configs import ConfigExecutor
+from .stage_executors.D_make_ps_emulator import PSEmulatorExecutor
 from .stage_executors.D_make_power_spectra import TheoryPSExecutor
 from .stage_executors.E_make_simulations import SimCreatorExecutor
 from .stage_executors.F_make_mask import MaskCreatorExecutor
@@ -1,5 +1,17 @@
 import os
+from pathlib import Path
+import logging
+
 import numpy as np
+import yaml
+
+
+logger = logging.getLogger(__name__)
+
+
+# Binary, columnar copy of the WMAP chains; made once, next to the text chain files
+CHAINS_ARRAY_FN = "wmap_chains_columnar.npy"
+CHAINS_INDEX_FN = "wmap_chains_columnar_index.yaml"
 
 
 def pull_params_from_file(wmap_chain_path, chain_idcs, params_to_get, wmap_chain_length):
@@ -43,9 +55,128 @@ def pull_params_from_file(wmap_chain_path, chain_idcs, params_to_get, wmap_chain
     return param_vals
 
 
+def pull_params_from_array(wmap_chain_path, chain_idcs, params_to_get, wmap_chain_length):
+    """
+    Get parameters from wmap chains, using the binary columnar copy of the chains.
+
+    The copy is made the first time it's needed (see convert_chains_to_array).
+    After that, all requested values are pulled with a single fancy-indexing
+    operation on a memory-mapped array, so the cost no longer scales with file parsing.
+    Returns the same structure as pull_params_from_file.
+    """
+    chains, param_rows = load_chains_array(wmap_chain_path, params_to_get, wmap_chain_length)
+
+    # Chain indices count from 1, matching the first column of the chain files
+    row_idcs = [param_rows[param] for param in params_to_get]
+    col_idcs = np.asarray(chain_idcs, dtype=np.int64) - 1
+    values = chains[np.ix_(row_idcs, col_idcs)]
+
+    param_vals = {}
+    for param, param_values in zip(params_to_get, values):
+        if param == 'a002':
+            param_values = param_values / 1e9
+        param_vals[param] = param_values.tolist()
+    param_vals['chain_idx'] = list(chain_idcs)
+    return param_vals
+
+
+def load_chains_array(wmap_chain_path, params_to_get, wmap_chain_length):
+    """
+    Memory-map the columnar chains array, converting the text chains first if needed.
+
+    Returns the array (params x chain_length) and a dict of row indices for each parameter.
+    """
+    wmap_chain_path = Path(wmap_chain_path)
+    array_path = wmap_chain_path / CHAINS_ARRAY_FN
+    index_path = wmap_chain_path / CHAINS_INDEX_FN
+
+    index = None
+    if array_path.exists() and index_path.exists():
+        with open(index_path, 'r') as infile:
+            index = yaml.safe_load(infile)
+        if not _chains_index_is_current(index, wmap_chain_path, params_to_get, wmap_chain_length):
+            index = None
+
+    if index is None:
+        # Keep any parameters converted previously, so that the copy only grows
+        params = list(params_to_get)
+        if index_path.exists():
+            with open(index_path, 'r') as infile:
+                old_params = yaml.safe_load(infile).get('params', [])
+            params += [p for p in old_params if p not in params and (wmap_chain_path / p).exists()]
+        index = convert_chains_to_array(wmap_chain_path, params, wmap_chain_length)
+
+    chains = np.load(array_path, mmap_mode='r')
+    param_rows = {param: i for i, param in enumerate(index['params'])}
+    return chains, param_rows
+
+
+def convert_chains_to_array(wmap_chain_path, params, wmap_chain_length):
+    """
+    One-time conversion of the text WMAP chains to a binary array, params x chain_length.
+
+    An index file records the parameter for each row, plus the sizes of the source
+    files so that a changed chain file triggers a new conversion.
+    """
+    wmap_chain_path = Path(wmap_chain_path)
+    logger.info(f"Converting WMAP chains for {params} to a binary array in {wmap_chain_path}. This only happens once.")
+
+    chains = np.empty((len(params), wmap_chain_length), dtype=np.float64)
+    for i, param in enumerate(params):
+        # We need the second column; the first is just the wmap index
+        values = np.loadtxt(wmap_chain_path / param, usecols=1, dtype=np.float64)
+        if values.shape[0] != wmap_chain_length:
+            raise ValueError(f"Chain file for {param} has {values.shape[0]} rows; expected {wmap_chain_length}.")
+        chains[i] = values
+
+    index = dict(
+        params=list(params),
+        chain_length=wmap_chain_length,
+        source_sizes={param: os.stat(wmap_chain_path / param).st_size for param in params}
+    )
+
+    # Write under temporary names so that an interrupted conversion is never used
+    array_path = wmap_chain_path / CHAINS_ARRAY_FN
+    tmp_array_path = array_path.with_name(f"{array_path.stem}.{os.getpid()}.tmp.npy")
+    np.save(tmp_array_path, chains)
+    os.replace(tmp_array_path, array_path)
+
+    index_path = wmap_chain_path / CHAINS_INDEX_FN
+    tmp_index_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    with open(tmp_index_path, 'w') as outfile:
+        yaml.dump(index, outfile, default_flow_style=False)
+    os.replace(tmp_index_path, index_path)
+    return index
+
+
+def _chains_index_is_current(index, wmap_chain_path, params_to_get, wmap_chain_length):
+    if index.get('chain_length') != wmap_chain_length:
+        return False
+    source_sizes = index.get('source_sizes', {})
+    for param in params_to_get:
+        if param not in source_sizes:
+            return False
+        if os.stat(Path(wmap_chain_path) / param).st_size != source_sizes[param]:
+            return False
+    return True
+
+
 def get_wmap_indices(n_indcs, seed:int, wmap_chain_length: int):
     rng = np.random.default_rng(seed=seed)
     set_of_indices = set(rng.integers(low=1, high=wmap_chain_length, size=n_indcs, endpoint=True))
     while len(set_of_indices) != n_indcs:
         set_of_indices.add(rng.integers(low=1, high=wmap_chain_length, size=1, endpoint=True)[0])
     return [int(idx)for idx in set_of_indices]
+
+
+def translate_params_keys(src_params, wmap_param_labels, camb_param_labels):
+    """
+    Cosmological parameters from WMAP chains have (slightly) different names in camb.
+    """
+    translation = dict(zip(wmap_param_labels, camb_param_labels))
+    target_dict = {}
+    for k in src_params:
+        if k == "chain_idx":
+            continue
+        target_dict[translation[k]] = src_params[k]
+    return target_dict
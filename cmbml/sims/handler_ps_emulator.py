@@ -0,0 +1,31 @@
+from typing import Union
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from cmbml.core import GenericHandler, register_handler
+from cmbml.core import make_directories
+from cmbml.sims.physics_cmb import CambPSEmulator
+
+
+logger = logging.getLogger(__name__)
+
+
+class CambPSEmulatorHandler(GenericHandler):
+    def read(self, path: Union[Path, str]) -> CambPSEmulator:
+        logger.debug(f"Reading power spectrum emulator from '{path}'")
+        with np.load(path) as arrays:
+            emulator = CambPSEmulator.from_arrays(arrays)
+        return emulator
+
+    def write(self, 
+              path: Union[Path, str], 
+              data: CambPSEmulator) -> None:
+        path = Path(path)
+        make_directories(path)
+        logger.debug(f"Writing power spectrum emulator to '{path}'")
+        np.savez(path, **data.to_arrays())
+
+
+register_handler("CambPSEmulator", CambPSEmulatorHandler)
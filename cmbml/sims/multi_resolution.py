@@ -0,0 +1,71 @@
+"""
+Support for writing simulations at several output resolutions from a single
+evaluation of the sky.
+
+The extra resolutions are set in the sim yaml (extra_nsides_out). Each is written
+under its own dataset, named with extra_dataset_name_template.
+"""
+from typing import Dict
+import logging
+
+import healpy as hp
+import pysm3
+from astropy.units import Quantity
+from omegaconf import DictConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_output_datasets(cfg: DictConfig) -> Dict[int, str]:
+    """
+    Returns the dataset name for each output nside, starting with the scenario nside.
+    """
+    datasets = {cfg.scenario.nside: cfg.dataset_name}
+    extra_nsides = cfg.model.sim.get("extra_nsides_out", None) or []
+    for nside in extra_nsides:
+        if nside in datasets:
+            continue
+        datasets[nside] = cfg.model.sim.extra_dataset_name_template.format(nside=nside)
+    return datasets
+
+
+def smooth_to_resolutions(skymap: Quantity,
+                          fwhm: Quantity,
+                          lmaxs: Dict[int, int]) -> Dict[int, Quantity]:
+    """
+    Convolves a map with a beam, producing a map at each of several nsides.
+
+    The expensive map2alm at the input resolution is done once, at the highest lmax;
+    the alms are truncated for each lower lmax.
+
+    Parameters:
+    skymap (Quantity): A single field at the sky resolution.
+    fwhm (Quantity): The beam FWHM.
+    lmaxs (dict): The lmax for the smoothing at each output nside.
+
+    Returns:
+    dict: The smoothed map at each output nside.
+    """
+    if len(lmaxs) == 1:
+        # Identical to the single resolution case
+        (nside_out, lmax), = lmaxs.items()
+        smoothed = pysm3.apply_smoothing_and_coord_transform(skymap, fwhm, lmax=lmax, output_nside=nside_out)
+        return {nside_out: smoothed}
+
+    unit = skymap.unit
+    lmax_all = max(lmaxs.values())
+    alm = pysm3.map2alm(skymap.value, hp.get_nside(skymap), lmax_all)
+
+    smoothed_maps = {}
+    for nside_out, lmax in lmaxs.items():
+        alm_out = alm
+        if lmax != lmax_all:
+            alm_out = hp.resize_alm(alm, lmax_all, lmax_all, lmax, lmax)
+        smoothed = pysm3.apply_smoothing_and_coord_transform(alm_out,
+                                                             fwhm,
+                                                             lmax=lmax,
+                                                             output_nside=nside_out,
+                                                             input_alm=True)
+        smoothed_maps[nside_out] = Quantity(smoothed.value, unit, copy=False)
+    return smoothed_maps
@@ -1,12 +1,16 @@
 from typing import Dict, Any, List, Union
 from pathlib import Path
+from hashlib import sha256
+import json
 import logging
 import inspect
 import camb
 from astropy.units import Quantity
 
 import numpy as np
-import healpy as hp
+from scipy.interpolate import RBFInterpolator
+
+from cmbml.utils.nest_ud_grade import ud_grade
 
 
 # Based on https://camb.readthedocs.io/en/latest/CAMBdemo.html
@@ -23,6 +27,20 @@ def make_camb_ps(cosmo_params, lmax) -> camb.CAMBdata:
     return results
 
 
+def get_camb_ps_key(cosmo_params: Dict[str, Any], lmax: int) -> str:
+    """
+    Deterministic key for a set of CAMB inputs, used to cache power spectra.
+
+    The key covers the (translated) cosmological parameters, lmax, and the
+    CAMB version, so a cached spectrum is only reused when CAMB would
+    produce the same result.
+    """
+    key_params = {k: float(v) for k, v in cosmo_params.items() if k != "chain_idx"}
+    key_dict = dict(params=key_params, lmax=int(lmax), camb=camb.__version__)
+    key_str = json.dumps(key_dict, sort_keys=True)
+    return sha256(key_str.encode()).hexdigest()[:20]
+
+
 def setup_camb(cosmo_params: Dict[str, Any], lmax:int) -> camb.CAMBparams:
     pars = camb.CAMBparams()
 
@@ -70,11 +88,149 @@ def _log_camb_args(set_cosmo_args, init_power_args) -> None:
     logger.debug(f"CAMB init_power args: {init_power_args}")
 
 
+class CambPSEmulator:
+    """
+    Emulates CAMB's saved power spectra as a function of cosmological parameters.
+
+    Spectra are compressed with PCA (after taking the log of columns which are
+    strictly positive) and the PCA coefficients are interpolated over the
+    standardized parameter space with radial basis functions. Evaluating the
+    emulator for a new set of parameters takes milliseconds.
+
+    The emulator should be fitted to exact CAMB runs drawn from the same
+    parameter distribution it will be used for (e.g. the WMAP chains), and
+    checked against held-out CAMB runs with fractional_error().
+    """
+    # Spectra are zero below ell = 2; they are not emulated
+    ELL_MIN = 2
+
+    def __init__(self, param_names: List[str], n_components: int=20) -> None:
+        self.param_names = list(param_names)
+        self.n_components = n_components
+        # Statistics set in fit()
+        self.param_mean = None
+        self.param_std = None
+        self.log_columns = None
+        self.ps_mean = None
+        self.ps_std = None
+        self.components = None
+        self.train_params = None
+        self.train_coeffs = None
+        # Error against held-out CAMB runs, set by the caller after validation
+        self.max_frac_error = None
+        self._interpolator = None
+
+    def fit(self, params: np.ndarray, spectra: np.ndarray) -> "CambPSEmulator":
+        """
+        Parameters:
+        params (np.ndarray): n_samples x n_params, ordered as param_names
+        spectra (np.ndarray): n_samples x n_ell x n_columns, as saved by CAMB
+        """
+        params = np.asarray(params, dtype=np.float64)
+        spectra = np.asarray(spectra, dtype=np.float64)
+        n_samples = params.shape[0]
+        if self.n_components > n_samples:
+            raise ValueError(f"Cannot fit {self.n_components} components with {n_samples} spectra.")
+
+        self.param_mean = params.mean(axis=0)
+        self.param_std = params.std(axis=0)
+        self.param_std[self.param_std == 0] = 1
+
+        used = spectra[:, self.ELL_MIN:, :]
+        self.log_columns = np.all(used > 0, axis=(0, 1))
+        flat = self._to_flat(used)
+        self.ps_mean = flat.mean(axis=0)
+        self.ps_std = flat.std(axis=0)
+        self.ps_std[self.ps_std == 0] = 1
+        flat = (flat - self.ps_mean) / self.ps_std
+
+        # Economy SVD; rows of vt are the principal components
+        _, _, vt = np.linalg.svd(flat, full_matrices=False)
+        self.components = vt[:self.n_components]
+        self.train_params = params
+        self.train_coeffs = flat @ self.components.T
+        self._build_interpolator()
+        return self
+
+    def predict(self, params: Union[Dict[str, float], np.ndarray]) -> np.ndarray:
+        """
+        Returns spectra for one (dict or 1D array) or many (2D array) parameter sets,
+        in the same layout as the fitted spectra (starting at ell=0).
+        """
+        if isinstance(params, dict):
+            params = [params[name] for name in self.param_names]
+        params = np.asarray(params, dtype=np.float64)
+        single = params.ndim == 1
+        params = np.atleast_2d(params)
+
+        coeffs = self._interpolator((params - self.param_mean) / self.param_std)
+        flat = (coeffs @ self.components) * self.ps_std + self.ps_mean
+        n_columns = self.log_columns.shape[0]
+        used = flat.reshape(params.shape[0], -1, n_columns)
+        used[:, :, self.log_columns] = np.exp(used[:, :, self.log_columns])
+
+        spectra = np.zeros((params.shape[0], used.shape[1] + self.ELL_MIN, n_columns))
+        spectra[:, self.ELL_MIN:, :] = used
+        return spectra[0] if single else spectra
+
+    def fractional_error(self, params: np.ndarray, spectra: np.ndarray) -> np.ndarray:
+        """
+        Maximum fractional error for each column, over all given spectra and all ells.
+
+        For columns which change sign (e.g. TE), the error is taken relative
+        to the largest magnitude of that column in each spectrum.
+        """
+        spectra = np.asarray(spectra, dtype=np.float64)[:, self.ELL_MIN:, :]
+        predicted = self.predict(np.atleast_2d(params))[:, self.ELL_MIN:, :]
+        abs_err = np.abs(predicted - spectra)
+        scale = np.where(self.log_columns,
+                         np.abs(spectra),
+                         np.abs(spectra).max(axis=1, keepdims=True))
+        return np.max(abs_err / scale, axis=(0, 1))
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(param_names=np.array(self.param_names),
+                    n_components=np.array(self.n_components),
+                    param_mean=self.param_mean,
+                    param_std=self.param_std,
+                    log_columns=self.log_columns,
+                    ps_mean=self.ps_mean,
+                    ps_std=self.ps_std,
+                    components=self.components,
+                    train_params=self.train_params,
+                    train_coeffs=self.train_coeffs,
+                    max_frac_error=np.array(np.nan if self.max_frac_error is None else self.max_frac_error))
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "CambPSEmulator":
+        emulator = cls(param_names=[str(p) for p in arrays["param_names"]],
+                       n_components=int(arrays["n_components"]))
+        for attr in ["param_mean", "param_std", "log_columns", "ps_mean", "ps_std",
+                     "components", "train_params", "train_coeffs"]:
+            setattr(emulator, attr, arrays[attr])
+        max_frac_error = float(arrays["max_frac_error"])
+        emulator.max_frac_error = None if np.isnan(max_frac_error) else max_frac_error
+        emulator._build_interpolator()
+        return emulator
+
+    def _build_interpolator(self) -> None:
+        std_params = (self.train_params - self.param_mean) / self.param_std
+        self._interpolator = RBFInterpolator(std_params, 
+                                             self.train_coeffs, 
+                                             kernel="thin_plate_spline", 
+                                             degree=1)
+
+    def _to_flat(self, used: np.ndarray) -> np.ndarray:
+        used = used.copy()
+        used[:, :, self.log_columns] = np.log(used[:, :, self.log_columns])
+        return used.reshape(used.shape[0], -1)
+
+
 def change_nside_of_map(cmb_maps: Union[np.ndarray, List[np.ndarray]], nside_out: int):
     try:
         # Assume single map; if not, cmb_maps.dtype will fail duck typing
-        scaled_map = hp.ud_grade(cmb_maps, nside_out=nside_out, dtype=cmb_maps.dtype)
+        scaled_map = ud_grade(cmb_maps, nside_out=nside_out, dtype=cmb_maps.dtype)
     except AttributeError:
         # handle lists of maps
-        scaled_map = [hp.ud_grade(cmb_map, nside_out=nside_out, dtype=cmb_map.dtype) for cmb_map in cmb_maps]
+        scaled_map = [ud_grade(cmb_map, nside_out=nside_out, dtype=cmb_map.dtype) for cmb_map in cmb_maps]
     return scaled_map
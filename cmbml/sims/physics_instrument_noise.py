@@ -7,19 +7,20 @@ import pysm3.units as u
 from astropy.cosmology import Planck15
 
 import cmbml.utils.fits_inspection as fits_inspect
+from cmbml.utils.nest_ud_grade import ud_grade
 
 
 logger = logging.getLogger(__name__)
 
 
-def planck_result_to_sd_map(fits_fn, hdu, field_idx, nside_out, cen_freq):
+def planck_result_to_sd_map(fits_fn, hdu, field_str, field_idcs, nside_out, cen_freq):
     logger.debug(f"physics_instrument_noise.planck_result_to_sd_map start")
-    source_skymap = hp.read_map(fits_fn, hdu=hdu, field=field_idx)
+    # Read the field, its unit, and its ordering in a single pass through the file
+    source_skymap, src_unit, ordering = fits_inspect.read_map_field(fits_fn, hdu, field_str, field_idcs)
 
-    m = _change_variance_map_resolution(source_skymap, nside_out)
+    m = _change_variance_map_resolution(source_skymap, nside_out, order_in=ordering)
     m = np.sqrt(m)
     
-    src_unit = fits_inspect.get_field_unit(fits_fn, hdu, field_idx)
     sqrt_unit = _get_sqrt_unit(src_unit)
 
     # Convert MJy/sr to K_CMB (I think, TODO: Verify)
@@ -44,17 +45,22 @@ def make_random_noise_map(sd_map, random_seed, center_frequency):
     return noise_map
 
 
-def _change_variance_map_resolution(m, nside_out):
+def _change_variance_map_resolution(m, nside_out, order_in="RING"):
     # For variance maps, because statistics
     power = 2
+    # Planck maps are NESTED; ud_grade works in NESTED, so passing it through avoids reordering at full resolution.
+    #    The output is always RING.
+    order_kwargs = dict(order_in=order_in, order_out="RING")
 
     # From PySM3 template.py's read_map function, with minimal alteration (added 'power'):
     m_dtype = fits_inspect.get_map_dtype(m)
     nside_in = hp.get_nside(m)
     if nside_out < nside_in:  # do downgrading in double precision
-        m = hp.ud_grade(m.astype(np.float64), power=power, nside_out=nside_out)
+        m = ud_grade(m.astype(np.float64), power=power, nside_out=nside_out, **order_kwargs)
     elif nside_out > nside_in:
-        m = hp.ud_grade(m, power=power, nside_out=nside_out)
+        m = ud_grade(m, power=power, nside_out=nside_out, **order_kwargs)
+    elif order_in != "RING":
+        m = hp.reorder(m, n2r=True)
     m = m.astype(m_dtype, copy=False)
     # End of used portion
     return m
@@ -0,0 +1,222 @@
+"""
+A PyTorch Dataset that makes simulations as they are requested, instead of reading
+them from disk. It uses the same machinery as SimCreatorExecutor (Instrument,
+CMBFactory, seed factories, and the noise cache), so sim n of a split is the
+same realization whether it is made here or by the make_sims stage.
+
+The CMB spectra (from make_theory_ps) and the noise cache (from make_noise_cache)
+must already exist. Foregrounds do not change between simulations; they are
+evaluated and smoothed once, when the dataset is made.
+
+Use make_sim_dataset_from_cfg() to get a dataset.
+"""
+from typing import Callable, Dict, List
+import logging
+
+import numpy as np
+from omegaconf import DictConfig
+from torch.utils.data import Dataset
+
+import healpy as hp
+import pysm3
+import pysm3.units as u
+
+from cmbml.core.config_helper import ConfigHelper
+from cmbml.core.namers import Namer
+from cmbml.core.split import Split
+from cmbml.utils.planck_instrument import make_instrument, Instrument
+from cmbml.sims.cmb_factory import CMBFactory
+from cmbml.sims.random_seed_manager import FieldLevelSeedFactory, SimLevelSeedFactory
+from cmbml.sims.physics_instrument_noise import make_random_noise_map
+from cmbml.utils.nest_ud_grade import ud_grade
+
+from cmbml.core.asset_handlers.qtable_handler import QTableHandler # Import to register handler
+from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum # Import to register handler
+from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import to register handler
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimOnTheFlyDataset(Dataset):
+    def __init__(self,
+                 split: Split,
+                 n_sims: int,
+                 instrument: Instrument,
+                 map_fields: str,
+                 nside_out: int,
+                 lmax_smoothing: int,
+                 output_units: str,
+                 cmb_factory: CMBFactory,
+                 cmb_seed_factory: SimLevelSeedFactory,
+                 noise_seed_factory: FieldLevelSeedFactory,
+                 cmb_ps_paths: List[str],
+                 noise_sd_maps: Dict[int, Dict[str, np.ndarray]],
+                 foregrounds: Dict[int, np.ndarray],
+                 pt_xforms: List[Callable]=[]
+                 ):
+        self.split = split
+        self.n_sims = n_sims
+        self.instrument = instrument
+        self.n_map_fields: int = len(map_fields)
+        self.nside_out = nside_out
+        self.lmax_smoothing = lmax_smoothing
+        self.output_unit = u.Unit(output_units)
+        self.cmb_factory = cmb_factory
+        self.cmb_seed_factory = cmb_seed_factory
+        self.noise_seed_factory = noise_seed_factory
+        # One path for ps_fidu_fixed splits, otherwise one per sim in the split
+        self.cmb_ps_paths = cmb_ps_paths
+        self.noise_sd_maps = noise_sd_maps
+        self.foregrounds = foregrounds
+        self.pt_xforms = pt_xforms
+
+    def __len__(self):
+        return self.n_sims
+
+    def __getitem__(self, sim_idx):
+        cmb_seed = self.cmb_seed_factory.get_seed(self.split, sim_idx)
+        # Beyond the precomputed spectra, new CMB realizations reuse them in turn
+        ps_path = self.cmb_ps_paths[sim_idx % len(self.cmb_ps_paths)]
+        cmb = self.cmb_factory.make_cmb_lensed(cmb_seed, ps_path)
+        cmb_map = cmb.map.value
+
+        # Matches the cmb_map written by SimCreatorExecutor
+        label = np.stack([ud_grade(cmb_map[i], nside_out=self.nside_out)
+                          for i in range(self.n_map_fields)], axis=0)
+
+        # The CMB differs between detectors only by a unit conversion and the beam, so
+        #    the (expensive, high resolution) map2alm is done once per field
+        nside_sky = hp.get_nside(cmb_map)
+        cmb_alms = [pysm3.map2alm(cmb_map[i], nside_sky, self.lmax_smoothing)
+                    for i in range(self.n_map_fields)]
+
+        features = []
+        for freq, detector in self.instrument.dets.items():
+            # As in CMBLensed.get_emission() then pysm3.Sky.get_emission(): uK_CMB to uK_RJ to the output unit
+            to_rj = pysm3.bandpass_unit_conversion(detector.cen_freq, None, u.uK_RJ, input_unit=u.uK_CMB)
+            to_output = pysm3.bandpass_unit_conversion(detector.cen_freq, None, self.output_unit)
+            cmb_to_output = (to_rj * to_output).to_value(self.output_unit / u.uK_CMB).item()
+
+            obs_map = np.empty((len(detector.fields), hp.nside2npix(self.nside_out)), dtype=np.float32)
+            for i, field_str in enumerate(detector.fields):
+                cmb_smoothed = pysm3.apply_smoothing_and_coord_transform(cmb_alms[i] * cmb_to_output,
+                                                                         detector.fwhm,
+                                                                         lmax=self.lmax_smoothing,
+                                                                         output_nside=self.nside_out,
+                                                                         input_alm=True)
+                noise_seed = self.noise_seed_factory.get_seed(self.split.name, sim_idx, freq, field_str)
+                noise_map = make_random_noise_map(self.noise_sd_maps[freq][field_str], noise_seed, None)
+                obs_map[i] = cmb_smoothed + self.foregrounds[freq][i] + noise_map.to_value(self.output_unit)
+            features.append(obs_map[:self.n_map_fields, :])
+        # Create a new axis - not np.concatenate, as that will use existing axes
+        features = np.stack(features, axis=0)
+
+        data = (features, label.astype(np.float32))
+        for transform in self.pt_xforms:
+            data = transform(data)
+        return data
+
+
+def make_sim_dataset_from_cfg(cfg: DictConfig,
+                              split_name: str,
+                              n_sims: int=None,
+                              pt_xforms: List[Callable]=[]) -> SimOnTheFlyDataset:
+    """
+    Get a dataset of simulations made on the fly, configured like the make_sims stage.
+
+    Args:
+        cfg: The hydra config, with the simulation pipeline.
+        split_name: The name of the split.
+        n_sims: The number of simulations in the dataset. Defaults to the
+                number in the split; it may be set higher.
+        pt_xforms: Callables that take data as a tuple of (obs, cmb)
+
+    Returns:
+        SimOnTheFlyDataset: Items are (obs, cmb), with obs of shape
+                            (n_detectors, n_map_fields, n_pix) and cmb of
+                            shape (n_map_fields, n_pix).
+    """
+    config_helper = ConfigHelper(cfg, stage_str="make_sims")
+    name_tracker = Namer(cfg)
+    assets_in = config_helper.get_assets_in(name_tracker)
+    split = config_helper.get_split(split_name)
+
+    det_info = assets_in['planck_deltabandpass'].read()
+    instrument = make_instrument(cfg=cfg, det_info=det_info)
+
+    nside_out = cfg.scenario.nside
+    nside_sky = cfg.model.sim.get("nside_sky", None)
+    if not nside_sky:
+        nside_sky = nside_out * cfg.model.sim.nside_sky_factor
+    lmax_smoothing = int(cfg.model.sim.pysm_beam_lmax_ratio * nside_out)
+
+    cmb_ps_asset = assets_in['cmb_ps']
+    with name_tracker.set_context("split", split.name):
+        if split.ps_fidu_fixed:
+            cmb_ps_paths = [str(cmb_ps_asset.path_alt)]
+        else:
+            cmb_ps_paths = []
+            for sim in split.iter_sims():
+                with name_tracker.set_context("sim_num", sim):
+                    cmb_ps_paths.append(str(cmb_ps_asset.path))
+
+    noise_cache_asset = assets_in['noise_cache']
+    noise_sd_maps = {}
+    for freq, detector in instrument.dets.items():
+        noise_sd_maps[freq] = {}
+        for field_str in detector.fields:
+            with name_tracker.set_contexts(dict(freq=freq, field=field_str)):
+                noise_sd_maps[freq][field_str] = noise_cache_asset.read()[0]
+
+    foregrounds = make_smoothed_foregrounds(instrument=instrument,
+                                            nside_sky=nside_sky,
+                                            nside_out=nside_out,
+                                            lmax_smoothing=lmax_smoothing,
+                                            preset_strings=list(cfg.model.sim.preset_strings),
+                                            output_units=cfg.scenario.units)
+
+    return SimOnTheFlyDataset(split=split,
+                              n_sims=n_sims if n_sims is not None else split.n_sims,
+                              instrument=instrument,
+                              map_fields=cfg.scenario.map_fields,
+                              nside_out=nside_out,
+                              lmax_smoothing=lmax_smoothing,
+                              output_units=cfg.scenario.units,
+                              cmb_factory=CMBFactory(nside_sky),
+                              cmb_seed_factory=SimLevelSeedFactory(cfg, cfg.model.sim.cmb.seed_string),
+                              noise_seed_factory=FieldLevelSeedFactory(cfg, cfg.model.sim.noise.seed_string),
+                              cmb_ps_paths=cmb_ps_paths,
+                              noise_sd_maps=noise_sd_maps,
+                              foregrounds=foregrounds,
+                              pt_xforms=pt_xforms)
+
+
+def make_smoothed_foregrounds(instrument: Instrument,
+                              nside_sky: int,
+                              nside_out: int,
+                              lmax_smoothing: int,
+                              preset_strings: List[str],
+                              output_units: str) -> Dict[int, np.ndarray]:
+    """
+    Evaluates the foregrounds for each detector, smoothed by its beam and at nside_out.
+    """
+    npix_out = hp.nside2npix(nside_out)
+    foregrounds = {}
+    if len(preset_strings) == 0:
+        for freq, detector in instrument.dets.items():
+            foregrounds[freq] = np.zeros((len(detector.fields), npix_out), dtype=np.float32)
+        return foregrounds
+
+    logger.info(f"Evaluating foregrounds {preset_strings} at nside {nside_sky}; this is done once per dataset.")
+    sky = pysm3.Sky(nside=nside_sky, preset_strings=preset_strings, output_unit=output_units)
+    for freq, detector in instrument.dets.items():
+        skymaps = sky.get_emission(detector.cen_freq)
+        fg_map = np.empty((len(detector.fields), npix_out), dtype=np.float32)
+        for i, (skymap, field_str) in enumerate(zip(skymaps, detector.fields)):
+            fg_map[i] = pysm3.apply_smoothing_and_coord_transform(skymap,
+                                                                  detector.fwhm,
+                                                                  lmax=lmax_smoothing,
+                                                                  output_nside=nside_out).value
+        foregrounds[freq] = fg_map
+    return foregrounds
@@ -1,17 +1,22 @@
-from typing import Dict
+from typing import Dict, NamedTuple
 import pysm3
+import os
 import logging
 
+from multiprocessing import Pool
+
 import hydra
 from omegaconf import DictConfig
 from pathlib import Path
+from tqdm import tqdm
 
+from astropy.io import fits
 from astropy.units import Quantity
 
-from cmbml.core import BaseStageExecutor, Asset
+from cmbml.core import BaseStageExecutor, Asset, GenericHandler
 from cmbml.utils.planck_instrument import make_instrument, Instrument
-from cmbml.utils.fits_inspection import get_num_fields_in_hdr
 from cmbml.sims.physics_instrument_noise import planck_result_to_sd_map
+from cmbml.sims.multi_resolution import get_output_datasets
 
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap
 from cmbml.core.asset_handlers.qtable_handler import QTableHandler
@@ -20,6 +25,21 @@ from cmbml.core.asset_handlers.qtable_handler import QTableHandler
 logger = logging.getLogger(__name__)
 
 
+class FrozenAsset(NamedTuple):
+    path: Path
+    handler: GenericHandler
+
+
+class TaskTarget(NamedTuple):
+    src_path: Path
+    hdu: int
+    field_str: str
+    field_idcs: Dict[int, Dict[str, int]]
+    nside_out: int
+    cen_freq: Quantity
+    asset_out: FrozenAsset
+
+
 class NoiseCacheExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following stage_str must match the pipeline yaml
@@ -38,53 +58,79 @@ class NoiseCacheExecutor(BaseStageExecutor):
             det_info = in_det_table.read()
         self.instrument: Instrument = make_instrument(cfg=cfg, det_info=det_info)
 
+        noise_ops = cfg.model.sim.noise.get("noise_operations", None)
+        self.num_processes = noise_ops.num_processes if noise_ops else 1
+        self.max_mem_fraction = noise_ops.max_mem_fraction if noise_ops else 0.5
+
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute() method.")
-        hdu = self.cfg.model.sim.noise.hdu_n
-        nside = self.cfg.scenario.nside
-        for freq, detector in self.instrument.dets.items():
-            src_path = self.get_src_path(freq)
-            for field_str in detector.fields:
-                field_idx = self.get_field_idx(src_path, field_str)
-                st_dev_skymap = planck_result_to_sd_map(fits_fn=src_path, 
-                                                        hdu=hdu, 
-                                                        field_idx=field_idx, 
-                                                        nside_out=nside, 
-                                                        cen_freq=detector.cen_freq)
-                with self.name_tracker.set_contexts(dict(freq=freq, field=field_str)):
-                    self.write_wrapper(data=st_dev_skymap, field_str=field_str)
-
-    def write_wrapper(self, data: Quantity, field_str):
-        units = data.unit
-        data = data.value
-        
-        # We want to give some indication that for I field, this is from the II covariance (or QQ, UU)
-        col_name = field_str + field_str
-        logger.debug(f'Writing NoiseCache map to path: {self.out_noise_cache.path}')
-        self.out_noise_cache.write(data=data,
-                                   column_names=[col_name],
-                                   column_units=[units])
-        # TODO: Test load this file; see if column names and units match expectation.
-        logger.debug(f'Wrote NoiseCache map to path: {self.out_noise_cache.path}')
-
-    def get_field_idx(self, src_path, field_str) -> int:
-        """
-        Looks at fits file to determine field_idx corresponding to field_str
+        tasks = self.build_tasks()
 
-        Parameters:
-        src_path (str): The path to the fits file.
-        field_str (str): The field string to look up.
+        # Run the first task outside multiprocessing for easier debugging.
+        first_task = tasks.pop(0)
+        self.try_a_task(parallel_make_noise_cache, first_task)
 
-        Returns:
-        int: The field index corresponding to the field string.
-        """
+        self.run_all_tasks(parallel_make_noise_cache, tasks)
+
+    def build_tasks(self):
         hdu = self.cfg.model.sim.noise.hdu_n
-        field_idcs_dict = dict(self.cfg.model.sim.noise.field_idcs)
-        # Get number of fields in map
-        n_map_fields = get_num_fields_in_hdr(fits_fn=src_path, hdu=hdu)
-        # Lookup field index based on config file
-        field_idx = field_idcs_dict[n_map_fields][field_str]
-        return field_idx
+        # OmegaConf containers don't pickle well; use plain dicts
+        field_idcs = {int(n_fields): dict(idcs) for n_fields, idcs in self.cfg.model.sim.noise.field_idcs.items()}
+        # make_sims may output several resolutions; each dataset needs its own noise cache
+        output_datasets = get_output_datasets(self.cfg)
+        tasks = []
+        for nside, dataset_name in output_datasets.items():
+            for freq, detector in self.instrument.dets.items():
+                src_path = self.get_src_path(freq)
+                for field_str in detector.fields:
+                    context = dict(freq=freq, field=field_str, dataset=dataset_name)
+                    with self.name_tracker.set_contexts(context):
+                        asset_out = FrozenAsset(path=self.out_noise_cache.path,
+                                                handler=self.out_noise_cache.handler)
+                    tasks.append(TaskTarget(src_path=src_path,
+                                            hdu=hdu,
+                                            field_str=field_str,
+                                            field_idcs=field_idcs,
+                                            nside_out=nside,
+                                            cen_freq=detector.cen_freq,
+                                            asset_out=asset_out))
+        return tasks
+
+    def try_a_task(self, _process, task: TaskTarget):
+        """
+        Make one noise map outside multiprocessing,
+        to avoid painful debugging within multiprocessing.
+        """
+        _process(task)
+
+    def run_all_tasks(self, process, tasks):
+        if len(tasks) == 0:
+            return
+        num_processes = self.get_memory_capped_processes(tasks)
+        logger.info(f"Making noise cache for {len(tasks)} tasks across {num_processes} workers.")
+        with Pool(processes=num_processes) as pool:
+            # Create an iterator from imap_unordered and wrap it with tqdm for progress tracking
+            task_iterator = tqdm(pool.imap_unordered(process, tasks), total=len(tasks))
+            # Iterate through the task_iterator to execute the tasks
+            for _ in task_iterator:
+                pass
+
+    def get_memory_capped_processes(self, tasks) -> int:
+        """
+        Limits the number of workers so that the largest tasks, run all at once, 
+        fit within a fraction of the available memory.
+        """
+        task_bytes = max(estimate_task_bytes(task) for task in tasks)
+        available_bytes = get_available_memory()
+        if available_bytes is None:
+            logger.warning("Could not determine available memory; not capping noise cache workers.")
+            return self.num_processes
+        mem_cap = int(self.max_mem_fraction * available_bytes // task_bytes)
+        num_processes = max(1, min(self.num_processes, mem_cap))
+        if num_processes < self.num_processes:
+            logger.info(f"Each noise cache task may use up to {task_bytes / 2**30:.1f} GiB; "
+                        f"limiting workers to {num_processes} (of {self.num_processes} requested).")
+        return num_processes
 
 
     def get_src_path(self, detector: int):
@@ -103,3 +149,49 @@ class NoiseCacheExecutor(BaseStageExecutor):
         with self.name_tracker.set_contexts(contexts_dict):
             src_path = self.in_noise_src.path
         return src_path
+
+
+def parallel_make_noise_cache(task_target: TaskTarget):
+    tt = task_target
+    st_dev_skymap = planck_result_to_sd_map(fits_fn=tt.src_path, 
+                                            hdu=tt.hdu, 
+                                            field_str=tt.field_str, 
+                                            field_idcs=tt.field_idcs,
+                                            nside_out=tt.nside_out, 
+                                            cen_freq=tt.cen_freq)
+
+    # We want to give some indication that for I field, this is from the II covariance (or QQ, UU)
+    col_name = tt.field_str + tt.field_str
+    logger.debug(f'Writing NoiseCache map to path: {tt.asset_out.path}')
+    tt.asset_out.handler.write(path=tt.asset_out.path,
+                               data=st_dev_skymap.value,
+                               column_names=[col_name],
+                               column_units=[st_dev_skymap.unit])
+
+
+def estimate_task_bytes(task_target: TaskTarget) -> int:
+    """
+    Rough peak memory for one task: the source field, 
+    its float64 copy, and ud_grade's working arrays.
+    """
+    header = fits.getheader(task_target.src_path, ext=task_target.hdu)
+    npix_in = 12 * header["NSIDE"] ** 2
+    npix_out = 12 * task_target.nside_out ** 2
+    return 4 * 8 * max(npix_in, npix_out)
+
+
+def get_available_memory():
+    """
+    Memory available to new processes, in bytes (None if it cannot be determined).
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
@@ -4,9 +4,10 @@ import logging
 
 from omegaconf import DictConfig, OmegaConf
 
-from cmbml.sims.get_wmap_params import get_wmap_indices, pull_params_from_file
+from cmbml.sims.get_wmap_params import get_wmap_indices, pull_params_from_array
 
 from cmbml.core.asset_handlers.asset_handlers_base import Config
+from cmbml.core.asset_handlers.npz_columns_handler import NumpyColumnsHandler # Import to register handler
 from cmbml.core import (
     BaseStageExecutor,
     Split,
@@ -24,10 +25,15 @@ class ConfigExecutor(BaseStageExecutor):
         super().__init__(cfg, stage_str="make_sim_configs")
 
         self.out_split_config: Asset = self.assets_out['split_configs']
+        self.out_wmap_param_table: Asset = self.assets_out['wmap_param_table']
         self.out_wmap_config: AssetWithPathAlts = self.assets_out['wmap_config']
         out_split_config_handler: Config
+        out_wmap_param_table_handler: NumpyColumnsHandler
         out_wmap_config_handler: Config
 
+        # Per-sim yaml files are slow to write and read back; they're an optional export
+        self.export_wmap_yaml = bool(self._config_help.get_stage_elem_silent("export_wmap_yaml", self.stage_str))
+
         self.wmap_param_labels = cfg.model.sim.cmb.wmap_params
         self.wmap_chain_length = cfg.model.sim.cmb.wmap_chain_length
         self.wmap_chains_dir = Path(cfg.local_system.assets_dir) / cfg.file_system.wmap_chains_dir
@@ -37,11 +43,12 @@ class ConfigExecutor(BaseStageExecutor):
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute() method.")
         all_idices = self.make_chain_idcs_for_each_split(self.seed)
+        all_params = self.pull_params_for_each_split(all_idices)
         for split in self.splits:
             with self.name_tracker.set_context("split", split.name):
-                self.process_split(split, all_idices[split.name])
+                self.process_split(split, all_idices[split.name], all_params[split.name])
 
-    def process_split(self, split: Split, these_idces) -> None:
+    def process_split(self, split: Split, these_idces, these_params) -> None:
         split_cfg_dict = dict(
             ps_fidu_fixed = split.ps_fidu_fixed,
             n_sims = split.n_sims,
@@ -51,7 +58,7 @@ class ConfigExecutor(BaseStageExecutor):
         with self.name_tracker.set_context("split", split.name):
             self.out_split_config.write(data=split_cfg_dict)
 
-        self.make_cosmo_param_configs(split_cfg_dict['wmap_chain_idcs'], split)
+        self.make_cosmo_param_configs(these_params, split)
 
     @staticmethod
     def n_ps_for_split(split: Split):
@@ -85,12 +92,31 @@ class ConfigExecutor(BaseStageExecutor):
 
         return chain_idcs_dict
 
-    def make_cosmo_param_configs(self, chain_idcs, split):
-        wmap_params = pull_params_from_file(wmap_chain_path=self.wmap_chains_dir,
-                                            chain_idcs=chain_idcs,
+    def pull_params_for_each_split(self, chain_idcs_dict: Dict[str, List[int]]) -> Dict[str, Dict[str, List]]:
+        # Pull the parameters for all splits at once, then portion them out
+        all_chain_idcs = [idx for split in self.splits for idx in chain_idcs_dict[split.name]]
+        all_params = pull_params_from_array(wmap_chain_path=self.wmap_chains_dir,
+                                            chain_idcs=all_chain_idcs,
                                             params_to_get=self.wmap_param_labels,
                                             wmap_chain_length=self.wmap_chain_length)
 
+        last_index_used = 0
+        params_dict = {}
+        for split in self.splits:
+            first_index = last_index_used
+            last_index_used = first_index + len(chain_idcs_dict[split.name])
+            params_dict[split.name] = {key: values[first_index: last_index_used]
+                                       for key, values in all_params.items()}
+        return params_dict
+
+    def make_cosmo_param_configs(self, wmap_params, split):
+        # One row per power spectrum: a single row for ps_fidu_fixed splits, 
+        #    otherwise the row number is the sim number
+        self.out_wmap_param_table.write(data=wmap_params)
+
+        if not self.export_wmap_yaml:
+            return
+
         if split.ps_fidu_fixed:
             these_params = {key: values[0] for key, values in wmap_params.items()}
             self.out_wmap_config.write(use_alt_path=True, data=these_params)
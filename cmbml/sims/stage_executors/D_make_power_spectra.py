@@ -1,23 +1,47 @@
+from typing import Dict, List, NamedTuple
+from pathlib import Path
+import shutil
+import os
 import logging
 
+from multiprocessing import Pool
+
 from omegaconf import DictConfig
 from tqdm import tqdm
 
 from cmbml.core import (
     BaseStageExecutor,
     Split,
-    AssetWithPathAlts
+    Asset,
+    AssetWithPathAlts,
+    GenericHandler,
+    make_directories
 )
 
-from cmbml.sims.physics_cmb import make_camb_ps
+from cmbml.sims.physics_cmb import make_camb_ps, get_camb_ps_key, CambPSEmulator
+from cmbml.sims.get_wmap_params import translate_params_keys
 
+from cmbml.sims.handler_ps_emulator import CambPSEmulatorHandler # Import to register handler
 from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum # Import to register handler
-from cmbml.core.asset_handlers.asset_handlers_base import Config
+from cmbml.core.asset_handlers.npz_columns_handler import NumpyColumnsHandler # Import to register handler
 
 
 logger = logging.getLogger(__name__)
 
 
+class FrozenAsset(NamedTuple):
+    # FrozenAsset is created as an immutable so that multiprocessing can run.
+    path: Path
+    handler: GenericHandler
+
+
+class TaskTarget(NamedTuple):
+    cosmo_params: Dict[str, float]
+    lmax: int
+    # CAMB writes to the first asset; the file is then copied to the rest
+    ps_assets: List[FrozenAsset]
+
+
 class TheoryPSExecutor(BaseStageExecutor):
     def __init__(self, cfg: DictConfig) -> None:
         # The following stage_str must match the pipeline yaml
@@ -28,46 +52,139 @@ class TheoryPSExecutor(BaseStageExecutor):
         self.camb_param_labels = cfg.model.sim.cmb.camb_params_equiv
 
         self.out_cmb_ps: AssetWithPathAlts = self.assets_out['cmb_ps']
-        self.in_wmap_config: AssetWithPathAlts = self.assets_in['wmap_config']
+        # The cache is optional; it is shared across datasets (see pipeline yaml)
+        self.out_cmb_ps_cache: Asset = self.assets_out.get('cmb_ps_cache', None)
+        self.in_wmap_param_table: Asset = self.assets_in['wmap_param_table']
+        self.in_ps_emulator: Asset = self.assets_in.get('ps_emulator', None)
 
         out_cmb_ps_handler: CambPowerSpectrum
-        in_wmap_config_handler: Config
+        out_cmb_ps_cache_handler: CambPowerSpectrum
+        in_wmap_param_table_handler: NumpyColumnsHandler
+        in_ps_emulator_handler: CambPSEmulatorHandler
+
+        camb_ops = cfg.model.sim.cmb.get("camb_operations", None)
+        self.num_processes = camb_ops.num_processes if camb_ops else 1
+
+        emulator_cfg = cfg.model.sim.cmb.get("emulator", None)
+        self.use_emulator = bool(emulator_cfg and emulator_cfg.use)
 
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute() method.")
-        self.default_execute()  # In BaseStageExecutor
-
-    def process_split(self, split: Split) -> None:
+        # Collect the output paths for each distinct set of CAMB inputs
+        ps_assets_by_key = {}
+        params_by_key = {}
+        for split in self.splits:
+            with self.name_tracker.set_context("split", split.name):
+                for key, cosmo_params, ps_asset in self.get_split_ps_targets(split):
+                    ps_assets_by_key.setdefault(key, []).append(ps_asset)
+                    params_by_key[key] = cosmo_params
+
+        if self.use_emulator:
+            self.emulate_all_ps(ps_assets_by_key, params_by_key)
+            return
+
+        tasks = self.build_tasks(ps_assets_by_key, params_by_key)
+        n_ps = sum(len(v) for v in ps_assets_by_key.values())
+        logger.info(f"{n_ps} power spectra needed; {len(ps_assets_by_key)} distinct; {len(tasks)} require CAMB.")
+        if len(tasks) == 0:
+            return
+
+        # Run the first task outside multiprocessing for easier debugging.
+        first_task = tasks.pop(0)
+        self.try_a_task(parallel_make_ps, first_task)
+
+        self.run_all_tasks(parallel_make_ps, tasks)
+
+    def get_split_ps_targets(self, split: Split):
+        """
+        Yields (cache key, CAMB parameters, output asset) for each power spectrum in the split.
+        """
+        # Pull cosmological parameters for the whole split from the table created earlier
+        param_table = self.in_wmap_param_table.read()
         if split.ps_fidu_fixed:
-            self.make_ps(self.in_wmap_config, self.out_cmb_ps, use_alt_path=True)
+            yield self.get_ps_target(param_table, row=0, use_alt_path=True)
         else:
-            for sim in tqdm(split.iter_sims()):
+            for sim in split.iter_sims():
                 with self.name_tracker.set_context("sim_num", sim):
-                    self.make_ps(self.in_wmap_config, self.out_cmb_ps, use_alt_path=False)
-
-    def make_ps(self, 
-                wmap_params: AssetWithPathAlts, 
-                ps_asset: AssetWithPathAlts,
-                use_alt_path) -> None:
-        # Pull cosmological parameters from wmap_configs created earlier
-        cosmo_params = wmap_params.read(use_alt_path=use_alt_path)
+                    yield self.get_ps_target(param_table, row=sim, use_alt_path=False)
+
+    def get_ps_target(self, param_table, row, use_alt_path):
+        cosmo_params = {key: values[row].item() for key, values in param_table.items()}
         # cosmological parameters from WMAP chains have (slightly) different names in camb
         cosmo_params = self._translate_params_keys(cosmo_params)
-
-        camb_results = make_camb_ps(cosmo_params, lmax=self.max_ell_for_camb)
-        ps_asset.write(use_alt_path=use_alt_path, data=camb_results)
+        key = get_camb_ps_key(cosmo_params, lmax=self.max_ell_for_camb)
+
+        path = self.out_cmb_ps.path_alt if use_alt_path else self.out_cmb_ps.path
+        ps_asset = FrozenAsset(path=path, handler=self.out_cmb_ps.handler)
+        return key, cosmo_params, ps_asset
+
+    def build_tasks(self, ps_assets_by_key, params_by_key):
+        tasks = []
+        for key, ps_assets in ps_assets_by_key.items():
+            if self.out_cmb_ps_cache is None:
+                tasks.append(TaskTarget(cosmo_params=params_by_key[key],
+                                        lmax=self.max_ell_for_camb,
+                                        ps_assets=ps_assets))
+                continue
+            with self.name_tracker.set_contexts(dict(ps_key=key, lmax=self.max_ell_for_camb)):
+                cache_asset = FrozenAsset(path=self.out_cmb_ps_cache.path,
+                                          handler=self.out_cmb_ps_cache.handler)
+            if Path(cache_asset.path).exists():
+                # Cache hit; no need to run CAMB
+                copy_ps_file(cache_asset.path, [asset.path for asset in ps_assets])
+            else:
+                tasks.append(TaskTarget(cosmo_params=params_by_key[key],
+                                        lmax=self.max_ell_for_camb,
+                                        ps_assets=[cache_asset, *ps_assets]))
+        return tasks
+
+    def emulate_all_ps(self, ps_assets_by_key, params_by_key):
+        """
+        Writes emulated spectra instead of running CAMB. These are never put in the cache.
+        """
+        emulator: CambPSEmulator = self.in_ps_emulator.read()
+        logger.warning(f"Using emulated power spectra instead of CAMB. Maximum fractional error against held-out CAMB runs: {emulator.max_frac_error}.")
+        for key, ps_assets in tqdm(ps_assets_by_key.items()):
+            ps_array = emulator.predict(params_by_key[key])
+            for ps_asset in ps_assets:
+                ps_asset.handler.write(path=ps_asset.path, data=ps_array)
+
+    def try_a_task(self, _process, task: TaskTarget):
+        """
+        Run CAMB once outside multiprocessing,
+        to avoid painful debugging within multiprocessing.
+        """
+        _process(task)
+
+    def run_all_tasks(self, process, tasks):
+        logger.info(f"Running CAMB on {len(tasks)} tasks across {self.num_processes} workers.")
+        with Pool(processes=self.num_processes) as pool:
+            # Create an iterator from imap_unordered and wrap it with tqdm for progress tracking
+            task_iterator = tqdm(pool.imap_unordered(process, tasks), total=len(tasks))
+            # Iterate through the task_iterator to execute the tasks
+            for _ in task_iterator:
+                pass
 
     def _translate_params_keys(self, src_params):
-        translation_dict = self._param_translation_dict()
-        target_dict = {}
-        for k in src_params:
-            if k == "chain_idx":
-                continue
-            target_dict[translation_dict[k]] = src_params[k]
-        return target_dict
-
-    def _param_translation_dict(self):
-        translation = {}
-        for i in range(len(self.wmap_param_labels)):
-            translation[self.wmap_param_labels[i]] = self.camb_param_labels[i]
-        return translation
+        return translate_params_keys(src_params, self.wmap_param_labels, self.camb_param_labels)
+
+
+def parallel_make_ps(task_target: TaskTarget):
+    tt = task_target
+    camb_results = make_camb_ps(tt.cosmo_params, lmax=tt.lmax)
+
+    first_asset, *other_assets = tt.ps_assets
+    # Write under a temporary name so that an interrupted run (or another
+    #    dataset sharing the cache) never sees a partial file
+    first_path = Path(first_asset.path)
+    tmp_path = first_path.with_name(f"{first_path.stem}.{os.getpid()}.tmp")
+    first_asset.handler.write(path=tmp_path, data=camb_results)
+    os.replace(tmp_path, first_path)
+
+    copy_ps_file(first_path, [asset.path for asset in other_assets])
+
+
+def copy_ps_file(src_path, dest_paths):
+    for dest_path in dest_paths:
+        make_directories(dest_path)
+        shutil.copyfile(src_path, dest_path)
@@ -0,0 +1,129 @@
+"""
+Fits an emulator for CAMB's power spectra, for use when a split has so many
+simulations that running CAMB for each is a bottleneck.
+
+The emulator is trained on exact CAMB runs at parameters drawn from the WMAP
+chains and checked against held-out CAMB runs. The errors are written to a
+report; review it before setting `emulator.use` in the cmb yaml.
+"""
+from typing import Dict, List
+from pathlib import Path
+import logging
+
+from multiprocessing import Pool
+
+import numpy as np
+from omegaconf import DictConfig
+from tqdm import tqdm
+
+from cmbml.core import BaseStageExecutor, Asset
+
+from cmbml.sims.get_wmap_params import get_wmap_indices, pull_params_from_array, translate_params_keys
+from cmbml.sims.physics_cmb import CambPSEmulator, get_camb_ps_key
+from cmbml.sims.stage_executors.D_make_power_spectra import FrozenAsset, TaskTarget, parallel_make_ps
+
+from cmbml.sims.handler_ps_emulator import CambPSEmulatorHandler # Import to register handler
+from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum, CAMB_PS_COLUMNS
+from cmbml.core.asset_handlers.asset_handlers_base import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class PSEmulatorExecutor(BaseStageExecutor):
+    def __init__(self, cfg: DictConfig) -> None:
+        # The following stage_str must match the pipeline yaml
+        super().__init__(cfg, stage_str='make_ps_emulator')
+
+        self.out_emulator: Asset = self.assets_out['ps_emulator']
+        self.out_report: Asset = self.assets_out['report']
+        self.out_training_ps: Asset = self.assets_out['training_ps']
+        out_emulator_handler: CambPSEmulatorHandler
+        out_report_handler: Config
+        out_training_ps_handler: CambPowerSpectrum
+
+        self.max_ell_for_camb = cfg.model.sim.cmb.ell_max
+        self.wmap_param_labels = cfg.model.sim.cmb.wmap_params
+        self.camb_param_labels = cfg.model.sim.cmb.camb_params_equiv
+        self.wmap_chain_length = cfg.model.sim.cmb.wmap_chain_length
+        self.wmap_chains_dir = Path(cfg.local_system.assets_dir) / cfg.file_system.wmap_chains_dir
+
+        self.emulator_cfg = cfg.model.sim.cmb.get("emulator", None)
+
+        camb_ops = cfg.model.sim.cmb.get("camb_operations", None)
+        self.num_processes = camb_ops.num_processes if camb_ops else 1
+
+    def execute(self) -> None:
+        logger.debug(f"Running {self.__class__.__name__} execute() method.")
+        if not self.emulator_cfg or not (self.emulator_cfg.make or self.emulator_cfg.use):
+            logger.info("Power spectrum emulator is disabled in the cmb yaml. Skipping.")
+            return
+
+        n_train = self.emulator_cfg.n_train
+        n_holdout = self.emulator_cfg.n_holdout
+        param_sets = self.draw_param_sets(n_train + n_holdout)
+        spectra = self.get_camb_spectra(param_sets)
+
+        param_names = list(self.camb_param_labels)
+        params = np.array([[p[name] for name in param_names] for p in param_sets])
+
+        logger.info(f"Fitting power spectrum emulator to {n_train} CAMB runs.")
+        emulator = CambPSEmulator(param_names, n_components=self.emulator_cfg.n_components)
+        emulator.fit(params[:n_train], spectra[:n_train])
+
+        frac_errors = emulator.fractional_error(params[n_train:], spectra[n_train:])
+        emulator.max_frac_error = float(frac_errors.max())
+        report = dict(
+            n_train=n_train,
+            n_holdout=n_holdout,
+            n_components=self.emulator_cfg.n_components,
+            max_frac_error=emulator.max_frac_error,
+            max_frac_error_per_column={col: float(err) for col, err in zip(CAMB_PS_COLUMNS, frac_errors)}
+        )
+        logger.info(f"Power spectrum emulator maximum fractional error on {n_holdout} held-out CAMB runs: {report['max_frac_error_per_column']}")
+
+        self.out_emulator.write(data=emulator)
+        self.out_report.write(data=report)
+
+    def draw_param_sets(self, n_param_sets) -> List[Dict[str, float]]:
+        # Drawn independently of the dataset's own chain indices (different seed)
+        chain_idcs = get_wmap_indices(n_param_sets,
+                                      self.emulator_cfg.seed,
+                                      wmap_chain_length=self.wmap_chain_length)
+        wmap_params = pull_params_from_array(wmap_chain_path=self.wmap_chains_dir,
+                                             chain_idcs=chain_idcs,
+                                             params_to_get=self.wmap_param_labels,
+                                             wmap_chain_length=self.wmap_chain_length)
+        param_sets = []
+        for i in range(n_param_sets):
+            these_params = {key: values[i] for key, values in wmap_params.items()}
+            param_sets.append(translate_params_keys(these_params,
+                                                    self.wmap_param_labels,
+                                                    self.camb_param_labels))
+        return param_sets
+
+    def get_camb_spectra(self, param_sets) -> np.ndarray:
+        """
+        Runs CAMB for each set of parameters (unless already run), then reads all spectra.
+        """
+        ps_assets = []
+        tasks = []
+        for cosmo_params in param_sets:
+            key = get_camb_ps_key(cosmo_params, lmax=self.max_ell_for_camb)
+            with self.name_tracker.set_contexts(dict(ps_key=key, lmax=self.max_ell_for_camb)):
+                ps_asset = FrozenAsset(path=self.out_training_ps.path,
+                                       handler=self.out_training_ps.handler)
+            ps_assets.append(ps_asset)
+            if not Path(ps_asset.path).exists():
+                tasks.append(TaskTarget(cosmo_params=cosmo_params,
+                                        lmax=self.max_ell_for_camb,
+                                        ps_assets=[ps_asset]))
+
+        logger.info(f"Running CAMB on {len(tasks)} tasks across {self.num_processes} workers; {len(param_sets) - len(tasks)} found in cache.")
+        if len(tasks) > 0:
+            with Pool(processes=self.num_processes) as pool:
+                for _ in tqdm(pool.imap_unordered(parallel_make_ps, tasks), total=len(tasks)):
+                    pass
+
+        spectra = [asset.handler.read(asset.path, TT_only=False) for asset in ps_assets]
+        return np.stack(spectra, axis=0)
@@ -1,6 +1,8 @@
 from typing import Dict
 from pathlib import Path
 import logging
+import resource
+import tracemalloc
 
 import hydra
 from omegaconf import DictConfig
@@ -25,10 +27,13 @@ from cmbml.core import (
 from cmbml.core.asset_handlers.qtable_handler import QTableHandler # Import to register handler
 from cmbml.core.asset_handlers.psmaker_handler import CambPowerSpectrum # Import for typing hint
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for VS Code hints
+from cmbml.core.asset_handlers.healpy_alm_handler import HealpyAlm # Import to register handler
 
 from cmbml.utils.map_formats import convert_pysm3_to_hp
 from cmbml.sims.physics_cmb import change_nside_of_map
 from cmbml.sims.physics_instrument_noise import make_random_noise_map
+from cmbml.sims.multi_resolution import get_output_datasets, smooth_to_resolutions
+from cmbml.utils.physics_ps import get_map_alms
 
 
 logger = logging.getLogger(__name__)
@@ -41,8 +46,11 @@ class SimCreatorExecutor(BaseStageExecutor):
 
         self.out_cmb_map: Asset = self.assets_out['cmb_map']
         self.out_obs_maps: Asset = self.assets_out['obs_maps']
+        # Optional: the CMB map's alms, so that analysis need not transform it again (see pipeline yaml)
+        self.out_cmb_alm: Asset = self.assets_out.get('cmb_alm', None)
         out_cmb_map_handler: HealpyMap
         out_obs_maps_handler: HealpyMap
+        out_cmb_alm_handler: HealpyAlm
 
         self.in_noise_cache: Asset = self.assets_in['noise_cache']
         self.in_cmb_ps: AssetWithPathAlts = self.assets_in['cmb_ps']
@@ -69,6 +77,14 @@ class SimCreatorExecutor(BaseStageExecutor):
         
         self.lmax_pysm3_smoothing = int(cfg.model.sim.pysm_beam_lmax_ratio * self.nside_out)
         logger.info(f"Simulation beam convolution will occur with lmax = {self.lmax_pysm3_smoothing}.")
+
+        # Optionally, the same sky is also written at other resolutions, each to its own dataset
+        self.output_datasets = get_output_datasets(cfg)
+        self.lmaxs_pysm3_smoothing = {nside: int(cfg.model.sim.pysm_beam_lmax_ratio * nside)
+                                      for nside in self.output_datasets}
+        for nside, dataset_name in self.output_datasets.items():
+            if nside != self.nside_out:
+                logger.info(f"Simulations will also be output at nside_out = {nside}, to dataset {dataset_name}.")
         
         self.units = cfg.scenario.units
         logger.info(f"Simulations will have units of {self.units}")
@@ -79,8 +95,16 @@ class SimCreatorExecutor(BaseStageExecutor):
         self.output_units = cfg.scenario.units
         self.cmb_factory = CMBFactory(self.nside_sky)
 
+        # Low-memory mode: one component and one field at a time, accumulated in float32
+        self.streaming = cfg.model.sim.get("streaming", False)
+        if self.streaming:
+            logger.info("Simulations will be made in low-memory streaming mode.")
+
     def execute(self) -> None:
         logger.debug(f"Running {self.__class__.__name__} execute() method.")
+        if self.streaming:
+            # Tracks numpy allocations, for the peak memory reported per sim
+            tracemalloc.start()
         placeholder = pysm3.Model(nside=self.nside_sky, max_nside=self.nside_sky)
         logger.debug('Creating PySM3 Sky object')
         self.sky = pysm3.Sky(nside=self.nside_sky,
@@ -104,43 +128,110 @@ class SimCreatorExecutor(BaseStageExecutor):
         self.sky.components[0] = cmb
         self.save_cmb_map_realization(cmb)
 
+        if self.streaming:
+            self.process_sim_streaming(split, sim_num)
+            return
+
         for freq, detector in self.instrument.dets.items():
             skymaps = self.sky.get_emission(detector.cen_freq)
 
-            obs_map = []
+            obs_maps = {nside: [] for nside in self.output_datasets}
             column_names = []
             for skymap, field_str in zip(skymaps, detector.fields):
                 # Use pysm3.apply_smoothing... to convolve the map with the planck detector beam
-                map_smoothed = pysm3.apply_smoothing_and_coord_transform(skymap, 
-                                                                         detector.fwhm, 
-                                                                         lmax=self.lmax_pysm3_smoothing, 
-                                                                         output_nside=self.nside_out)
+                #    (at each output resolution, sharing the map2alm)
+                maps_smoothed = smooth_to_resolutions(skymap, detector.fwhm, self.lmaxs_pysm3_smoothing)
+                # The same noise seed is used at every resolution
                 noise_seed = self.noise_seed_factory.get_seed(split.name, sim_num, freq, field_str)
-                noise_map = self.get_noise_map(freq, field_str, noise_seed)
-                final_map = map_smoothed + noise_map
-                obs_map.append(final_map)
+                for nside, map_smoothed in maps_smoothed.items():
+                    noise_map = self.get_noise_map(freq, field_str, noise_seed, nside=nside)
+                    final_map = map_smoothed + noise_map
+                    obs_maps[nside].append(final_map)
 
                 column_names.append(field_str + "_STOKES")
 
-            with self.name_tracker.set_contexts(dict(freq=freq)):
-                self.out_obs_maps.write(data=obs_map,
-                                        column_names=column_names)
+            self.write_obs_maps(freq, obs_maps, column_names)
             logger.debug(f"For {split.name}:{sim_name}, {freq} GHz: done with channel")
         logger.debug(f"For {split.name}:{sim_name}, done with simulation")
 
+    def process_sim_streaming(self, split: Split, sim_num: int) -> None:
+        """
+        Makes the observation maps like process_sim(), but holds only one sky component's 
+        emission at a time. Emission is summed into a float32 buffer at nside_sky for each 
+        field, which is then smoothed and has noise added. Intermediates are released 
+        as soon as they are used.
+        """
+        sim_name = self.name_tracker.sim_name()
+        tracemalloc.reset_peak()
+        npix_sky = 12 * self.nside_sky ** 2
+        for freq, detector in self.instrument.dets.items():
+            # pysm3.Sky.get_emission() sums the components in uK_RJ, then converts
+            to_output_unit = pysm3.bandpass_unit_conversion(detector.cen_freq, None, self.sky.output_unit)
+            to_output_unit = to_output_unit.value.item()
+
+            n_fields = len(detector.fields)
+            sky_buffer = np.zeros((n_fields, npix_sky), dtype=np.float32)
+            for component in self.sky.components:
+                emission = component.get_emission(detector.cen_freq)
+                for i in range(n_fields):
+                    sky_buffer[i] += emission[i].value * to_output_unit
+                del emission
+
+            obs_maps = {nside: [] for nside in self.output_datasets}
+            column_names = []
+            for i, field_str in enumerate(detector.fields):
+                field_map = Quantity(sky_buffer[i].astype(np.float64), self.sky.output_unit, copy=False)
+                maps_smoothed = smooth_to_resolutions(field_map, detector.fwhm, self.lmaxs_pysm3_smoothing)
+                del field_map
+                noise_seed = self.noise_seed_factory.get_seed(split.name, sim_num, freq, field_str)
+                for nside, map_smoothed in maps_smoothed.items():
+                    noise_map = self.get_noise_map(freq, field_str, noise_seed, nside=nside)
+                    final_map = map_smoothed.value.astype(np.float32)
+                    final_map += noise_map.to_value(self.sky.output_unit).astype(np.float32).reshape(final_map.shape)
+                    del noise_map
+                    obs_maps[nside].append(final_map * self.sky.output_unit)
+                del maps_smoothed
+                column_names.append(field_str + "_STOKES")
+            del sky_buffer
+
+            self.write_obs_maps(freq, obs_maps, column_names)
+            del obs_maps
+            logger.debug(f"For {split.name}:{sim_name}, {freq} GHz: done with channel")
+
+        _, peak_traced = tracemalloc.get_traced_memory()
+        # ru_maxrss is in kilobytes on Linux; it covers the whole process lifetime
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        logger.info(f"For {split.name}:{sim_name}, peak memory for arrays was {peak_traced / 2**30:.2f} GiB "
+                    f"(process peak RSS so far: {peak_rss / 2**30:.2f} GiB).")
+
+    def write_obs_maps(self, freq, obs_maps, column_names):
+        for nside, obs_map in obs_maps.items():
+            with self.name_tracker.set_contexts(dict(freq=freq, dataset=self.output_datasets[nside])):
+                self.out_obs_maps.write(data=obs_map,
+                                        column_names=column_names)
+
     def save_cmb_map_realization(self, cmb: CMBLensed):
         cmb_realization: Quantity = cmb.map
-        nside_out = self.nside_out
         cmb_data, cmb_units = convert_pysm3_to_hp(cmb_realization)
-        scaled_map = change_nside_of_map(cmb_data, nside_out)
-        self.out_cmb_map.write(data=scaled_map, column_units=cmb_units)
-
-    def get_noise_map(self, freq, field_str, noise_seed, center_frequency=None):
-        with self.name_tracker.set_context('freq', freq):
-            with self.name_tracker.set_context('field', field_str):
-                sd_map = self.in_noise_cache.read()
-                noise_map = make_random_noise_map(sd_map, noise_seed, center_frequency)
-                return noise_map
+        for nside_out, dataset_name in self.output_datasets.items():
+            scaled_map = change_nside_of_map(cmb_data, nside_out)
+            with self.name_tracker.set_context('dataset', dataset_name):
+                self.out_cmb_map.write(data=scaled_map, column_units=cmb_units)
+                if self.out_cmb_alm is not None:
+                    # At the lmax used for analysis, in the map's precision
+                    lmax = int(self.cfg.model.analysis.lmax_ratio * nside_out)
+                    alms = get_map_alms(scaled_map, lmax=lmax, map_fields=self.cfg.scenario.map_fields)
+                    if np.asarray(scaled_map).dtype == np.float32:
+                        alms = alms.astype(np.complex64)
+                    self.out_cmb_alm.write(data=alms)
+
+    def get_noise_map(self, freq, field_str, noise_seed, center_frequency=None, nside=None):
+        # Each resolution has its own noise cache, in its own dataset
+        dataset_name = self.output_datasets[nside if nside else self.nside_out]
+        with self.name_tracker.set_contexts(dict(freq=freq, field=field_str, dataset=dataset_name)):
+            sd_map = self.in_noise_cache.read()
+            noise_map = make_random_noise_map(sd_map, noise_seed, center_frequency)
+            return noise_map
 
     def get_nside_sky(self):
         nside_out = self.cfg.scenario.nside
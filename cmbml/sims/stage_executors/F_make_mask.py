@@ -8,7 +8,7 @@ from omegaconf import DictConfig
 
 from cmbml.core import BaseStageExecutor, Asset
 from cmbml.core.asset_handlers.healpy_map_handler import HealpyMap # Import for typing hint
-from cmbml.utils.physics_mask import downgrade_mask
+from cmbml.utils.physics_mask import get_stage_mask
 
 
 logger = logging.getLogger(__name__)
@@ -30,11 +30,7 @@ class MaskCreatorExecutor(BaseStageExecutor):
 
     def execute(self) -> None:
         mask = self.get_mask()
-        mask = downgrade_mask(mask, self.nside_out, threshold=self.mask_threshold)
         self.out_mask.write(data=mask)
 
     def get_mask(self):
-        with self.name_tracker.set_context("src_root", self.cfg.local_system.assets_dir):
-            logger.info(f"Using mask from {self.in_mask.path}")
-            mask = self.in_mask.read(map_fields=self.in_mask.use_fields)[0]
-            return mask
+        return get_stage_mask(self.cfg, self.in_mask, self.nside_out, self.mask_threshold)
@@ -0,0 +1,171 @@
+"""
+Tools for rendering figures quickly, many at a time.
+
+hp.mollview projects a map by converting each image pixel to a direction and
+then to a HEALPix pixel. That lookup depends only on nside, the image size, and
+the rotation, so here it is computed once (get_mollweide_grid) and each view is
+a single gather from the map (mollview).
+
+Figures may be made in worker processes; init_render_worker sets a
+non-interactive backend and gives workers projections already computed.
+"""
+from typing import Dict, Iterable, NamedTuple, Tuple, Union
+import logging
+
+import numpy as np
+import healpy as hp
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib import colors
+
+
+logger = logging.getLogger(__name__)
+
+
+class MollweideGrid(NamedTuple):
+    nside: int
+    xsize: int
+    rot: Tuple
+    nest: bool
+    pix: np.ndarray     # (ysize, xsize) HEALPix pixel for each image pixel; -1 off the sky
+    extent: Tuple       # Image extent, in projection coordinates (as hp.mollview)
+
+
+# Projections by (nside, xsize, rot, nest)
+_GRIDS: Dict[Tuple, MollweideGrid] = {}
+
+
+def _grid_key(nside, xsize, rot, nest) -> Tuple:
+    rot = tuple(rot) if rot is not None else None
+    return (int(nside), int(xsize), rot, bool(nest))
+
+
+def get_mollweide_grid(nside: int, xsize: int=800, rot=None, nest: bool=False) -> MollweideGrid:
+    """
+    The HEALPix pixel seen at each pixel of a Mollweide image, as hp.mollview
+    (with flip='astro') would draw it. Computed once per (nside, xsize, rot, nest).
+    """
+    key = _grid_key(nside, xsize, rot, nest)
+    grid = _GRIDS.get(key, None)
+    if grid is None:
+        grid = _make_mollweide_grid(*key)
+        _GRIDS[key] = grid
+    return grid
+
+
+def _make_mollweide_grid(nside, xsize, rot, nest) -> MollweideGrid:
+    proj = hp.projector.MollweideProj(rot=rot, flipconv="astro", xsize=xsize)
+    x, y = proj.ij2xy()
+    on_sky = ~np.ma.getmaskarray(x)
+    vec = proj.xy2vec(np.asarray(x[on_sky]), np.asarray(y[on_sky]))
+    pix = np.full(x.shape, -1, dtype=np.int64)
+    pix[on_sky] = hp.vec2pix(nside, vec[0], vec[1], vec[2], nest=nest)
+    return MollweideGrid(nside=nside, xsize=xsize, rot=rot, nest=nest, pix=pix, extent=proj.get_extent())
+
+
+def add_grids(grids: Iterable[MollweideGrid]) -> None:
+    for grid in grids:
+        _GRIDS[_grid_key(grid.nside, grid.xsize, grid.rot, grid.nest)] = grid
+
+
+def init_render_worker(grids: Iterable[MollweideGrid]=()) -> None:
+    """
+    Sets up a worker process for rendering figures.
+    """
+    matplotlib.use("Agg")
+    add_grids(grids)
+
+
+def project(some_map: np.ndarray, grid: MollweideGrid) -> np.ma.MaskedArray:
+    """
+    The Mollweide image of a map, masked off the sky and at masked or UNSEEN pixels.
+    """
+    if hp.get_nside(some_map) != grid.nside:
+        raise ValueError(f"Map has nside {hp.get_nside(some_map)}; the projection is for nside {grid.nside}.")
+    on_sky = grid.pix >= 0
+    values = np.asarray(some_map)[np.where(on_sky, grid.pix, 0)]
+    mask = ~on_sky | (values == hp.UNSEEN) | ~np.isfinite(values)
+    map_mask = np.ma.getmask(some_map)
+    if map_mask is not np.ma.nomask:
+        mask |= map_mask[np.where(on_sky, grid.pix, 0)]
+    return np.ma.array(values, mask=mask)
+
+
+def mollview(some_map: np.ndarray,
+             ax=None,
+             xsize: int=800,
+             rot=None,
+             nest: bool=False,
+             min: float=None,
+             max: float=None,
+             cmap=None,
+             norm: Union[str, colors.Normalize]=None,
+             title: str=None,
+             unit: str="",
+             cbar: bool=True,
+             badcolor: str="gray"):
+    """
+    Draws a Mollweide view of a map on ax (default: the current axes),
+    in the manner of hp.mollview(..., hold=True).
+
+    Returns the ScalarMappable for the colors, e.g. for a shared colorbar.
+    """
+    ax = plt.gca() if ax is None else ax
+    grid = get_mollweide_grid(hp.get_nside(some_map), xsize=xsize, rot=rot, nest=nest)
+    img = project(some_map, grid)
+
+    # As healpy, limits default to the extremes of the pixels shown
+    vmin = img.min() if min is None else min
+    vmax = img.max() if max is None else max
+    if norm == "log":
+        norm = colors.LogNorm(vmin=vmin, vmax=vmax)
+    elif norm is None:
+        norm = colors.Normalize(vmin=vmin, vmax=vmax)
+    cmap = plt.get_cmap(cmap)
+
+    # Colors are made here so that off-sky pixels are blank and masked pixels are gray
+    rgba = cmap(norm(img.filled(vmin)))
+    rgba[img.mask] = colors.to_rgba(badcolor)
+    rgba[grid.pix < 0] = (0, 0, 0, 0)
+
+    ax.imshow(rgba, extent=grid.extent, origin="lower", interpolation="nearest", aspect="equal")
+    # Outline of the sky
+    t = np.linspace(0, 2 * np.pi, 721)
+    ax.plot(2 * np.cos(t), np.sin(t), color="black", linewidth=1)
+    ax.set_axis_off()
+    if title is not None:
+        ax.set_title(title)
+
+    mappable = plt.cm.ScalarMappable(norm=norm, cmap=cmap)
+    mappable.set_array([])
+    if cbar:
+        colorbar = ax.figure.colorbar(mappable, ax=ax, orientation="horizontal", shrink=0.4, pad=0.05,
+                                      ticks=[norm.vmin, norm.vmax])
+        colorbar.set_label(unit)
+    return mappable
+
+
+def graticule(ax=None, dpar: float=30, dmer: float=30, rot=None, xsize: int=800, **kwargs) -> None:
+    """
+    Draws lines of constant latitude and longitude on a view made by mollview().
+    """
+    ax = plt.gca() if ax is None else ax
+    line_params = dict(color="black", linestyle=":", linewidth=0.8)
+    line_params.update(kwargs)
+    proj = hp.projector.MollweideProj(rot=rot, flipconv="astro", xsize=xsize)
+
+    n_points = 361
+    lines = []
+    for lat in np.arange(-90 + dpar, 90, dpar):
+        lines.append((np.linspace(-180, 180, n_points), np.full(n_points, lat)))
+    for lon in np.arange(-180, 180, dmer):
+        lines.append((np.full(n_points, lon), np.linspace(-90, 90, n_points)))
+
+    for lon, lat in lines:
+        x, y = proj.ang2xy(lon, lat, lonlat=True)
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        # Break lines where they wrap around the edge of the view
+        breaks = np.nonzero(np.abs(np.diff(x)) > 1)[0] + 1
+        for xs, ys in zip(np.split(x, breaks), np.split(y, breaks)):
+            ax.plot(xs, ys, **line_params)
+
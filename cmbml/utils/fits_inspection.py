@@ -60,6 +60,33 @@ def get_field_unit(fits_fn, hdu, field_idx):
     return unit
 
 
+def read_map_field(fits_fn, hdu, field_str, field_idcs: Dict[int, Dict[str, int]]):
+    """
+    Reads a single field of a HEALPix map, along with its unit and ordering,
+    opening the file only once.
+
+    Parameters:
+    fits_fn (str): The path to the fits file.
+    hdu (int): The HDU containing the map.
+    field_str (str): The field to read, e.g. "I".
+    field_idcs (dict): For each number of fields in the HDU, the index of each field_str.
+
+    Returns:
+    tuple: The map (native byte order, in the file's pixel ordering), 
+           its unit string, and its ordering ("RING" or "NESTED").
+    """
+    with fits.open(fits_fn, memmap=True) as hdul:
+        table = hdul[hdu]
+        n_fields = len(table.columns)
+        field_idx = field_idcs[n_fields][field_str]
+        unit = table.header.get(f"TUNIT{field_idx + 1}", "")
+        ordering = table.header.get("ORDERING", "RING").strip().upper()
+        # Only this column is read from disk; maps may be stored as rows of 1024 pixels
+        m = table.data.field(field_idx).ravel()
+        m = m.astype(get_map_dtype(m))
+    return m, unit, ordering
+
+
 def get_num_fields(fits_fn) -> Dict[int, int]:
     # Open the FITS file
     n_fields = {}
@@ -0,0 +1,147 @@
+"""
+A faster equivalent of hp.ud_grade.
+
+In NEST ordering, the children of a pixel are contiguous, so changing resolution
+is a reshape (and a mean, when downgrading). hp.ud_grade does the same, but
+reorders RING maps with freshly computed permutations on every call and makes
+several full-size temporaries. Here the permutations are cached per nside and the
+work is done in chunks of output pixels.
+
+Results match hp.ud_grade (pess=False), including handling of UNSEEN and
+non-finite pixels (see tests/test_nest_ud_grade.py).
+"""
+from typing import Union
+from functools import lru_cache
+
+import numpy as np
+import healpy as hp
+
+
+# Output pixels per chunk; keeps temporaries small
+CHUNK_SIZE = 2**18
+
+# Any pixel at or below this is treated as UNSEEN by hp.mask_bad (default tolerances)
+UNSEEN_UPPER = hp.UNSEEN + 1e-5 * np.abs(hp.UNSEEN)
+
+
+@lru_cache(maxsize=4)
+def ring_to_nest_index(nside: int) -> np.ndarray:
+    """
+    Indices such that map_ring[..., idx] is the map in NEST ordering.
+
+    Cached; at nside 2048 each is 200 MB.
+    """
+    idx = hp.nest2ring(nside, np.arange(hp.nside2npix(nside)))
+    return idx.astype(np.int32 if idx.max() < 2**31 else np.int64)
+
+
+@lru_cache(maxsize=4)
+def nest_to_ring_index(nside: int) -> np.ndarray:
+    """
+    Indices such that map_nest[..., idx] is the map in RING ordering.
+
+    Cached; at nside 2048 each is 200 MB.
+    """
+    idx = hp.ring2nest(nside, np.arange(hp.nside2npix(nside)))
+    return idx.astype(np.int32 if idx.max() < 2**31 else np.int64)
+
+
+def ud_grade(map_in: np.ndarray,
+             nside_out: int,
+             order_in: str="RING",
+             order_out: str=None,
+             power: Union[float, None]=None,
+             dtype=None) -> np.ndarray:
+    """
+    Upgrades or downgrades map(s), as hp.ud_grade (with pess=False).
+
+    Parameters:
+    map_in (np.ndarray): A map, or maps with pixels on the last axis.
+    nside_out (int): The output nside.
+    order_in (str): 'RING' or 'NEST'.
+    order_out (str): 'RING' or 'NEST'. Defaults to order_in.
+    power (float): If set, the result is divided by (nside_in/nside_out)**power
+                   (e.g. power=2 for variance maps).
+    dtype: The output dtype. Defaults to the input dtype.
+
+    Returns:
+    np.ndarray: The map(s) at nside_out.
+    """
+    m = np.asarray(map_in)
+    if order_out is None:
+        order_out = order_in
+    ring_in = str(order_in).upper()[0:4] == "RING"
+    ring_out = str(order_out).upper()[0:4] == "RING"
+    type_out = np.dtype(dtype) if dtype is not None else m.dtype
+
+    nside_in = hp.npix2nside(m.shape[-1])
+    if not hp.isnsideok(nside_out, nest=not ring_in):
+        raise ValueError(f"{nside_out} is not a valid nside parameter (must be a power of 2)")
+    npix_out = hp.nside2npix(nside_out)
+
+    if nside_out == nside_in:
+        map_out = m
+        if ring_in != ring_out:
+            map_out = hp.reorder(m, r2n=ring_in, n2r=not ring_in)
+        return map_out.astype(type_out, copy=False)
+
+    ratio = (nside_out / nside_in) ** float(power) if power else 1
+
+    # Indices into the input map giving NEST ordering, or None if already NEST
+    r2n_in = ring_to_nest_index(nside_in) if ring_in else None
+
+    map_out = np.empty((*m.shape[:-1], npix_out), dtype=type_out)
+
+    if nside_out < nside_in:
+        rat2 = (nside_in // nside_out) ** 2
+        def _process(start, stop):
+            map_out[..., start:stop] = _downgrade_chunk(m, start, stop, rat2, ratio, r2n_in)
+    else:
+        rat2 = (nside_out // nside_in) ** 2
+        def _process(start, stop):
+            map_out[..., start:stop] = _upgrade_chunk(m, start, stop, rat2, ratio, r2n_in)
+
+    # Chunks are aligned to whole parent pixels when upgrading
+    chunk_size = max(CHUNK_SIZE // rat2, 1) * rat2 if nside_out > nside_in else CHUNK_SIZE
+    for start in range(0, npix_out, chunk_size):
+        _process(start, min(start + chunk_size, npix_out))
+
+    if ring_out:
+        map_out = map_out[..., nest_to_ring_index(nside_out)]
+    return map_out
+
+
+def _gather(m, start, stop, r2n_in):
+    if r2n_in is None:
+        return m[..., start:stop]
+    return m[..., r2n_in[start:stop]]
+
+
+def _downgrade_chunk(m, start, stop, rat2, ratio, r2n_in):
+    m_chunk = _gather(m, start * rat2, stop * rat2, r2n_in)
+    mr = m_chunk.reshape(*m_chunk.shape[:-1], stop - start, rat2)
+    out = mr.sum(axis=-1)
+    # Common case: no bad pixels. UNSEEN, -inf, and NaN all fail the first check
+    if mr.min() > UNSEEN_UPPER and np.isfinite(out).all():
+        return out * (ratio / rat2)
+
+    goods = ~(hp.mask_bad(mr) | ~np.isfinite(mr))
+    # As hp.ud_grade: multiplying (not masking) means a NaN still propagates to its parent pixel
+    out = np.sum(mr * goods, axis=-1).astype(mr.dtype)
+    nhit = goods.sum(axis=-1) / ratio
+    hit = nhit != 0
+    out[hit] = out[hit] / nhit[hit]
+    try:
+        out[~hit] = hp.UNSEEN
+    except OverflowError:
+        pass
+    return out
+
+
+def _upgrade_chunk(m, start, stop, rat2, ratio, r2n_in):
+    m_chunk = _gather(m, start // rat2, stop // rat2, r2n_in)
+    out = np.repeat(m_chunk, rat2, axis=-1)
+    if ratio != 1:
+        out = out * ratio
+    return out
+
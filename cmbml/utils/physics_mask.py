@@ -1,7 +1,15 @@
+from typing import Dict, Tuple, Union
+from dataclasses import dataclass
+from pathlib import Path
+from hashlib import sha256
+import os
 import logging
+
 import numpy as np
 import healpy as hp
 
+from cmbml.utils.nest_ud_grade import ud_grade
+
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +21,7 @@ def downgrade_mask(mask_data, nside_out, threshold):
         return mask_data
     elif nside_in < nside_out:
         logger.warning(f"Mask resolution is lower than map resolution. Consider scaling it externally. This is an unhandled case. Proceed with caution.")
-    downgraded_mask = hp.ud_grade(mask_data, nside_out)
+    downgraded_mask = ud_grade(mask_data, nside_out)
     mask = apply_threshold(downgraded_mask, threshold)
     return mask
 
@@ -23,3 +31,136 @@ def apply_threshold(mask, thresh):
     #    When downscaling mask maps; threshold the downscaled map
     #    They use 0.9
     return np.where(mask<thresh, 0, 1)
+
+
+@dataclass(frozen=True)
+class MaskInfo:
+    mask: np.ndarray           # 0 (masked) or 1 (unmasked), at the requested nside; as read if already at that nside
+    fsky: float                # Fraction of the sky left unmasked
+    unmasked_idx: np.ndarray   # Indices of the unmasked pixels
+
+
+class MaskService:
+    """
+    Provides masks downgraded from a source map (e.g. the Planck 2048 mask).
+
+    Masks are keyed by (source path, field, nside, threshold). Each is computed once, 
+    then kept in memory and (if a cache_dir is given) on disk, so that stages 
+    in later runs need not read the full resolution source again. Derived 
+    quantities (fsky, the unmasked pixel indices, apodized masks) are cached too.
+
+    Use get_mask_service() to share one instance across stages.
+    """
+    def __init__(self, cache_dir: Union[Path, str]=None) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._mask_infos: Dict[Tuple, MaskInfo] = {}
+        self._apodized: Dict[Tuple, np.ndarray] = {}
+
+    def get_mask(self, src_path, field, nside, threshold) -> np.ndarray:
+        return self.get_mask_info(src_path, field, nside, threshold).mask
+
+    def get_mask_info(self, src_path, field, nside, threshold) -> MaskInfo:
+        key = self._make_key(src_path, field, nside, threshold)
+        if key in self._mask_infos:
+            return self._mask_infos[key]
+
+        cache_path = self._get_cache_path(key, src_path, "mask")
+        if cache_path is not None and cache_path.exists():
+            logger.debug(f"Loading cached mask from {cache_path}")
+            mask = np.load(cache_path)
+            if mask.dtype == np.int8:
+                mask = mask.astype(np.int64)
+        else:
+            logger.info(f"Making mask from {src_path}, field {field}, at nside {nside} with threshold {threshold}.")
+            src_mask = hp.read_map(src_path, field=0 if field is None else field)
+            mask = downgrade_mask(src_mask, nside, threshold=threshold)
+            # Thresholded (0 or 1) masks are stored compactly; a mask used at its own nside is stored as read,
+            #   so that a mask loaded from the cache is the same as a mask just made
+            is_binary = np.issubdtype(mask.dtype, np.integer)
+            self._save(cache_path, mask.astype(np.int8) if is_binary else mask)
+
+        mask_info = MaskInfo(mask=mask,
+                             fsky=np.sum(mask) / mask.shape[0],
+                             unmasked_idx=np.flatnonzero(mask))
+        self._mask_infos[key] = mask_info
+        return mask_info
+
+    def get_apodized_mask(self, src_path, field, nside, threshold, aposize_deg) -> np.ndarray:
+        """
+        Mask with a smooth edge: the binary mask is smoothed with a Gaussian 
+        of FWHM aposize_deg, clipped to [0, 1], and zeroed where the binary mask is zero.
+        """
+        key = (*self._make_key(src_path, field, nside, threshold), aposize_deg)
+        if key in self._apodized:
+            return self._apodized[key]
+
+        cache_path = self._get_cache_path(key, src_path, "apodized")
+        if cache_path is not None and cache_path.exists():
+            apodized = np.load(cache_path)
+        else:
+            mask = self.get_mask(src_path, field, nside, threshold)
+            apodized = hp.smoothing(mask.astype(np.float64), fwhm=np.radians(aposize_deg))
+            apodized = np.clip(apodized, 0, 1) * mask
+            self._save(cache_path, apodized)
+        self._apodized[key] = apodized
+        return apodized
+
+    @staticmethod
+    def _make_key(src_path, field, nside, threshold) -> Tuple:
+        return (str(Path(src_path).resolve()), field, int(nside), float(threshold))
+
+    def _get_cache_path(self, key, src_path, kind) -> Union[Path, None]:
+        if self.cache_dir is None:
+            return None
+        # A changed source file gets a new cache entry
+        src_stat = os.stat(src_path)
+        key_str = repr((*key, src_stat.st_size, src_stat.st_mtime_ns))
+        key_hash = sha256(key_str.encode()).hexdigest()[:16]
+        return self.cache_dir / f"{Path(src_path).stem}_{kind}_{key_hash}.npy"
+
+    @staticmethod
+    def _save(cache_path, data) -> None:
+        if cache_path is None:
+            return
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write under a temporary name so that a partially written file is never read
+        tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, data)
+        os.replace(tmp_path, cache_path)
+
+
+_mask_services: Dict[str, MaskService] = {}
+
+
+def get_mask_service(cache_dir: Union[Path, str]=None) -> MaskService:
+    """
+    Returns the MaskService for the cache_dir, shared by all stages in this process.
+    """
+    service_key = str(cache_dir)
+    if service_key not in _mask_services:
+        _mask_services[service_key] = MaskService(cache_dir)
+    return _mask_services[service_key]
+
+
+def get_mask_cache_dir(cfg) -> Union[Path, None]:
+    """
+    The on-disk mask cache location from the hydra configs (None disables it).
+    """
+    mask_cache_dir = cfg.file_system.get("mask_cache_dir", None)
+    if not mask_cache_dir:
+        return None
+    return Path(cfg.local_system.datasets_root) / mask_cache_dir
+
+
+def get_stage_mask(cfg, mask_asset, nside: int, threshold: float) -> np.ndarray:
+    """
+    The mask of a stage's mask asset (a science asset, under the assets_dir),
+    at nside and thresholded.
+
+    Downgraded masks are shared across stages and runs (see get_mask_cache_dir).
+    """
+    with mask_asset.name_tracker.set_context("src_root", cfg.local_system.assets_dir):
+        mask_path = mask_asset.path
+    logger.info(f"Using mask from {mask_path}")
+    mask_service = get_mask_service(get_mask_cache_dir(cfg))
+    return mask_service.get_mask(mask_path, mask_asset.use_fields, nside, threshold)
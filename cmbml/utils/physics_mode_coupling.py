@@ -0,0 +1,175 @@
+"""
+Mode-coupling (MASTER) correction for power spectra of masked maps.
+
+Masking couples multipoles: the pseudo-spectrum of a masked map is
+<C~_l1> = sum_l2 M_l1l2 C_l2, with M set by the power spectrum of the mask
+(Hivon et al. 2002). Dividing by fsky (get_xpower's default) corrects only the
+overall amplitude. Here M is computed once per (mask, lmax, binning), binned,
+inverted, and cached on disk; correcting a spectrum is then a single
+matrix-vector product.
+
+Use get_mode_coupling() to get a (cached) ModeCoupling.
+"""
+from typing import Dict, Tuple, Union
+from pathlib import Path
+from hashlib import sha256
+import os
+import logging
+
+import numpy as np
+import healpy as hp
+from scipy.special import gammaln
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModeCoupling:
+    """
+    The inverse of the binned mode-coupling matrix for one mask.
+
+    Bins are [bin_edges[i], bin_edges[i+1]), covering lmin to lmax. Spectra are
+    averaged (flat in C_l) within bins. With delta_ell=1, bins are single ells.
+    """
+    def __init__(self, decoupling: np.ndarray, bin_edges: np.ndarray, lmax: int) -> None:
+        self.decoupling = decoupling    # (n_bins, lmax + 1): inverse binned M, times the binning operator
+        self.bin_edges = bin_edges
+        self.lmax = lmax
+
+    @property
+    def n_bins(self) -> int:
+        return len(self.bin_edges) - 1
+
+    @property
+    def bin_centers(self) -> np.ndarray:
+        return (self.bin_edges[:-1] + self.bin_edges[1:] - 1) / 2
+
+    def decouple(self, pseudo_cl: np.ndarray) -> np.ndarray:
+        """
+        Binned, mode-decoupled spectra from pseudo-spectra (not divided by fsky).
+
+        pseudo_cl may be (lmax + 1,) or a stack (n_maps, lmax + 1).
+        """
+        return pseudo_cl[..., :self.lmax + 1] @ self.decoupling.T
+
+    def to_ells(self, binned_cl: np.ndarray) -> np.ndarray:
+        """
+        Expands binned spectra to one value per ell, 0 to lmax. Ells below lmin are zero.
+        """
+        ells = np.arange(self.lmax + 1)
+        bin_idx = np.searchsorted(self.bin_edges, ells, side="right") - 1
+        in_bins = (bin_idx >= 0) & (bin_idx < self.n_bins)
+        cl = np.zeros((*binned_cl.shape[:-1], self.lmax + 1), dtype=binned_cl.dtype)
+        cl[..., in_bins] = binned_cl[..., bin_idx[in_bins]]
+        return cl
+
+
+def get_bin_edges(lmax: int, delta_ell: int, lmin: int=2) -> np.ndarray:
+    edges = np.arange(lmin, lmax + 1, delta_ell)
+    return np.append(edges, lmax + 1)
+
+
+def compute_coupling_matrix(mask_cl: np.ndarray, lmax: int) -> np.ndarray:
+    """
+    The mode-coupling matrix, M_l1l2, for ells 0 to lmax.
+
+    M_l1l2 = (2 l2 + 1) / (4 pi) * sum_l3 (2 l3 + 1) W_l3 (l1 l2 l3; 0 0 0)^2
+
+    Parameters:
+    mask_cl (np.ndarray): The power spectrum of the mask, W_l, to at least 2 * lmax.
+    lmax (int): Maximum ell.
+
+    Returns:
+    np.ndarray: M, of shape (lmax + 1, lmax + 1).
+    """
+    lmax_mask = len(mask_cl) - 1
+    # log(n!) for the Wigner 3j symbols
+    ln_fact = gammaln(np.arange(4 * lmax + 2) + 1)
+    weighted_mask_cl = (2 * np.arange(lmax_mask + 1) + 1) * mask_cl / (4 * np.pi)
+
+    # xi is symmetric; M_l1l2 = xi_l1l2 * (2 l2 + 1)
+    xi = np.zeros((lmax + 1, lmax + 1))
+    for l1 in range(lmax + 1):
+        l2 = np.arange(l1, lmax + 1)[:, None]
+        # Nonzero terms have |l1 - l2| <= l3 <= l1 + l2, with l1 + l2 + l3 even
+        k = np.arange(l1 + 1)[None, :]
+        l3 = (l2 - l1) + 2 * k
+        valid = l3 <= lmax_mask
+        # Any in-triangle value; these terms are dropped
+        l3 = np.where(valid, l3, l2 - l1)
+        w3j_sq = _wigner3j_000_squared(l1, l2, l3, ln_fact)
+        xi[l1, l1:] = np.sum(np.where(valid, w3j_sq * weighted_mask_cl[l3], 0), axis=1)
+    xi = xi + np.triu(xi, k=1).T
+    return xi * (2 * np.arange(lmax + 1) + 1)[None, :]
+
+
+def _wigner3j_000_squared(l1, l2, l3, ln_fact):
+    """
+    (l1 l2 l3; 0 0 0)^2, for l1 + l2 + l3 even and satisfying the triangle condition.
+    """
+    big_l = l1 + l2 + l3
+    g = big_l // 2
+    ln_w = (ln_fact[big_l - 2 * l1] + ln_fact[big_l - 2 * l2] + ln_fact[big_l - 2 * l3] - ln_fact[big_l + 1]
+            + 2 * (ln_fact[g] - ln_fact[g - l1] - ln_fact[g - l2] - ln_fact[g - l3]))
+    return np.exp(ln_w)
+
+
+def make_mode_coupling(mask: np.ndarray, lmax: int, delta_ell: int=1, lmin: int=2) -> ModeCoupling:
+    mask_cl = hp.anafast(mask.astype(np.float64), lmax=2 * lmax)
+    coupling = compute_coupling_matrix(mask_cl, lmax)
+
+    bin_edges = get_bin_edges(lmax, delta_ell, lmin)
+    n_bins = len(bin_edges) - 1
+    # Binning operator (average within each bin) and its inverse (spread over each bin)
+    binning = np.zeros((n_bins, lmax + 1))
+    unbinning = np.zeros((lmax + 1, n_bins))
+    for b in range(n_bins):
+        lo, hi = bin_edges[b], bin_edges[b + 1]
+        binning[b, lo:hi] = 1 / (hi - lo)
+        unbinning[lo:hi, b] = 1
+    binned_coupling = binning @ coupling @ unbinning
+    decoupling = np.linalg.solve(binned_coupling, binning)
+    return ModeCoupling(decoupling, bin_edges, lmax)
+
+
+_mode_couplings: Dict[Tuple, ModeCoupling] = {}
+
+
+def get_mode_coupling(mask: np.ndarray,
+                      lmax: int,
+                      delta_ell: int=1,
+                      lmin: int=2,
+                      cache_dir: Union[Path, str]=None) -> ModeCoupling:
+    """
+    Returns the ModeCoupling for a mask, computing it only if it is not cached
+    in memory or (if a cache_dir is given) on disk.
+    """
+    mask_hash = sha256(np.ascontiguousarray(mask, dtype=np.float64).tobytes()).hexdigest()[:16]
+    key = (mask_hash, int(lmax), int(delta_ell), int(lmin))
+    if key in _mode_couplings:
+        return _mode_couplings[key]
+
+    cache_path = None
+    if cache_dir is not None:
+        key_hash = sha256(repr(key).encode()).hexdigest()[:16]
+        cache_path = Path(cache_dir) / f"mode_coupling_{key_hash}.npz"
+
+    if cache_path is not None and cache_path.exists():
+        logger.debug(f"Loading cached mode-coupling matrix from {cache_path}")
+        with np.load(cache_path) as data:
+            mode_coupling = ModeCoupling(data["decoupling"], data["bin_edges"], int(data["lmax"]))
+    else:
+        logger.info(f"Computing mode-coupling matrix to lmax {lmax} with delta_ell {delta_ell}. This is done once per mask.")
+        mode_coupling = make_mode_coupling(mask, lmax, delta_ell, lmin)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write under a temporary name so that a partially written file is never read
+            tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp.npz")
+            np.savez(tmp_path,
+                     decoupling=mode_coupling.decoupling,
+                     bin_edges=mode_coupling.bin_edges,
+                     lmax=mode_coupling.lmax)
+            os.replace(tmp_path, cache_path)
+
+    _mode_couplings[key] = mode_coupling
+    return mode_coupling
@@ -1,3 +1,4 @@
+from typing import List
 from abc import ABC, abstractmethod
 import logging
 
@@ -10,11 +11,16 @@ from cmbml.utils.physics_beam import Beam, NoBeam
 logger = logging.getLogger(__name__)
 
 
-def get_autopower(map_, mask, lmax):
-    return get_xpower(map1=map_, map2=map_, mask=mask, lmax=lmax)
+def get_autopower(map_, mask, lmax, mode_coupling=None):
+    return get_xpower(map1=map_, map2=map_, mask=mask, lmax=lmax, mode_coupling=mode_coupling)
 
 
-def get_xpower(map1, map2, mask, lmax, use_pixel_weights=False):
+def get_xpower(map1, map2, mask, lmax, use_pixel_weights=False, mode_coupling=None):
+    """
+    The (cross) power spectrum of two maps. With a mask, the spectrum is 
+    corrected by dividing by fsky, or, if a ModeCoupling (for the same mask) 
+    is given, by the inverse of the mode-coupling matrix.
+    """
     if mask is None:
         ps = hp.anafast(map1, map2, lmax=lmax, use_pixel_weights=use_pixel_weights)
     else:
@@ -25,10 +31,160 @@ def get_xpower(map1, map2, mask, lmax, use_pixel_weights=False):
                         mask*(map2-mean2),
                         lmax=lmax,
                         use_pixel_weights=use_pixel_weights)
-        ps = ps / fsky
+        ps = _correct_masked_ps(ps, fsky, mode_coupling)
     return ps
 
 
+def _correct_masked_ps(pseudo_ps, fsky, mode_coupling):
+    if mode_coupling is None:
+        return pseudo_ps / fsky
+    return mode_coupling.to_ells(mode_coupling.decouple(pseudo_ps))
+
+
+def get_map_alms(maps, lmax, map_fields="I"):
+    """
+    The alms for maps of shape (n_fields, n_pix): temperature only for "I", 
+    otherwise T, E, and B (as anafast). Returns shape (n_fields, n_alm).
+    """
+    maps = np.atleast_2d(maps)
+    if map_fields == "I":
+        return hp.map2alm(maps[0], lmax=lmax)[None, :]
+    return np.stack(hp.map2alm(maps, lmax=lmax, pol=True), axis=0)
+
+
+def get_autopower_from_alms(alms, mask=None, mode_coupling=None):
+    """
+    As get_autopower, from alms (e.g. from get_map_alms or stored by an earlier stage).
+
+    With a mask, the alms must be of the masked, mean-subtracted map, 
+    mask * (map - mean), as get_xpower computes before its transform.
+    Alms stored in single precision (complex64) are accepted.
+    """
+    # hp.alm2cl needs complex128
+    alms = np.atleast_2d(alms).astype(np.complex128, copy=False)
+    ps = hp.alm2cl(alms[0]) if alms.shape[0] == 1 else hp.alm2cl(alms)
+    if mask is None:
+        return ps
+    fsky = np.sum(mask)/mask.shape[0]
+    return _correct_masked_ps(ps, fsky, mode_coupling)
+
+
+def get_autopower_batch(maps, mask, lmax, n_threads=1, backend="auto", mode_coupling=None):
+    """
+    Auto power spectra for a stack of maps sharing one mask.
+
+    Equivalent to calling get_autopower on each map. Masking and mean subtraction
+    are done for all maps at once. With the ducc0 backend, the spherical harmonic
+    transforms for the stack are batched and run on n_threads threads; with the
+    healpy backend, hp.map2alm is called per map (healpy sets its own threading).
+
+    Parameters:
+    maps (np.ndarray): Maps of shape (n_maps, n_pix), RING ordering.
+    mask (np.ndarray): Mask of shape (n_pix,), or None.
+    lmax (int): Maximum ell.
+    n_threads (int): Threads for the ducc0 backend.
+    backend (str): "ducc0", "healpy", or "auto" (ducc0 if installed).
+    mode_coupling (ModeCoupling): If given (with a mask), used instead of fsky to correct for the mask.
+
+    Returns:
+    np.ndarray: Power spectra of shape (n_maps, lmax + 1).
+    """
+    alms = get_masked_alms_batch(maps, mask, lmax, n_threads=n_threads, backend=backend)
+    return get_power_from_alms_batch(alms, mask=mask, mode_coupling=mode_coupling)
+
+
+def get_masked_alms_batch(maps, mask, lmax, n_threads=1, backend="auto"):
+    """
+    The alms of a stack of maps, (n_maps, n_pix), as get_xpower transforms them:
+    with a mask, the alms of mask * (map - mean). Returns shape (n_maps, n_alm).
+
+    The alms give both auto and cross spectra (get_power_from_alms_batch),
+    so that each map is transformed once. See get_autopower_batch for the backends.
+    """
+    maps = np.atleast_2d(maps)
+    if mask is not None:
+        means = maps @ mask / np.sum(mask)
+        maps = mask * (maps - means[:, None])
+
+    if backend == "auto":
+        backend = "ducc0" if _have_ducc0() else "healpy"
+
+    if backend == "ducc0":
+        return _ducc0_map2alm(maps, lmax, n_threads)
+    elif backend == "healpy":
+        return np.stack([hp.map2alm(m, lmax=lmax) for m in maps], axis=0)
+    raise ValueError(f"Unknown power spectrum backend: {backend}. Use 'ducc0', 'healpy', or 'auto'.")
+
+
+def get_power_from_alms_batch(alms1, alms2=None, mask=None, mode_coupling=None):
+    """
+    Auto (or, with alms2, cross) power spectra from stacks of alms, (n_maps, n_alm),
+    e.g. from get_masked_alms_batch. alms2 may be a single set of alms, shared by all of alms1.
+
+    With a mask, the alms must be of the masked, mean-subtracted maps, as for get_autopower_from_alms.
+    Returns shape (n_maps, lmax + 1).
+    """
+    # hp.alm2cl needs complex128; alms may be stored, or transformed, in complex64
+    alms1 = np.atleast_2d(alms1).astype(np.complex128, copy=False)
+    if alms2 is None:
+        ps = np.stack([hp.alm2cl(alm) for alm in alms1], axis=0)
+    else:
+        alms2 = np.broadcast_to(np.asarray(alms2).astype(np.complex128, copy=False), alms1.shape)
+        ps = np.stack([hp.alm2cl(alm1, alm2) for alm1, alm2 in zip(alms1, alms2)], axis=0)
+    if mask is None:
+        return ps
+    fsky = np.sum(mask)/mask.shape[0]
+    return _correct_masked_ps(ps, fsky, mode_coupling)
+
+
+def get_transfer_function(cross_ps, real_ps):
+    """
+    The transfer function of predictions, T_ell = C^{pred x real}_ell / C^{real}_ell.
+    Spectra have ells on the last axis (other axes broadcast); C_ell or D_ell alike.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cross_ps / real_ps
+
+
+def get_correlation_coefficient(cross_ps, real_ps, pred_ps):
+    """
+    The correlation coefficient of predictions and realizations,
+    r_ell = C^{pred x real}_ell / sqrt(C^{pred}_ell C^{real}_ell).
+    Spectra have ells on the last axis (other axes broadcast); C_ell or D_ell alike.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cross_ps / np.sqrt(real_ps * pred_ps)
+
+
+def _have_ducc0():
+    try:
+        import ducc0
+    except ImportError:
+        return False
+    return True
+
+
+def _ducc0_map2alm(maps, lmax, n_threads, n_iter=3):
+    """
+    As hp.map2alm (with its default of 3 iterations), for a stack of maps at once.
+    """
+    import ducc0
+
+    nside = hp.npix2nside(maps.shape[-1])
+    geom = ducc0.healpix.Healpix_Base(nside, "RING").sht_info()
+    sht_kwargs = dict(lmax=lmax, spin=0, nthreads=n_threads, **geom)
+    # ducc0 wants (n_transforms, n_components, n_pix); spin 0 has one component
+    maps = np.ascontiguousarray(maps, dtype=np.float64)[:, None, :]
+    pixel_area = 4 * np.pi / maps.shape[-1]
+
+    alms = ducc0.sht.experimental.adjoint_synthesis(map=maps, **sht_kwargs) * pixel_area
+    # Jacobi iterations, as healpy does
+    for _ in range(n_iter):
+        residual = maps - ducc0.sht.experimental.synthesis(alm=alms, **sht_kwargs)
+        alms += ducc0.sht.experimental.adjoint_synthesis(map=residual, **sht_kwargs) * pixel_area
+    return alms[:, 0, :]
+
+
 def cl_to_dl(cl, ells):
     norm = ells * (ells+1) / (np.pi * 2)
     return cl * norm
@@ -160,14 +316,50 @@ class CrossSpectrum(PowerSpectrum):
             logger.warning("CrossSpectrum is already deconvolved. No action taken.")
 
 
-def get_auto_ps_result(map_, lmax, is_convolved=False, beam=None, mask=None, name=None) -> PowerSpectrum:
+def get_auto_ps_result(map_, lmax, is_convolved=False, beam=None, mask=None, name=None, mode_coupling=None) -> PowerSpectrum:
     if beam is None:
         beam = NoBeam(lmax)
-    cl = get_autopower(map_, mask, lmax)
+    cl = get_autopower(map_, mask, lmax, mode_coupling=mode_coupling)
     ells = np.arange(lmax + 1)
     return AutoSpectrum(name, cl, ells, beam, is_convolved)
 
 
+def get_auto_ps_results_batch(maps, lmax, is_convolved=False, beam=None, mask=None, n_threads=1, backend="auto", mode_coupling=None) -> List[PowerSpectrum]:
+    """
+    As get_auto_ps_result, for a stack of maps sharing a mask and beam (see get_autopower_batch).
+    """
+    if beam is None:
+        beam = NoBeam(lmax)
+    cls = get_autopower_batch(maps, mask, lmax, n_threads=n_threads, backend=backend, mode_coupling=mode_coupling)
+    ells = np.arange(lmax + 1)
+    return [AutoSpectrum(None, cl, ells, beam, is_convolved) for cl in cls]
+
+
+def get_auto_ps_results_from_alms_batch(alms, lmax, is_convolved=False, beam=None, mask=None, mode_coupling=None) -> List[PowerSpectrum]:
+    """
+    As get_auto_ps_results_batch, from alms (see get_masked_alms_batch).
+    """
+    if beam is None:
+        beam = NoBeam(lmax)
+    cls = get_power_from_alms_batch(alms, mask=mask, mode_coupling=mode_coupling)
+    ells = np.arange(lmax + 1)
+    return [AutoSpectrum(None, cl, ells, beam, is_convolved) for cl in cls]
+
+
+def get_x_ps_results_from_alms_batch(alms1, alms2, lmax, is_convolved=False, beam1=None, beam2=None, mask=None, mode_coupling=None) -> List[PowerSpectrum]:
+    """
+    Cross spectra of a stack of alms with other alms, e.g. of predictions with their realization,
+    without transforming the maps again (see get_masked_alms_batch and get_power_from_alms_batch).
+    """
+    if beam1 is None:
+        beam1 = NoBeam(lmax)
+    if beam2 is None:
+        beam2 = NoBeam(lmax)
+    cls = get_power_from_alms_batch(alms1, alms2, mask=mask, mode_coupling=mode_coupling)
+    ells = np.arange(lmax + 1)
+    return [CrossSpectrum(None, cl, ells, beam1, beam2, is_convolved) for cl in cls]
+
+
 def get_x_ps_result(map1, map2, lmax, is_convolved=False, beam1=None, beam2=None, mask=None, name=None) -> PowerSpectrum:
     if beam1 is None:
         beam1 = NoBeam(lmax)
@@ -0,0 +1,240 @@
+"""
+Streaming summary statistics, for summarizing reports as results arrive.
+
+RunningStats keeps the mean and standard deviation of a stream of values
+(Welford's algorithm) and, optionally, estimates of quantiles (the P-squared
+algorithm of Jain & Chlamtac, 1985). Memory does not grow with the number of values.
+
+RunningArrayStats does the same elementwise, for arrays (e.g. spectra).
+
+GroupedStats keeps a RunningStats for each metric within each group (e.g. each
+epoch), and produces tables in the same layout as pandas' agg(['mean', 'std']).
+Results match pandas, including skipping NaN and using ddof=1.
+"""
+from typing import Dict, Hashable, Iterable, List, Sequence, Union
+import math
+
+import numpy as np
+import pandas as pd
+
+
+class P2Quantile:
+    """
+    Estimate of a single quantile of a stream, with five markers (P-squared algorithm).
+
+    Values may be scalars or arrays (of a fixed shape), in which case each
+    element gets its own estimate. Exact for up to five values.
+    """
+    def __init__(self, q: float) -> None:
+        if not 0 < q < 1:
+            raise ValueError(f"Quantiles must be between 0 and 1; got {q}.")
+        self.q = q
+        self.count = 0
+        self._first: List[np.ndarray] = []
+        self.heights: np.ndarray = None     # (5, *shape)
+        self.positions: np.ndarray = None   # (5, *shape)
+        self.desired = np.array([1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5])
+        self.increments = np.array([0, q / 2, q, (1 + q) / 2, 1])
+
+    def update(self, value: Union[float, np.ndarray]) -> None:
+        value = np.asarray(value, dtype=np.float64)
+        self.count += 1
+        if self.count <= 5:
+            self._first.append(value)
+            if self.count == 5:
+                self.heights = np.sort(np.stack(self._first), axis=0)
+                self.positions = np.broadcast_to(np.arange(1.0, 6.0).reshape(5, *[1] * value.ndim),
+                                                 self.heights.shape).copy()
+            return
+
+        h, n = self.heights, self.positions
+        # Adjust the extreme markers, then find the cell (0 to 3) containing the value
+        h[0] = np.minimum(h[0], value)
+        h[4] = np.maximum(h[4], value)
+        k = (value >= h[1]).astype(int) + (value >= h[2]) + (value >= h[3])
+
+        for i in range(1, 5):
+            n[i] += i > k
+        self.desired += self.increments
+
+        # Move the middle markers toward their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            move = (((d >= 1) & (n[i + 1] - n[i] > 1))
+                    | ((d <= -1) & (n[i - 1] - n[i] < -1)))
+            if not np.any(move):
+                continue
+            d = np.where(d >= 0, 1.0, -1.0)
+            parabolic = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1]))
+            h_next = np.where(d > 0, h[i + 1], h[i - 1])
+            n_next = np.where(d > 0, n[i + 1], n[i - 1])
+            linear = h[i] + d * (h_next - h[i]) / (n_next - n[i])
+            in_order = (h[i - 1] < parabolic) & (parabolic < h[i + 1])
+            h[i] = np.where(move, np.where(in_order, parabolic, linear), h[i])
+            n[i] += np.where(move, d, 0)
+
+    @property
+    def value(self) -> Union[float, np.ndarray]:
+        if self.count == 0:
+            return np.nan
+        if self.count < 5:
+            # Exact, with linear interpolation (as np.quantile and pandas)
+            value = np.quantile(np.stack(self._first), self.q, axis=0)
+        else:
+            value = self.heights[2]
+        return float(value) if np.ndim(value) == 0 else value.copy()
+
+
+class RunningStats:
+    """
+    Count, mean, and standard deviation (ddof=1) of a stream of values,
+    with optional quantile estimates. NaN values are skipped, as in pandas.
+    """
+    def __init__(self, quantiles: Sequence[float]=()) -> None:
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._quantiles = [P2Quantile(q) for q in quantiles]
+
+    def update(self, value: float) -> None:
+        if value is None:
+            return
+        value = float(value)
+        if math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        for quantile in self._quantiles:
+            quantile.update(value)
+
+    @property
+    def mean(self) -> float:
+        return self._mean if self.count > 0 else np.nan
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+    def summary(self) -> Dict[str, float]:
+        summary = {'mean': self.mean, 'std': self.std}
+        for quantile in self._quantiles:
+            summary[quantile_label(quantile.q)] = quantile.value
+        return summary
+
+
+class RunningArrayStats:
+    """
+    Elementwise mean and variance of a stream of arrays of one shape (e.g. power
+    spectra), with optional quantile estimates. Arrays can be added one at a time or
+    in batches; batches are merged exactly (Chan et al., 1979).
+    """
+    def __init__(self, quantiles: Sequence[float]=()) -> None:
+        self.count = 0
+        self._mean: np.ndarray = None
+        self._m2: np.ndarray = None
+        self._quantiles = [P2Quantile(q) for q in quantiles]
+
+    def update(self, value: np.ndarray) -> None:
+        self.update_batch(np.asarray(value)[None])
+
+    def update_batch(self, values: np.ndarray) -> None:
+        """
+        Adds arrays stacked on the first axis.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n_batch = values.shape[0]
+        if n_batch == 0:
+            return
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self._mean, self._m2 = batch_mean, batch_m2
+        else:
+            n_total = self.count + n_batch
+            delta = batch_mean - self._mean
+            self._mean = self._mean + delta * n_batch / n_total
+            self._m2 = self._m2 + batch_m2 + delta ** 2 * self.count * n_batch / n_total
+        self.count += n_batch
+        for quantile in self._quantiles:
+            for value in values:
+                quantile.update(value)
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self._mean
+
+    def var(self, ddof: int=0) -> np.ndarray:
+        if self.count - ddof <= 0:
+            return np.full_like(self._mean, np.nan)
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof: int=0) -> np.ndarray:
+        return np.sqrt(self.var(ddof))
+
+    @property
+    def quantiles(self) -> Dict[float, np.ndarray]:
+        return {quantile.q: quantile.value for quantile in self._quantiles}
+
+
+def quantile_label(q: float) -> str:
+    return f"q{q:g}"
+
+
+class GroupedStats:
+    """
+    RunningStats for each metric, within each group.
+
+    Groups are any hashable labels; they are created when first updated.
+    """
+    def __init__(self, metrics: Iterable[str], quantiles: Sequence[float]=()) -> None:
+        self.metrics = list(metrics)
+        self.quantiles = list(quantiles)
+        self._stats: Dict[Hashable, Dict[str, RunningStats]] = {}
+
+    @property
+    def stat_names(self) -> List[str]:
+        return ['mean', 'std'] + [quantile_label(q) for q in self.quantiles]
+
+    @property
+    def groups(self) -> List[Hashable]:
+        return list(self._stats.keys())
+
+    def update(self, group: Hashable, result: Dict) -> None:
+        """
+        Adds one result (e.g. a row of a report) to a group. Metrics absent from the result are skipped.
+        """
+        if group not in self._stats:
+            self._stats[group] = {metric: RunningStats(self.quantiles) for metric in self.metrics}
+        group_stats = self._stats[group]
+        for metric in self.metrics:
+            if metric in result:
+                group_stats[metric].update(result[metric])
+
+    def summary(self, group: Hashable) -> pd.DataFrame:
+        """
+        Summary of one group: a row per statistic, a column per metric
+        (as df[metrics].agg(['mean', 'std'])).
+        """
+        group_stats = self._stats.get(group, None)
+        if group_stats is None:
+            group_stats = {metric: RunningStats(self.quantiles) for metric in self.metrics}
+        data = {metric: group_stats[metric].summary() for metric in self.metrics}
+        return pd.DataFrame(data, index=self.stat_names, columns=self.metrics)
+
+    def summary_by(self, groups: Sequence[Hashable], labels: Sequence=None, name: str=None) -> pd.DataFrame:
+        """
+        Summary of several groups: a row per group, with (metric, statistic) columns
+        (as df.groupby(name)[metrics].agg(['mean', 'std'])).
+        """
+        labels = list(groups) if labels is None else list(labels)
+        columns = pd.MultiIndex.from_product([self.metrics, self.stat_names])
+        rows = []
+        for group in groups:
+            summary = self.summary(group)
+            rows.append([summary.loc[stat, metric] for metric, stat in columns])
+        return pd.DataFrame(rows, index=pd.Index(labels, name=name), columns=columns)
+
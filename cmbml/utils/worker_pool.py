@@ -0,0 +1,84 @@
+"""
+Running a stage's tasks across processes, with settings shared by all tasks.
+
+Settings that every task needs (e.g. a mask and beams, or a projection) are given
+to each worker once, when it starts, instead of being sent with every task.
+Task functions read them with get_settings().
+"""
+from typing import Any, Callable, List, NamedTuple, Sequence
+from pathlib import Path
+import logging
+
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from cmbml.core import Asset, GenericHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenAsset(NamedTuple):
+    # FrozenAsset is created as an immutable so that multiprocessing can run.
+    path: Path
+    handler: GenericHandler
+
+
+def freeze(asset: Asset) -> FrozenAsset:
+    """
+    The asset's current path and its handler, to send to a worker (None for None).
+    """
+    if asset is None:
+        return None
+    return FrozenAsset(path=asset.path, handler=asset.handler)
+
+
+# Set in each worker by init_worker()
+_settings: Any = None
+
+
+def init_worker(settings: Any, initializer: Callable=None, initargs: Sequence=()) -> None:
+    global _settings
+    _settings = settings
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def get_settings() -> Any:
+    """
+    The settings given to run_tasks(), in a task function.
+    """
+    return _settings
+
+
+def run_tasks(process: Callable,
+              tasks: List,
+              settings: Any,
+              num_processes: int,
+              initializer: Callable=None,
+              initargs: Sequence=()) -> List:
+    """
+    Runs process on each task, with settings available through get_settings().
+    Returns the results, in no particular order.
+
+    The first task is run in this process, outside multiprocessing, to avoid
+    painful debugging within multiprocessing. initializer(*initargs), if given,
+    is also called in each worker (e.g. fig_render.init_render_worker).
+    """
+    if len(tasks) == 0:
+        return []
+    init_worker(settings, initializer, initargs)
+    results = [process(tasks[0])]
+
+    other_tasks = tasks[1:]
+    if len(other_tasks) == 0:
+        return results
+    logger.info(f"Running {len(other_tasks)} more tasks across {num_processes} workers.")
+    with Pool(processes=num_processes,
+              initializer=init_worker,
+              initargs=(settings, initializer, initargs)) as pool:
+        # Create an iterator from imap_unordered and wrap it with tqdm for progress tracking
+        for result in tqdm(pool.imap_unordered(process, other_tasks), total=len(other_tasks)):
+            results.append(result)
+    return results
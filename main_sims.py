@@ -28,6 +28,7 @@ from cmbml.sims import (
     HydraConfigSimsCheckerExecutor,
     NoiseCacheExecutor,
     ConfigExecutor,
+    PSEmulatorExecutor,
     TheoryPSExecutor,
     SimCreatorExecutor
 )
@@ -57,6 +58,7 @@ def run_simulations(cfg):
     pipeline_context.add_pipe(HydraConfigSimsCheckerExecutor)
     pipeline_context.add_pipe(NoiseCacheExecutor)
     pipeline_context.add_pipe(ConfigExecutor)
+    pipeline_context.add_pipe(PSEmulatorExecutor)  # Skipped unless enabled in the cmb yaml
     pipeline_context.add_pipe(TheoryPSExecutor)
     pipeline_context.add_pipe(SimCreatorExecutor)
     # TODO: Put this back in the pipeline yaml; fix/make executor
@@ -0,0 +1,30 @@
+import numpy as np
+import healpy as hp
+import matplotlib
+import matplotlib.pyplot as plt
+import pytest
+
+from cmbml.utils.fig_render import get_mollweide_grid, project
+
+
+matplotlib.use("Agg")
+
+
+@pytest.mark.parametrize("nside, xsize", [(64, 400), (256, 1200)])
+def test_projection_matches_mollview(nside, xsize):
+    test_map = np.random.default_rng(0).normal(size=hp.nside2npix(nside))
+    test_map[:1000] = hp.UNSEEN
+
+    expected = hp.mollview(test_map, xsize=xsize, return_projected_map=True)
+    plt.close("all")
+    img = project(test_map, get_mollweide_grid(nside, xsize))
+
+    on_sky = ~np.ma.getmaskarray(expected) & np.isfinite(expected)
+    assert img.shape == expected.shape
+    np.testing.assert_array_equal(img.filled(hp.UNSEEN)[on_sky], np.asarray(expected)[on_sky])
+    # Masked in the image wherever healpy shows nothing
+    assert np.all(img.mask[~on_sky])
+
+
+def test_grid_is_cached():
+    assert get_mollweide_grid(32, 200) is get_mollweide_grid(32, 200)
@@ -0,0 +1,37 @@
+import numpy as np
+import healpy as hp
+import pytest
+
+from cmbml.core.asset_handlers.healpy_alm_handler import HealpyAlm
+from cmbml.utils.physics_ps import get_autopower_from_alms, get_power_from_alms_batch
+
+
+NSIDE = 32
+LMAX = 64
+
+
+@pytest.fixture
+def cmb_map():
+    return hp.synfast(1 / np.arange(1, 3 * NSIDE + 1) ** 2, NSIDE).astype(np.float32)
+
+
+@pytest.mark.parametrize("alm_dtype", [np.complex64, np.complex128])
+def test_spectrum_from_stored_alms(tmp_path, cmb_map, alm_dtype):
+    alms = hp.map2alm(cmb_map.astype(np.float64), lmax=LMAX)
+    path = tmp_path / "alms.fits"
+    HealpyAlm().write(path, alms.astype(alm_dtype))
+    read_alms = HealpyAlm().read(path)
+    assert read_alms.shape == (1, alms.shape[0])
+
+    expected = hp.alm2cl(alms.astype(alm_dtype).astype(np.complex128))
+    np.testing.assert_allclose(get_autopower_from_alms(read_alms), expected, rtol=1e-6)
+    np.testing.assert_allclose(get_power_from_alms_batch(read_alms)[0], expected, rtol=1e-6)
+    np.testing.assert_allclose(get_power_from_alms_batch(read_alms, read_alms[0])[0], expected, rtol=1e-6)
+
+
+def test_read_truncates_to_lmax(tmp_path, cmb_map):
+    alms = hp.map2alm(cmb_map.astype(np.float64), lmax=LMAX)
+    path = tmp_path / "alms.fits"
+    HealpyAlm().write(path, alms)
+    read_alms = HealpyAlm().read(path, lmax=LMAX // 2)
+    np.testing.assert_allclose(get_autopower_from_alms(read_alms), hp.alm2cl(alms)[:LMAX // 2 + 1])
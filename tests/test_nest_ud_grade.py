@@ -0,0 +1,57 @@
+import numpy as np
+import healpy as hp
+import pytest
+
+from cmbml.utils.nest_ud_grade import ud_grade
+
+
+NSIDE_IN = 256
+NPIX_IN = hp.nside2npix(NSIDE_IN)
+
+
+def make_map():
+    return np.random.default_rng(0).normal(size=NPIX_IN)
+
+
+def make_maps_float32():
+    return np.random.default_rng(1).normal(size=(3, NPIX_IN)).astype(np.float32)
+
+
+def make_bad_map():
+    rng = np.random.default_rng(2)
+    bad_map = rng.normal(size=NPIX_IN)
+    bad_map[rng.choice(NPIX_IN, NPIX_IN // 10, replace=False)] = hp.UNSEEN
+    bad_map[:64] = hp.UNSEEN   # A whole low-resolution pixel (in NEST)
+    bad_map[100] = np.nan
+    bad_map[200] = np.inf
+    return bad_map
+
+
+def assert_matches_healpy(m, **kwargs):
+    expected = hp.ud_grade(m, **kwargs)
+    result = ud_grade(m, **kwargs)
+    assert result.dtype == expected.dtype
+    # Summation order differs slightly; float32 inputs differ in the last bits
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6, equal_nan=True)
+
+
+@pytest.mark.parametrize("nside_out", [64, 512])
+@pytest.mark.parametrize("order_in", ["RING", "NEST"])
+@pytest.mark.parametrize("order_out", [None, "RING", "NEST"])
+@pytest.mark.parametrize("power", [None, 2, -2])
+def test_matches_healpy(nside_out, order_in, order_out, power):
+    assert_matches_healpy(make_map(), nside_out=nside_out, order_in=order_in, order_out=order_out, power=power)
+
+
+@pytest.mark.parametrize("nside_out", [64, 512])
+def test_matches_healpy_float32_stack(nside_out):
+    assert_matches_healpy(make_maps_float32(), nside_out=nside_out, order_in="RING")
+
+
+@pytest.mark.parametrize("nside_out", [64, 512])
+def test_matches_healpy_unseen_and_nonfinite(nside_out):
+    assert_matches_healpy(make_bad_map(), nside_out=nside_out, order_in="NEST", order_out="RING", power=2)
+
+
+def test_same_nside_reorders():
+    assert_matches_healpy(make_map(), nside_out=NSIDE_IN, order_in="RING", order_out="NEST")
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from cmbml.core.asset_handlers.psmaker_handler import NumpyPowerSpectrumStack
+
+
+@pytest.fixture
+def stack_path(tmp_path):
+    # Rows out of sim order, as a stack may be written
+    sims = np.array([3, 0, 2, 1])
+    spectra = np.stack([np.full(10, sim, dtype=float) for sim in sims])
+    path = tmp_path / "theory_ps_stack.npy"
+    NumpyPowerSpectrumStack().write(path, data=spectra, sims=sims)
+    return path
+
+
+def test_lookup_by_sim(stack_path):
+    lookup = NumpyPowerSpectrumStack().read_lookup(stack_path)
+    for sim in range(4):
+        spectrum = lookup(sim)
+        np.testing.assert_array_equal(spectrum, np.full(10, sim))
+        assert not isinstance(spectrum, np.memmap)
+    np.testing.assert_array_equal(lookup.spectra[lookup.rows([2, 3])][:, 0], [2, 3])
+
+
+def test_lookup_missing_sim(stack_path):
+    lookup = NumpyPowerSpectrumStack().read_lookup(stack_path)
+    with pytest.raises(OSError, match=r"sims \[7\]"):
+        lookup(7)
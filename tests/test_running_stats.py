@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cmbml.utils.running_stats import (
+    RunningStats,
+    RunningArrayStats,
+    GroupedStats,
+    quantile_label
+    )
+
+
+@pytest.fixture
+def values():
+    values = np.random.default_rng(0).gamma(2.0, size=5000)
+    values[::97] = np.nan
+    return values
+
+
+def test_running_stats_matches_pandas(values):
+    stats = RunningStats()
+    for v in values:
+        stats.update(v)
+    expected = pd.Series(values).agg(['mean', 'std'])
+    assert np.isclose(stats.mean, expected['mean'])
+    assert np.isclose(stats.std, expected['std'])
+
+
+@pytest.mark.parametrize("q", [0.05, 0.5, 0.95])
+def test_p2_quantile_within_bounds(values, q):
+    stats = RunningStats(quantiles=[q])
+    for v in values:
+        stats.update(v)
+    estimate, exact = stats.summary()[quantile_label(q)], np.nanquantile(values, q)
+    assert abs(estimate - exact) < 0.05 * exact
+
+
+def test_p2_quantile_exact_for_few_values():
+    stats = RunningStats(quantiles=[0.5])
+    for v in [3.0, 1.0, 2.0]:
+        stats.update(v)
+    assert stats.summary() == {'mean': 2.0, 'std': 1.0, 'q0.5': 2.0}
+
+
+@pytest.fixture
+def report():
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({'split': rng.choice(['Test1', 'Test2'], 200),
+                         'mse': rng.normal(size=200),
+                         'mae': rng.normal(size=200)})
+
+
+def test_grouped_stats_match_pandas(report):
+    grouped = GroupedStats(['mse', 'mae'])
+    for row in report.to_dict('records'):
+        grouped.update(row['split'], row)
+    pd.testing.assert_frame_equal(grouped.summary('Test1'),
+                                  report[report['split'] == 'Test1'][['mse', 'mae']].agg(['mean', 'std']))
+    pd.testing.assert_frame_equal(grouped.summary_by(['Test1', 'Test2'], name='split'),
+                                  report.groupby('split')[['mse', 'mae']].agg(['mean', 'std']))
+
+
+def test_running_array_stats_match_numpy():
+    spectra = np.random.default_rng(2).gamma(2.0, size=(1000, 300))
+    array_stats = RunningArrayStats(quantiles=[0.16, 0.84])
+    array_stats.update(spectra[0])
+    for start in range(1, len(spectra), 128):
+        array_stats.update_batch(spectra[start:start + 128])
+    assert array_stats.count == len(spectra)
+    np.testing.assert_allclose(array_stats.mean, spectra.mean(axis=0))
+    np.testing.assert_allclose(array_stats.std(), spectra.std(axis=0))
+    np.testing.assert_allclose(array_stats.std(ddof=1), spectra.std(axis=0, ddof=1))
+    for q, estimate in array_stats.quantiles.items():
+        exact = np.quantile(spectra, q, axis=0)
+        rel_err = np.abs(estimate - exact) / exact
+        assert np.max(rel_err) < 0.15
+        assert np.mean(rel_err) < 0.03